@@ -0,0 +1,28 @@
+#!/bin/sh
+#
+# Start the cnc app
+#
+# CNC_SERVER=runserver (default) runs the django development server as before
+# CNC_SERVER=asgi runs gunicorn with CNC_WORKERS uvicorn workers and the async workflow views. It stays opt in until
+# scripts/benchmark covers it, the benchmark only runs against runserver so far
+#
+
+if [ "${CNC_SERVER:-runserver}" = "runserver" ]; then
+    exec python /app/cnc/manage.py runserver 0.0.0.0:80
+fi
+
+export BOOTSTRAPPER_ASYNC_VIEWS="${BOOTSTRAPPER_ASYNC_VIEWS:-yes}"
+export BOOTSTRAPPER_WARMUP="${BOOTSTRAPPER_WARMUP:-yes}"
+
+# each worker keeps its own metrics, prometheus_client collects them from files in this dir
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/cnc_metrics}"
+rm -rf "${PROMETHEUS_MULTIPROC_DIR}" && mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+
+# archives can take minutes to build, so the worker timeout must be longer than the bootstrapper read timeout
+exec gunicorn bootstrapper.asgi:application \
+    --worker-class uvicorn.workers.UvicornWorker \
+    --workers "${CNC_WORKERS:-4}" \
+    --timeout "${CNC_WORKER_TIMEOUT:-600}" \
+    --pythonpath /app/cnc,/app/src \
+    --chdir /app/cnc \
+    --bind 0.0.0.0:80
@@ -0,0 +1,25 @@
+# ASGI entry point for running the cnc app with the bootstrapper views under an async server
+#
+# Used by entrypoint.sh in the container when CNC_SERVER=asgi, which runs it with gunicorn and uvicorn workers:
+#
+# gunicorn bootstrapper.asgi:application -k uvicorn.workers.UvicornWorker --pythonpath /app/cnc,/app/src
+#
+# Set BOOTSTRAPPER_ASYNC_VIEWS=yes so the complete and Panorama steps are served as async views, and
+# BOOTSTRAPPER_WARMUP=yes to fill the snippet, repository and template caches as each worker starts. Streamed
+# archives and files are read in a thread rather than on the event loop, see bootstrapper.lib.asgi_utils
+#
+
+import os
+
+# set before anything from django or the app is imported, asgi_utils imports the django handlers
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cnc.settings')
+
+from bootstrapper.lib import asgi_utils  # noqa: E402
+
+# runserver serves the static files itself, there is no separate web server in the container to do it
+application = asgi_utils.get_asgi_application()
+
+# fill the caches in the background while the worker starts taking requests, see /bootstrapper/ready
+from bootstrapper.lib import warmup_utils  # noqa: E402
+
+warmup_utils.start_warmup()
@@ -0,0 +1,57 @@
+# Build bootstrap archives for a fleet of devices from a single CSV or YAML inventory file
+#
+# Each row of the inventory holds the bootstrapper-payload variables for one device. All archives are written into
+# a single zip file along with a status.csv report for each device.
+#
+# Example:
+#
+# docker-compose exec cnc python /app/src/bootstrapper/build_fleet.py /root/.pan_cnc/inventory.csv \
+#   -o /root/.pan_cnc/fleet.zip
+#
+
+import argparse
+import os
+import sys
+
+# locate the pan-cnc project next to the src directory this app is installed in
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cnc_dir = os.environ.get('CNC_DIR', os.path.join(os.path.dirname(src_dir), 'cnc'))
+sys.path.insert(0, cnc_dir)
+sys.path.insert(0, src_dir)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cnc.settings')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build bootstrap archives for every device in an inventory file')
+    parser.add_argument('inventory', help='CSV or YAML inventory file')
+    parser.add_argument('-o', '--output', default='bootstrap_fleet.zip', help='zip file to write all archives to')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='max concurrent builds, defaults to BOOTSTRAPPER_FLEET_WORKERS')
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+
+    from bootstrapper.lib import fleet_utils
+
+    try:
+        with open(args.inventory, 'rb') as inventory_file:
+            devices = fleet_utils.load_inventory(inventory_file, args.inventory)
+    except (OSError, ValueError) as e:
+        print(f'Could not load inventory {args.inventory}: {e}')
+        return 1
+
+    print(f'Building {len(devices)} devices into {args.output}')
+    try:
+        results = fleet_utils.build_fleet(devices, 'bootstrapper', args.output, args.workers)
+    except ValueError as ve:
+        print(ve)
+        return 1
+
+    failed = [r for r in results if r['status'] != 'success']
+    print(f'Built {len(results) - len(failed)} of {len(results)} archives')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
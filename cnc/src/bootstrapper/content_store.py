@@ -0,0 +1,63 @@
+# Manage the dynamic content packages that are added to bootstrap archives
+#
+# Packages are kept in BOOTSTRAPPER_CONTENT_DIR together with an index of their type, version and checksum. Download
+# a package once and every archive built with include_dynamic_content set to yes will reference it.
+#
+# Example:
+#
+# docker-compose exec cnc python /app/src/bootstrapper/content_store.py download \
+#   https://updates.example.com/panupv2-all-contents-8213-5678 --sha256 <digest>
+# docker-compose exec cnc python /app/src/bootstrapper/content_store.py list
+#
+
+import argparse
+import os
+import sys
+
+# locate the pan-cnc project next to the src directory this app is installed in
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cnc_dir = os.environ.get('CNC_DIR', os.path.join(os.path.dirname(src_dir), 'cnc'))
+sys.path.insert(0, cnc_dir)
+sys.path.insert(0, src_dir)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cnc.settings')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the dynamic content package store')
+    parser.add_argument('-d', '--content-dir', default=None, help='store directory, defaults to '
+                                                                  'BOOTSTRAPPER_CONTENT_DIR')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='index and list all stored packages')
+    download_parser = subparsers.add_parser('download', help='download packages into the store')
+    download_parser.add_argument('urls', nargs='+', help='package urls')
+    download_parser.add_argument('--sha256', action='append', default=list(),
+                                 help='expected sha256 of each package, in the same order as the urls')
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+
+    import requests
+
+    from bootstrapper.lib import content_utils
+
+    if args.command == 'download':
+        session = requests.Session()
+        checksums = args.sha256 + [None] * (len(args.urls) - len(args.sha256))
+        for url, sha256 in zip(args.urls, checksums):
+            try:
+                package = content_utils.download_package(url, sha256, content_dir=args.content_dir, session=session)
+            except (ValueError, OSError, requests.exceptions.RequestException) as e:
+                print(f'Could not download {url}: {e}')
+                return 1
+            print(f'Stored {package["name"]} sha256 {package["sha256"]}')
+        return 0
+
+    index = content_utils.scan_content(args.content_dir)
+    for name, entry in sorted(index.items(), key=lambda i: (i[1]['package'], i[1]['version'])):
+        print(f'{entry["package"]:<10} {entry["version"]:<12} {entry["size"]:>12} {entry["sha256"]}  {name}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Helpers for the json api, which builds an archive from a single request instead of the step by step workflow
+
+The api is disabled unless BOOTSTRAPPER_API_TOKEN is set. Clients send the token as 'Authorization: Bearer <token>'
+and POST a json object of bootstrapper-payload variables to /bootstrapper/api_build. A bootstrap.xml can be included
+by naming a template in 'custom_bootstrap' or by passing the document itself in 'bootstrap_xml'. With 'async' set to
+true the archive is built as a background job and kept in the archive cache until it is downloaded from
+/bootstrapper/api_job/<job_id>?download=yes
+"""
+import hmac
+import json
+
+import requests
+
+from pan_cnc.lib import cnc_utils
+
+from bootstrapper.lib import archive_cache_utils
+from bootstrapper.lib import blob_utils
+from bootstrapper.lib import build_utils
+from bootstrapper.lib import job_utils
+from bootstrapper.lib import metrics_utils
+from bootstrapper.lib import upload_utils
+from bootstrapper.lib import upstream_utils
+
+# keys accepted in a build request that are not bootstrapper-payload variables
+api_options = ('custom_bootstrap', 'bootstrap_xml', 'async')
+
+# snippet variables that are rendered by the app and can not be supplied by a client
+internal_variables = ('payload', 'init_cfg')
+
+
+def get_api_token():
+    return cnc_utils.get_config_value('BOOTSTRAPPER_API_TOKEN', '')
+
+
+def is_authorized(request):
+    """
+    Check the bearer token sent with an api request
+    :param request: django request
+    :return: True if the api is enabled and the token matches
+    """
+    token = get_api_token()
+    if token == '':
+        return False
+
+    auth_header = request.META.get('HTTP_AUTHORIZATION', '')
+    scheme, _, supplied = auth_header.partition(' ')
+    if scheme.lower() != 'bearer':
+        return False
+
+    return hmac.compare_digest(supplied.strip().encode('utf-8'), token.encode('utf-8'))
+
+
+def parse_build_request(service, body):
+    """
+    Parse and check the json body of a build request
+    :param service: bootstrapper-payload snippet (service) dict
+    :param body: raw request body
+    :return: tuple of variables dict, inline bootstrap.xml string and the async flag
+    :raises ValueError: if the body is not a json object or contains unknown keys
+    """
+    try:
+        data = json.loads(body)
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError) as je:
+        raise ValueError(f'Request body is not valid json: {je}')
+
+    if not isinstance(data, dict):
+        raise ValueError('Request body must be a json object')
+
+    known = {v['name'] for v in service.get('variables', []) if v['name'] not in internal_variables}
+    unknown = sorted(k for k in data if k not in known and k not in api_options)
+    if unknown:
+        raise ValueError(f'Unknown variables: {", ".join(unknown)}')
+
+    variables = dict()
+    for key, value in data.items():
+        if key in ('bootstrap_xml', 'async'):
+            continue
+        if isinstance(value, bool):
+            # same as the dropdowns in the workflow, which use the strings yes and no
+            value = 'yes' if value else 'no'
+        elif value is None:
+            value = ''
+        elif isinstance(value, (dict, list)):
+            raise ValueError(f'Variable {key} must be a string')
+        variables[key] = str(value)
+
+    bootstrap_xml = data.get('bootstrap_xml', '') or ''
+    if not isinstance(bootstrap_xml, str):
+        raise ValueError('bootstrap_xml must be a string')
+
+    return variables, bootstrap_xml, bool(data.get('async', False))
+
+
+def prepare_build_request(service, app_dir, variables, bootstrap_xml=''):
+    """
+    Build the full context for a build request, using the same rendering and Panorama lookups as the workflow
+    :param service: bootstrapper-payload snippet (service) dict
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param variables: variables dict from parse_build_request
+    :param bootstrap_xml: bootstrap.xml document to include, overrides custom_bootstrap
+    :return: tuple of the full context and the blob reference of the bootstrap.xml to include
+    :raises ValueError: if the bootstrap could not be rendered
+    :raises TargetConnectionException: if Panorama could not be reached
+    """
+    bootstrap_ref = ''
+    if bootstrap_xml.strip() != '':
+        bootstrap_ref = upload_utils.store_bootstrap([bytes(bootstrap_xml, 'utf-8')])
+
+    return build_utils.prepare_context(service, app_dir, variables, bootstrap_ref)
+
+
+def submit_build(payload, filename):
+    """
+    Queue a build_archive job. The payload holds credentials, so it is kept in the blob store rather than in the
+    job record
+    :param payload: payload data structure from build_utils.render_payload
+    :param filename: filename to use if the bootstrapper service does not send one
+    :return: job id
+    """
+    payload_ref = blob_utils.put_bytes(bytes(json.dumps(payload), 'utf-8'))
+    digest = archive_cache_utils.get_payload_digest(payload)
+    # jobs are locked by digest, so identical payloads are built once and the second job is served from the cache
+    return job_utils.submit_job('build_archive', 'api', lock_name=f'build_archive-{digest}', payload_ref=payload_ref,
+                                filename=filename, digest=digest, deployment_type=payload.get('archive_type', ''))
+
+
+@job_utils.register_job('build_archive')
+def build_archive(payload_ref, filename, digest, deployment_type):
+    """
+    Background job to request an archive from the bootstrapper service and keep it in the archive cache. The payload
+    blob is removed when the job finishes, identical jobs queued at the same time share it and are served from the
+    cache
+    :param payload_ref: blob reference of the json payload
+    :param filename: filename to use if the bootstrapper service does not send one
+    :param digest: payload digest from archive_cache_utils.get_payload_digest
+    :param deployment_type: archive_type of the payload, for the build metrics
+    :return: tuple of success, message and details with the digest and filename of the cached archive
+    """
+    try:
+        entry = archive_cache_utils.get_cached_archive(digest)
+        if entry is not None:
+            metrics_utils.record_build(deployment_type, 200, 'hit')
+            return True, 'Archive ready', dict(digest=digest, filename=entry['filename'])
+
+        try:
+            payload = json.loads(b''.join(blob_utils.iter_blob(payload_ref)))
+        except FileNotFoundError:
+            return False, 'An identical build queued at the same time has already used this payload, submit it again'
+
+        return _build_archive(payload, filename, digest)
+    finally:
+        blob_utils.remove_blob(payload_ref)
+
+
+def _build_archive(payload, filename, digest):
+    deployment_type = payload.get('archive_type', '')
+
+    try:
+        resp = upstream_utils.post_to_bootstrapper('generate_bootstrap_package', payload, stream=True)
+    except requests.exceptions.RequestException as rex:
+        metrics_utils.record_build(deployment_type, 'error', 'miss')
+        return False, f'Could not contact Bootstrapper Service: {rex}'
+
+    metrics_utils.record_build(deployment_type, resp.status_code, 'miss')
+    content_type = resp.headers.get('Content-Type', '')
+    if resp.status_code != 200 or 'json' in content_type:
+        with resp:
+            if resp.status_code != 200:
+                return False, f'Bootstrapper Service returned {resp.status_code}: {resp.text}'
+
+            # cloud deployment types upload the archive themselves and only return a status message
+            return True, resp.json().get('response', resp.text)
+
+    filename = build_utils.get_archive_filename(resp, filename)
+    chunk_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_CHUNK_SIZE', '65536'))
+    try:
+        for _ in archive_cache_utils.cache_stream(digest, upstream_utils.relay_upstream_content(resp, chunk_size),
+                                                  filename, content_type):
+            pass
+    except requests.exceptions.RequestException as rex:
+        return False, f'Could not download archive: {rex}'
+
+    if archive_cache_utils.get_cached_archive(digest) is None:
+        return False, 'Archive is larger than BOOTSTRAPPER_ARCHIVE_CACHE_MAX_BYTES and could not be kept'
+
+    return True, 'Archive ready', dict(digest=digest, filename=filename)
@@ -0,0 +1,246 @@
+"""
+Content addressed store of archives returned by the bootstrapper service.
+
+Archives are keyed by an HMAC of the final json payload sent to /generate_bootstrap_package, so an identical request
+is served from disk instead of being built again. The payload contains secrets such as auth_key and cloud
+credentials; these are part of the key but are never written to the index, and the HMAC key is local to this
+install so the digest cannot be used to guess them. The store is capped at BOOTSTRAPPER_ARCHIVE_CACHE_MAX_BYTES
+and evicts the least recently used archives first.
+"""
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.http import FileResponse
+from django.http import HttpResponseNotModified
+
+from pan_cnc.lib import cnc_utils
+
+# only archive types are cached, cloud types upload to a bucket as a side effect of every request
+cacheable_types = ('tgz', 'zip', 'iso', 'encoded_tgz')
+
+
+def get_cache_dir():
+    cache_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'archives')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_max_bytes():
+    """
+    Size cap for all cached archives, 0 disables the cache
+    :return: int
+    """
+    return int(cnc_utils.get_config_value('BOOTSTRAPPER_ARCHIVE_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+
+
+def is_cacheable(deployment_type):
+    return deployment_type in cacheable_types and get_max_bytes() > 0
+
+
+@contextmanager
+def _locked_index():
+    """
+    Hold an exclusive lock on the index for the duration of a read - modify - write, across threads and workers
+    :return: path to the index file
+    """
+    cache_dir = get_cache_dir()
+    with open(os.path.join(cache_dir, 'index.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield os.path.join(cache_dir, 'index.json')
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_index(index_path):
+    try:
+        with open(index_path, 'r') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _write_index(index_path, index):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path))
+    with os.fdopen(fd, 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(tmp_path, index_path)
+
+
+def _get_hmac_key():
+    key_path = os.path.join(get_cache_dir(), '.key')
+    if not os.path.exists(key_path):
+        try:
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as key_file:
+                key_file.write(os.urandom(32))
+        except FileExistsError:
+            # another worker created it first
+            pass
+
+    with open(key_path, 'rb') as key_file:
+        return key_file.read()
+
+
+def get_payload_digest(payload):
+    """
+    Compute the cache key for a payload
+    :param payload: data structure that will be sent to the bootstrapper service as json
+    :return: hex digest string
+    """
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hmac.new(_get_hmac_key(), canonical, hashlib.sha256).hexdigest()
+
+
+def _archive_path(digest):
+    return os.path.join(get_cache_dir(), f'{digest}.archive')
+
+
+def get_cached_archive(digest, open_file=False):
+    """
+    Look up an archive and mark it as recently used
+    :param digest: payload digest from get_payload_digest
+    :param open_file: also open the archive while the index is locked, so it can still be read if it is evicted
+                      before it has been sent
+    :return: dict with path, filename, content_type, size and file when open_file is set, or None if not cached
+    """
+    with _locked_index() as index_path:
+        index = _read_index(index_path)
+        entry = index.get(digest, None)
+        if entry is None:
+            return None
+
+        path = _archive_path(digest)
+        if not os.path.exists(path):
+            index.pop(digest)
+            _write_index(index_path, index)
+            return None
+
+        # archives are only evicted under this lock, an open file stays readable after it has been removed
+        archive = open(path, 'rb') if open_file else None
+        entry['last_used'] = time.time()
+        _write_index(index_path, index)
+
+    return dict(entry, path=path, file=archive)
+
+
+def cache_stream(digest, chunks, filename, content_type):
+    """
+    Pass chunks through unchanged while writing them to the store. The archive is only added to the index once
+    every chunk has been consumed, a partial download is discarded
+    :param digest: payload digest from get_payload_digest
+    :param chunks: iterable of bytes, i.e. from upstream_utils.relay_upstream_content
+    :param filename: filename of the archive
+    :param content_type: content type of the archive
+    :return: generator of bytes
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=get_cache_dir(), suffix='.partial')
+    complete = False
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in chunks:
+                tmp_file.write(chunk)
+                size += len(chunk)
+                yield chunk
+        complete = True
+    finally:
+        # make sure the upstream connection is released even if the client went away part way through
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if complete:
+            _add_archive(digest, tmp_path, size, filename, content_type)
+        else:
+            os.unlink(tmp_path)
+
+
+async def spool_async_stream(digest, chunks, filename, content_type):
+    """
+    Write an archive from an async iterator of chunks to disk and add it to the store
+    :param digest: payload digest from get_payload_digest, or None to only spool the archive
+    :param chunks: async iterable of bytes, i.e. from an httpx response
+    :param filename: filename of the archive
+    :param content_type: content type of the archive
+    :return: tuple of an open binary file at the start of the archive and its size. The file stays readable even if
+             the archive is too large to be kept in the store
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=get_cache_dir(), suffix='.partial')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            async for chunk in chunks:
+                tmp_file.write(chunk)
+                size += len(chunk)
+        # opened by descriptor so the file has no path name, the path is renamed or removed below and FileResponse
+        # would otherwise try to read the size of the archive from it
+        archive = os.fdopen(os.open(tmp_path, os.O_RDONLY), 'rb')
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    if digest is None:
+        os.unlink(tmp_path)
+    else:
+        # waits on the index lock, so keep it off the event loop
+        await sync_to_async(_add_archive, thread_sensitive=False)(digest, tmp_path, size, filename, content_type)
+
+    return archive, size
+
+
+def _add_archive(digest, tmp_path, size, filename, content_type):
+    max_bytes = get_max_bytes()
+    if size > max_bytes:
+        os.unlink(tmp_path)
+        return
+
+    with _locked_index() as index_path:
+        os.replace(tmp_path, _archive_path(digest))
+        index = _read_index(index_path)
+        now = time.time()
+        index[digest] = dict(filename=filename, content_type=content_type, size=size, created=now, last_used=now)
+
+        # evict least recently used archives until we are back under the cap
+        total = sum(e['size'] for e in index.values())
+        for old_digest in sorted(index, key=lambda d: index[d]['last_used']):
+            if total <= max_bytes:
+                break
+            total -= index[old_digest]['size']
+            index.pop(old_digest)
+            try:
+                os.unlink(_archive_path(old_digest))
+            except FileNotFoundError:
+                pass
+
+        _write_index(index_path, index)
+
+
+def get_etag(digest):
+    return f'"{digest}"'
+
+
+def cached_archive_response(request, digest, entry):
+    """
+    Serve an archive from the store, or a 304 if the client already has it
+    :param request: django request
+    :param digest: payload digest from get_payload_digest
+    :param entry: dict as returned from get_cached_archive with open_file set
+    :return: FileResponse or HttpResponseNotModified
+    """
+    etag = get_etag(digest)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        entry['file'].close()
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(entry['file'], content_type=entry['content_type'])
+        response['Content-Disposition'] = 'attachment; filename=%s' % entry['filename']
+        response['Content-Length'] = str(entry['size'])
+
+    response['ETag'] = etag
+    return response
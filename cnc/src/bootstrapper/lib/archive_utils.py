@@ -0,0 +1,237 @@
+"""
+Build bootstrap archives inside the cnc app instead of asking the bootstrapper service
+
+Archives use the standard PAN-OS bootstrap layout:
+
+    config/init-cfg.txt
+    config/bootstrap.xml
+    content/
+    license/authcodes
+    software/
+
+and are generated as a stream, so nothing is base64 encoded, sent over the network or held in memory. Deployment
+types listed in BOOTSTRAPPER_LOCAL_ARCHIVE_TYPES (any of tgz, zip and encoded_tgz) are built locally, iso and the
+cloud types always use the bootstrapper service. Content packages are read from the content store, see content_utils.
+"""
+import base64
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+
+from pan_cnc.lib import cnc_utils
+
+from bootstrapper.lib import blob_utils
+
+# deployment types this module knows how to build, mapped to the file extension and content type
+archive_formats = {
+    'tgz': ('tgz', 'application/gzip'),
+    'zip': ('zip', 'application/zip'),
+    'encoded_tgz': ('tgz.b64', 'text/plain'),
+}
+
+bootstrap_dirs = ('config', 'content', 'license', 'software')
+
+chunk_size = 64 * 1024
+
+
+def get_local_archive_types():
+    """
+    Deployment types to build in process, set as a comma separated list in BOOTSTRAPPER_LOCAL_ARCHIVE_TYPES
+    :return: set of deployment types
+    """
+    configured = cnc_utils.get_config_value('BOOTSTRAPPER_LOCAL_ARCHIVE_TYPES', '')
+    return {t.strip() for t in configured.split(',') if t.strip() in archive_formats}
+
+
+def is_local(deployment_type):
+    return deployment_type in get_local_archive_types()
+
+
+def get_archive_filename(deployment_type, hostname):
+    extension = archive_formats[deployment_type][0]
+    return f'{hostname or "bootstrap"}.{extension}'
+
+
+def get_content_type(deployment_type):
+    return archive_formats[deployment_type][1]
+
+
+def _bytes_member(data):
+    return len(data), lambda: iter([data])
+
+
+def _file_member(path):
+    def read_chunks():
+        with open(path, 'rb') as member_file:
+            while True:
+                chunk = member_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    return os.path.getsize(path), read_chunks
+
+
+def get_archive_members(init_cfg, bootstrap_ref='', auth_key='', content_files=None):
+    """
+    List everything that goes into a bootstrap archive
+    :param init_cfg: rendered init-cfg.txt
+    :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+    :param auth_key: license auth code, written to license/authcodes when set
+    :param content_files: paths of content packages to add to content/
+    :return: list of (name, size, chunks) tuples where chunks is a function returning an iterator of bytes, size
+             and chunks are None for directories
+    """
+    members = [(f'{d}/', None, None) for d in bootstrap_dirs]
+    members.append(('config/init-cfg.txt',) + _bytes_member(bytes(init_cfg, 'utf-8')))
+
+    if bootstrap_ref:
+        blob_utils.touch_blob(bootstrap_ref)
+        blob_path = blob_utils.get_blob_path(bootstrap_ref)
+        members.append(('config/bootstrap.xml', os.path.getsize(blob_path),
+                        lambda: blob_utils.iter_blob(bootstrap_ref, chunk_size)))
+
+    if auth_key:
+        members.append(('license/authcodes',) + _bytes_member(bytes(f'{auth_key}\n', 'utf-8')))
+
+    for path in content_files or list():
+        members.append((f'content/{os.path.basename(path)}',) + _file_member(path))
+
+    return members
+
+
+def stream_tgz(members):
+    """
+    Write a gzipped tar archive as a stream of chunks. Headers are built by tarfile and compressed together with
+    the file data, so no member is ever held in memory as a whole
+    :param members: list from get_archive_members
+    :return: generator of bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    now = int(time.time())
+
+    for name, size, chunks in members:
+        info = tarfile.TarInfo(name.rstrip('/'))
+        info.mtime = now
+        if size is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        else:
+            info.size = size
+            info.mode = 0o644
+
+        yield compressor.compress(info.tobuf(format=tarfile.GNU_FORMAT))
+        if size is None:
+            continue
+
+        written = 0
+        for chunk in chunks():
+            written += len(chunk)
+            yield compressor.compress(chunk)
+
+        if written != size:
+            raise ValueError(f'{name} changed size while the archive was being built')
+
+        # tar data is padded to a whole number of blocks
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            yield compressor.compress(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    # two empty blocks mark the end of the archive, padded to the default record size like tarfile does
+    yield compressor.compress(tarfile.NUL * tarfile.RECORDSIZE)
+    yield compressor.flush()
+
+
+class _ChunkSink:
+    """
+    Write only file object that collects what zipfile writes so it can be yielded. Has no tell or seek, which makes
+    zipfile write data descriptors instead of going back to fix up headers
+    """
+
+    def __init__(self):
+        self.chunks = list()
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = list()
+        return data
+
+
+def stream_zip(members):
+    """
+    Write a zip archive as a stream of chunks
+    :param members: list from get_archive_members
+    :return: generator of bytes
+    """
+    sink = _ChunkSink()
+    now = time.localtime()[:6]
+
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, size, chunks in members:
+            info = zipfile.ZipInfo(name, date_time=now)
+            if size is None:
+                info.external_attr = (0o40755 << 16) | 0x10
+                archive.writestr(info, b'')
+                yield sink.drain()
+                continue
+
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, mode='w') as member:
+                for chunk in chunks():
+                    member.write(chunk)
+                    yield sink.drain()
+
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+def stream_base64(chunks):
+    """
+    Base64 encode a stream of chunks without line breaks
+    :param chunks: iterable of bytes
+    :return: generator of bytes
+    """
+    remainder = b''
+    for chunk in chunks:
+        data = remainder + chunk
+        cut = len(data) - len(data) % 3
+        remainder = data[cut:]
+        if cut:
+            yield base64.b64encode(data[:cut])
+
+    if remainder:
+        yield base64.b64encode(remainder)
+
+
+def stream_archive(deployment_type, init_cfg, bootstrap_ref='', auth_key='', content_files=None):
+    """
+    Build a bootstrap archive for one of the locally supported deployment types
+    :param deployment_type: tgz, zip or encoded_tgz
+    :param init_cfg: rendered init-cfg.txt
+    :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+    :param auth_key: license auth code
+    :param content_files: paths of content packages to add to content/
+    :return: generator of bytes
+    """
+    members = get_archive_members(init_cfg, bootstrap_ref, auth_key, content_files)
+    if deployment_type == 'zip':
+        chunks = stream_zip(members)
+    elif deployment_type == 'tgz':
+        chunks = stream_tgz(members)
+    elif deployment_type == 'encoded_tgz':
+        chunks = stream_base64(stream_tgz(members))
+    else:
+        raise ValueError(f'Archive type {deployment_type} can not be built locally')
+
+    return (chunk for chunk in chunks if chunk)
@@ -0,0 +1,82 @@
+"""
+ASGI handlers that read streaming response bodies in a worker thread instead of on the event loop
+
+Django 3.2, the last release for python 3.6, iterates the body of a StreamingHttpResponse or FileResponse on the
+event loop. Reading the next block of a cached archive or fleet zip, compressing the next part of a locally built
+archive or waiting on the bootstrapper service for a relayed one then holds up every other request of the worker.
+These handlers fetch each part of the body with sync_to_async and only send it from the event loop. Responses that
+are not streamed are left to Django.
+
+send_response is a private method of ASGIHandler, so the copy here follows the 3.2 release that requirements.txt
+pins. Under any other release streamed bodies are left to Django as well.
+"""
+import django
+from asgiref.sync import sync_to_async
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.core.handlers.asgi import ASGIHandler
+
+# the django release whose ASGIHandler.send_response is followed below
+supported_django = (3, 2)
+
+
+def _next_part(iterator):
+    # StopIteration can not be raised through a future, so the end of the body is returned as None
+    return next(iterator, None)
+
+
+class OffLoopStreamingMixin:
+    """
+    Send streaming response bodies like ASGIHandler.send_response, but read each part of the body in a thread
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming or django.VERSION[:2] != supported_django:
+            return await super().send_response(response, send)
+
+        # headers and cookies are encoded the same way as in ASGIHandler.send_response
+        response_headers = list()
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            response_headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': response_headers})
+
+        # parts are read one at a time, so the body is still never held in memory as a whole
+        next_part = sync_to_async(_next_part, thread_sensitive=False)
+        parts = iter(response)
+        while True:
+            part = await next_part(parts)
+            if part is None:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+class BootstrapperASGIHandler(OffLoopStreamingMixin, ASGIHandler):
+    pass
+
+
+class BootstrapperStaticFilesHandler(OffLoopStreamingMixin, ASGIStaticFilesHandler):
+    pass
+
+
+def get_asgi_application():
+    """
+    Set up django and return the ASGI application for the cnc app, including its static files as runserver would
+    serve them
+    :return: ASGI application
+    """
+    django.setup(set_prefix=False)
+    if django.VERSION[:2] != supported_django:
+        print(f'Django {django.get_version()} is not supported by asgi_utils, streamed responses are read on the '
+              f'event loop')
+
+    return BootstrapperStaticFilesHandler(BootstrapperASGIHandler())
@@ -0,0 +1,145 @@
+"""
+Content addressed store for large values such as bootstrap.xml that should not live in the workflow session.
+
+The workflow only keeps the sha256 reference returned from put_bytes or put_chunks. The base64 encoding needed by
+the bootstrapper payload is done once, in chunks, when the payload is built. Blobs that have not been used for
+BOOTSTRAPPER_BLOB_MAX_AGE seconds are removed when a blob is stored, at most once every prune_interval seconds.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+from base64 import urlsafe_b64encode
+
+from pan_cnc.lib import cnc_utils
+
+# read size for encoding, a multiple of 3 so each chunk encodes without padding
+encode_chunk_size = 3 * 64 * 1024
+
+# seconds between scans of the blob dir for old blobs in each process
+prune_interval = 3600
+
+_last_prune = 0
+
+
+def get_blob_dir():
+    blob_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'blobs')
+    os.makedirs(blob_dir, exist_ok=True)
+    return blob_dir
+
+
+def get_blob_path(ref):
+    """
+    Resolve a blob reference to a path on disk
+    :param ref: sha256 hex digest as returned from put_bytes
+    :return: path string
+    """
+    if not re.match('^[0-9a-f]{64}$', ref or ''):
+        raise ValueError(f'Invalid blob reference {ref}')
+
+    return os.path.join(get_blob_dir(), ref)
+
+
+def put_chunks(chunks):
+    """
+    Store a value from an iterable of bytes without holding all of it in memory
+    :param chunks: iterable of bytes
+    :return: blob reference
+    """
+    blob_dir = get_blob_dir()
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=blob_dir, suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as blob_file:
+            for chunk in chunks:
+                digest.update(chunk)
+                blob_file.write(chunk)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    ref = digest.hexdigest()
+    # identical content simply replaces the existing blob, which also marks it as recently used
+    os.replace(tmp_path, get_blob_path(ref))
+    if time.time() - _last_prune > prune_interval:
+        prune_blobs()
+    return ref
+
+
+def put_bytes(data):
+    """
+    Store a value
+    :param data: bytes
+    :return: blob reference
+    """
+    return put_chunks([data])
+
+
+def touch_blob(ref):
+    """
+    Mark a blob as recently used, so prune_blobs keeps it for as long as a workflow still refers to it
+    :param ref: blob reference
+    :return: None
+    :raises FileNotFoundError: if the blob has already been removed
+    """
+    os.utime(get_blob_path(ref))
+
+
+def iter_blob(ref, chunk_size=64 * 1024):
+    """
+    Read a blob back in chunks
+    :param ref: blob reference
+    :param chunk_size: max size of each chunk
+    :return: generator of bytes
+    :raises FileNotFoundError: if the blob has been removed
+    """
+    touch_blob(ref)
+    with open(get_blob_path(ref), 'rb') as blob_file:
+        while True:
+            chunk = blob_file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def encode_blob(ref):
+    """
+    urlsafe base64 encode a blob for the bootstrapper payload, reading it in chunks
+    :param ref: blob reference
+    :return: encoded string
+    :raises FileNotFoundError: if the blob has been removed
+    """
+    return ''.join(urlsafe_b64encode(chunk).decode('utf-8') for chunk in iter_blob(ref, encode_chunk_size))
+
+
+def remove_blob(ref):
+    """
+    Remove a blob as soon as it is no longer needed, for values that should not wait for prune_blobs
+    :param ref: blob reference
+    :return: None
+    """
+    try:
+        os.unlink(get_blob_path(ref))
+    except FileNotFoundError:
+        pass
+
+
+def prune_blobs():
+    """
+    Remove blobs that have not been stored or used recently
+    :return: None
+    """
+    global _last_prune
+
+    _last_prune = time.time()
+    max_age = int(cnc_utils.get_config_value('BOOTSTRAPPER_BLOB_MAX_AGE', str(7 * 86400)))
+    cutoff = time.time() - max_age
+    blob_dir = get_blob_dir()
+    for file_name in os.listdir(blob_dir):
+        path = os.path.join(blob_dir, file_name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
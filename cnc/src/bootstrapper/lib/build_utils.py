@@ -0,0 +1,242 @@
+"""
+Helpers to compile bootstrapper-payload snippets and request archives from the bootstrapper service outside of the
+step by step workflow views
+"""
+import json
+from base64 import urlsafe_b64encode
+
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import blob_utils
+from bootstrapper.lib import content_utils
+from bootstrapper.lib import panorama_utils
+from bootstrapper.lib import snippet_index_utils
+from bootstrapper.lib import template_utils
+
+payload_snippet_name = 'bootstrapper-payload'
+
+# the default bootstrap.xml, offered on the choose bootstrap page as well as the panos_full templates
+default_bootstrap_name = 'bootstrap_xml'
+
+# other choices on the choose bootstrap page, templates with these names are never offered or rendered
+reserved_bootstrap_names = ('upload', 'default')
+
+
+def load_payload_service(app_dir):
+    """
+    Load the bootstrapper-payload snippet that defines all variables needed to build an archive
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :return: snippet (service) dict
+    """
+    service = template_utils.load_app_snippet(payload_snippet_name)
+    if service is None:
+        raise ValueError(f'Could not load {payload_snippet_name} snippet')
+
+    return service
+
+
+def get_default_context(service):
+    """
+    Build a context from the default value of every variable defined in the snippet
+    :param service: snippet (service) dict
+    :return: dict of variable name to default value
+    """
+    context = dict()
+    for variable in service.get('variables', []):
+        default = variable.get('default', '')
+        if default is None:
+            default = ''
+        elif isinstance(default, bool):
+            # unquoted yes / no defaults are parsed as booleans, but the dropdown values are the strings
+            default = 'yes' if default else 'no'
+        context[variable['name']] = default
+
+    return context
+
+
+def get_bootstrap_templates():
+    """
+    Find the bootstrap.xml templates that may be chosen, every snippet labelled as a full panos configuration except
+    those named like one of the other choices
+    :return: list of dicts with name, label, repo and meta_path keys
+    """
+    bs_templates = snippet_index_utils.get_snippets_by_label('template_category', 'panos_full')
+    return [bst for bst in bs_templates if bst['name'] not in reserved_bootstrap_names]
+
+
+def render_bootstrap(template_name, app_dir, context):
+    """
+    Render a bootstrap.xml template snippet and keep the result in the blob store. Only the templates offered on the
+    choose bootstrap page can be rendered, never any other snippet
+    :param template_name: default_bootstrap_name or the name of a template from get_bootstrap_templates
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param context: variables to render the template with
+    :return: blob reference of the rendered bootstrap.xml
+    :raises ValueError: if the template is not one of the offered templates or could not be rendered
+    """
+    if template_name == default_bootstrap_name:
+        service = template_utils.load_app_snippet(default_bootstrap_name)
+    else:
+        meta_paths = {bst['name']: bst['meta_path'] for bst in get_bootstrap_templates()}
+        if template_name not in meta_paths:
+            raise ValueError(f'Unknown bootstrap template {template_name}')
+        # load the labelled snippet itself, another repository may have a snippet of the same name
+        service = template_utils.load_snippet_metadata(meta_paths[template_name])
+
+    if service is None:
+        raise ValueError(f'Could not load bootstrap template {template_name}')
+
+    template_context = get_default_context(service)
+    template_context.update(context)
+
+    # special case to hide FW_NAME field from iron-skillet
+    if 'hostname' in template_context and 'FW_NAME' in template_context:
+        template_context['FW_NAME'] = template_context['hostname']
+
+    bs = template_utils.render_snippet_template(service, template_context)
+    if bs is None:
+        raise ValueError(f'Could not render bootstrap template {template_name}')
+
+    return blob_utils.put_bytes(bytes(bs, 'utf-8'))
+
+
+def get_payload_context(context):
+    """
+    Copy of the device context with the values init-cfg.txt and the payload expect
+    :param context: all variables for this device
+    :return: dict
+    """
+    payload_context = dict(context)
+
+    if 'panorama_ip' not in payload_context and 'TARGET_IP' in payload_context:
+        payload_context['panorama_ip'] = payload_context['TARGET_IP']
+
+    return payload_context
+
+
+def render_init_cfg(service, context):
+    """
+    Compile init-cfg.txt for a single device
+    :param service: bootstrapper-payload snippet (service) dict
+    :param context: all variables for this device
+    :return: init-cfg.txt string
+    """
+    ic = template_utils.render_snippet_template(service, get_payload_context(context), 'init_cfg.txt')
+    if ic is None:
+        raise ValueError('Could not compile init-cfg.txt')
+
+    return ic
+
+
+def get_dynamic_content_error(deployment_type):
+    """
+    Explain why dynamic content can not be added to an archive of this deployment type
+    :param deployment_type: deployment type of the build
+    :return: message string
+    """
+    local_types = ', '.join(sorted(archive_utils.get_local_archive_types())) or 'none'
+    return (f'Dynamic content can not be included in {deployment_type} archives built by the bootstrapper service, '
+            f'only in archives built locally. BOOTSTRAPPER_LOCAL_ARCHIVE_TYPES: {local_types}')
+
+
+def render_payload(service, app_dir, context, bootstrap_ref=''):
+    """
+    Compile init-cfg.txt and the json payload for the /generate_bootstrap_package endpoint. The encoded init-cfg.txt
+    and bootstrap.xml are added to the payload after it has been rendered, so large configs are never passed through
+    the template or the json parser
+    :param service: bootstrapper-payload snippet (service) dict
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param context: all variables for this device
+    :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+    :return: payload data structure ready to be sent as json
+    :raises ValueError: if the payload could not be compiled, or dynamic content is requested
+    :raises FileNotFoundError: if the bootstrap.xml blob has been pruned
+    """
+    # the bootstrapper service has no access to the content store, only archives built locally include content
+    if context.get('include_dynamic_content', 'no') == 'yes':
+        raise ValueError(get_dynamic_content_error(context.get('deployment_type', '')))
+
+    ic = render_init_cfg(service, context)
+
+    payload_context = get_payload_context(context)
+    payload_context['init_cfg_string'] = ''
+    payload_context['bootstrap_string'] = ''
+
+    payload = template_utils.render_snippet_template(service, payload_context, 'payload.j2')
+    if payload is None:
+        raise ValueError('Could not compile bootstrapper payload')
+
+    try:
+        json_payload = json.loads(payload)
+    except json.decoder.JSONDecodeError as je:
+        raise ValueError(f'Could not encode payload! {je}')
+
+    json_payload['init_cfg_str'] = urlsafe_b64encode(bytes(ic, 'utf-8')).decode('utf-8')
+    json_payload['bootstrap_str'] = blob_utils.encode_blob(bootstrap_ref) if bootstrap_ref else ''
+    return json_payload
+
+
+def stream_local_archive(service, context, bootstrap_ref=''):
+    """
+    Build the archive for a single device in process, for deployment types enabled in
+    BOOTSTRAPPER_LOCAL_ARCHIVE_TYPES. init-cfg.txt and bootstrap.xml go straight into the archive without being
+    encoded into a payload
+    :param service: bootstrapper-payload snippet (service) dict
+    :param context: all variables for this device
+    :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+    :return: tuple of filename, content type and a generator of archive bytes
+    :raises FileNotFoundError: if the bootstrap.xml blob has been pruned
+    """
+    deployment_type = context.get('deployment_type', '')
+    ic = render_init_cfg(service, context)
+
+    content_files = list()
+    if context.get('include_dynamic_content', 'no') == 'yes':
+        content_files = content_utils.get_archive_content()
+
+    chunks = archive_utils.stream_archive(deployment_type, ic, bootstrap_ref, context.get('auth_key', ''),
+                                          content_files)
+    filename = archive_utils.get_archive_filename(deployment_type, context.get('hostname', ''))
+    return filename, archive_utils.get_content_type(deployment_type), chunks
+
+
+def prepare_context(service, app_dir, variables, bootstrap_ref=''):
+    """
+    Build the full context for a single device from a dict of variables, as used by fleet mode and the json api. Any
+    variable not given uses its default, a vm auth key is fetched from Panorama when needed, and the template named in
+    custom_bootstrap is rendered unless a bootstrap_ref is already given
+    :param service: bootstrapper-payload snippet (service) dict
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param variables: dict of variables for this device
+    :param bootstrap_ref: blob reference of a bootstrap.xml to include, if any
+    :return: tuple of the full context and the blob reference of the bootstrap.xml to include
+    """
+    context = get_default_context(service)
+    context.update(variables)
+
+    # fetch a vm auth key unless one is supplied, devices on the same panorama share the cached key
+    if context.get('include_panorama', 'no') == 'yes' and variables.get('vm_auth_key', '') == '' \
+            and context.get('panorama_password', '') != '':
+        vm_auth_key = panorama_utils.get_vm_auth_key(context['panorama_ip'], context.get('panorama_user', ''),
+                                                     context['panorama_password'])
+        if vm_auth_key is None:
+            raise ValueError('Could not get VM Auth key from Panorama')
+        context['vm_auth_key'] = vm_auth_key
+
+    custom_bootstrap = context.get('custom_bootstrap', '')
+    if not bootstrap_ref and custom_bootstrap not in ('', 'none'):
+        bootstrap_ref = render_bootstrap(custom_bootstrap, app_dir, context)
+
+    return context, bootstrap_ref
+
+
+def get_archive_filename(resp, default_name):
+    """
+    Determine the filename of the archive returned by the bootstrapper service
+    :param resp: requests Response object
+    :param default_name: name to use when the service does not send a Content-Disposition header
+    :return: filename string
+    """
+    if 'Content-Disposition' in resp.headers:
+        return resp.headers['Content-Disposition'].split('=')[1].strip('"')
+
+    return default_name
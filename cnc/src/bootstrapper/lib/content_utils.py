@@ -0,0 +1,301 @@
+"""
+Store of dynamic content packages (App / Threat, Antivirus, WildFire) that can be added to bootstrap archives
+
+Packages live in BOOTSTRAPPER_CONTENT_DIR, which docker-compose shares with the bootstrapper and content_downloader
+containers as content_updates. An index.json in that directory records the type, version, size and sha256 of every
+package, so a package is only hashed once and a download with a known checksum is skipped when the package is
+already in the store. Downloads are streamed to a .partial file and resumed with a Range request if the connection
+drops. Only one process at a time downloads a given file, others wait for it and then use the stored package. Archives reference packages by path, so a fleet build reads the same files for every firewall.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+import requests
+
+from pan_cnc.lib import cnc_utils
+
+index_name = 'index.json'
+
+# file name patterns of the packages published on the update server, as used by the content_downloader snippet
+package_patterns = {
+    'appthreat': re.compile(r'^panupv2-all-contents-(\d+)-(\d+)'),
+    'app': re.compile(r'^panupv2-all-apps-(\d+)-(\d+)'),
+    'antivirus': re.compile(r'^panup-all-antivirus-(\d+)-(\d+)'),
+    'wildfire2': re.compile(r'^panupv3-all-wildfire-(\d+)-(\d+)'),
+}
+
+_index_lock = threading.Lock()
+_index_cache = dict()
+
+
+def get_content_dir():
+    default_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'content_updates')
+    content_dir = cnc_utils.get_config_value('BOOTSTRAPPER_CONTENT_DIR', default_dir)
+    os.makedirs(content_dir, exist_ok=True)
+    return content_dir
+
+
+def get_archive_package_types():
+    """
+    Package types added to archives when include_dynamic_content is yes, set as a comma separated list in
+    BOOTSTRAPPER_CONTENT_PACKAGES
+    :return: list of package types
+    """
+    configured = cnc_utils.get_config_value('BOOTSTRAPPER_CONTENT_PACKAGES', 'appthreat,antivirus')
+    return [t.strip() for t in configured.split(',') if t.strip() in package_patterns]
+
+
+def parse_package_name(file_name):
+    """
+    Determine the type and version of a content package from its file name
+    :param file_name: i.e. panupv2-all-contents-8213-5678
+    :return: tuple of package type and version string, or None if this is not a content package
+    """
+    for package_type, pattern in package_patterns.items():
+        match = pattern.match(file_name)
+        if match is not None:
+            return package_type, f'{match.group(1)}-{match.group(2)}'
+
+    return None
+
+
+def _version_key(version):
+    return tuple(int(part) for part in version.split('-'))
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as package_file:
+        for chunk in iter(lambda: package_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest
+
+
+def _load_index(content_dir):
+    index_path = os.path.join(content_dir, index_name)
+    try:
+        mtime = os.path.getmtime(index_path)
+    except OSError:
+        return dict()
+
+    cached = _index_cache.get(content_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError) as e:
+        print(f'Could not read content index, rebuilding: {e}')
+        return dict()
+
+    _index_cache[content_dir] = (mtime, index)
+    return index
+
+
+def _save_index(content_dir, index):
+    fd, tmp_path = tempfile.mkstemp(dir=content_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, os.path.join(content_dir, index_name))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    _index_cache.pop(content_dir, None)
+
+
+def scan_content(content_dir=None):
+    """
+    Bring the index up to date with the packages on disk. Only packages that are new or have changed size or
+    modification time are hashed
+    :param content_dir: directory to scan, defaults to get_content_dir()
+    :return: index dict of file name to dict with package, version, size, mtime and sha256
+    """
+    if content_dir is None:
+        content_dir = get_content_dir()
+
+    with _index_lock:
+        index = _load_index(content_dir)
+        updated = dict()
+
+        for file_name in sorted(os.listdir(content_dir)):
+            parsed = parse_package_name(file_name)
+            path = os.path.join(content_dir, file_name)
+            if parsed is None or file_name.endswith('.partial') or not os.path.isfile(path):
+                continue
+
+            stat = os.stat(path)
+            entry = index.get(file_name)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == int(stat.st_mtime):
+                updated[file_name] = entry
+                continue
+
+            print(f'Indexing content package {file_name}')
+            updated[file_name] = dict(package=parsed[0], version=parsed[1], size=stat.st_size,
+                                      mtime=int(stat.st_mtime), sha256=_hash_file(path).hexdigest())
+
+        if updated != index:
+            _save_index(content_dir, updated)
+
+        return updated
+
+
+def find_package(package_type, version=None, content_dir=None):
+    """
+    Find a package in the store
+    :param package_type: one of package_patterns, i.e. appthreat
+    :param version: version to look for, defaults to the latest one
+    :param content_dir: store directory, defaults to get_content_dir()
+    :return: dict with name, path, package, version, size and sha256 or None
+    """
+    if content_dir is None:
+        content_dir = get_content_dir()
+
+    index = scan_content(content_dir)
+    candidates = [(name, entry) for name, entry in index.items() if entry['package'] == package_type
+                  and (version is None or entry['version'] == version)]
+    if not candidates:
+        return None
+
+    name, entry = max(candidates, key=lambda c: _version_key(c[1]['version']))
+    return dict(entry, name=name, path=os.path.join(content_dir, name))
+
+
+def find_by_checksum(sha256, content_dir=None):
+    if content_dir is None:
+        content_dir = get_content_dir()
+
+    for name, entry in scan_content(content_dir).items():
+        if entry['sha256'] == sha256.lower():
+            return dict(entry, name=name, path=os.path.join(content_dir, name))
+
+    return None
+
+
+def get_archive_content(package_types=None, content_dir=None):
+    """
+    Select the packages to add to the content/ directory of an archive, the latest of each type
+    :param package_types: list of package types, defaults to get_archive_package_types()
+    :param content_dir: store directory, defaults to get_content_dir()
+    :return: list of paths
+    """
+    if package_types is None:
+        package_types = get_archive_package_types()
+
+    paths = list()
+    for package_type in package_types:
+        package = find_package(package_type, content_dir=content_dir)
+        if package is None:
+            print(f'No {package_type} content package in the content store')
+            continue
+        paths.append(package['path'])
+
+    return paths
+
+
+def download_package(url, sha256=None, file_name=None, content_dir=None, session=None):
+    """
+    Download a content package into the store. Nothing is downloaded when a package with the expected checksum is
+    already stored. Interrupted downloads continue from the .partial file with a Range request, here or on the next
+    call
+    :param url: url of the package
+    :param sha256: expected sha256 hex digest, if known
+    :param file_name: name to store the package under, defaults to the last part of the url
+    :param content_dir: store directory, defaults to get_content_dir()
+    :param session: requests Session to use
+    :return: package dict as returned from find_package
+    :raises ValueError: if the download does not match the expected checksum or is not a content package
+    :raises requests.exceptions.RequestException: if the download still fails after BOOTSTRAPPER_CONTENT_RETRIES
+    """
+    if content_dir is None:
+        content_dir = get_content_dir()
+
+    if sha256 is not None:
+        existing = find_by_checksum(sha256, content_dir)
+        if existing is not None:
+            print(f'Content package {existing["name"]} is already stored')
+            return existing
+
+    if file_name is None:
+        file_name = unquote(os.path.basename(urlparse(url).path))
+
+    if parse_package_name(file_name) is None or os.path.basename(file_name) != file_name:
+        raise ValueError(f'{file_name} is not a content package')
+
+    if session is None:
+        session = requests.Session()
+
+    with _download_lock(content_dir, file_name):
+        # another process may have finished this download while we waited
+        if sha256 is not None:
+            existing = find_by_checksum(sha256, content_dir)
+            if existing is not None:
+                print(f'Content package {existing["name"]} is already stored')
+                return existing
+
+        retries = int(cnc_utils.get_config_value('BOOTSTRAPPER_CONTENT_RETRIES', '3'))
+        partial_path = os.path.join(content_dir, f'{file_name}.partial')
+        for attempt in range(retries + 1):
+            try:
+                _fetch_to_partial(session, url, partial_path)
+                break
+            except requests.exceptions.RequestException as rex:
+                if attempt == retries:
+                    raise
+                print(f'Download of {file_name} interrupted, resuming: {rex}')
+
+        if sha256 is not None and _hash_file(partial_path).hexdigest() != sha256.lower():
+            os.unlink(partial_path)
+            raise ValueError(f'Checksum of {file_name} does not match {sha256}')
+
+        os.replace(partial_path, os.path.join(content_dir, file_name))
+
+    return find_package(*parse_package_name(file_name), content_dir=content_dir)
+
+
+@contextmanager
+def _download_lock(content_dir, file_name):
+    """
+    Hold an exclusive lock on one file name in the store, so concurrent downloads never write the same .partial
+    file. The lock file starts with a dot so it is never taken for a package
+    """
+    with open(os.path.join(content_dir, f'.{file_name}.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _fetch_to_partial(session, url, partial_path):
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else dict()
+
+    with session.get(url, headers=headers, stream=True, timeout=(10, 60)) as resp:
+        if resp.status_code == 416:
+            # nothing left to fetch, the partial file already holds the whole package
+            return
+
+        resp.raise_for_status()
+        # a server that ignores Range sends the whole package again
+        if resp.status_code != 206:
+            offset = 0
+
+        with open(partial_path, 'ab' if offset else 'wb') as partial_file:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                partial_file.write(chunk)
+
+        if 'Content-Length' in resp.headers and 'Content-Encoding' not in resp.headers:
+            if os.path.getsize(partial_path) < offset + int(resp.headers['Content-Length']):
+                raise requests.exceptions.ConnectionError(f'Connection closed before the end of {url}')
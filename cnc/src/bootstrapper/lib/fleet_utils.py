@@ -0,0 +1,359 @@
+"""
+Fleet mode - build bootstrap archives for many devices from a single inventory file
+
+An inventory is a CSV file with one row per device, or a YAML file with a list of devices, where each column / key is
+a bootstrapper-payload variable such as hostname, ipv4_mgmt_address or auth_key. YAML inventories may also define a
+'defaults' dict that applies to every device. The optional 'custom_bootstrap' column names a bootstrap template to
+render for that device.
+
+Each device is rendered and sent to the bootstrapper service from a bounded pool of worker threads. Archives are
+spooled to disk as they arrive and collected into a single zip file along with a per-device status report. Fleets
+uploaded in the web ui are built by a build_fleet background job and downloaded once it has finished.
+"""
+import csv
+import io
+import os
+import re
+import tempfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+import requests
+import yaml
+
+from pan_cnc.lib import cnc_utils
+from pan_cnc.lib.exceptions import TargetConnectionException
+
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import blob_utils
+from bootstrapper.lib import build_utils
+from bootstrapper.lib import job_utils
+from bootstrapper.lib import metrics_utils
+from bootstrapper.lib import upstream_utils
+
+report_name = 'status.csv'
+report_fields = ['hostname', 'deployment_type', 'status', 'http_status', 'filename', 'message', 'elapsed']
+
+
+def load_inventory(inventory_file, file_name=''):
+    """
+    Parse an inventory file into a list of per-device variable dicts
+    :param inventory_file: file like object opened in binary or text mode
+    :param file_name: name of the file, used to determine the format. Anything not ending in .yaml or .yml is CSV
+    :return: list of dicts
+    """
+    try:
+        contents = inventory_file.read()
+        if isinstance(contents, bytes):
+            contents = contents.decode('utf-8-sig')
+
+        if file_name.lower().endswith(('.yaml', '.yml')):
+            return _load_yaml_inventory(contents)
+
+        return _load_csv_inventory(contents)
+
+    except (UnicodeDecodeError, yaml.YAMLError, csv.Error) as e:
+        raise ValueError(f'Could not parse inventory: {e}')
+
+
+def _load_yaml_inventory(contents):
+    data = yaml.safe_load(contents)
+    defaults = dict()
+    if isinstance(data, dict):
+        defaults = data.get('defaults', dict()) or dict()
+        data = data.get('devices', list())
+
+    if not isinstance(data, list):
+        raise ValueError('YAML inventory must be a list of devices or contain a devices key')
+
+    devices = list()
+    for device in data:
+        if not isinstance(device, dict):
+            raise ValueError('Each device in the YAML inventory must be a dict of variables')
+        row = dict(defaults)
+        row.update(device)
+        devices.append({k: _yaml_value_to_str(v) for k, v in row.items()})
+
+    return devices
+
+
+def _yaml_value_to_str(value):
+    # unquoted yes / no are parsed as booleans by YAML, but the payload dropdowns expect the original strings
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'yes' if value else 'no'
+    return str(value)
+
+
+def _load_csv_inventory(contents):
+    reader = csv.DictReader(io.StringIO(contents))
+    devices = list()
+    for row in reader:
+        # skip blank cells so the snippet defaults apply
+        devices.append({k.strip(): v.strip() for k, v in row.items() if k is not None and v is not None and v != ''})
+
+    return devices
+
+
+def get_worker_count():
+    """
+    Number of concurrent requests to send to the bootstrapper service, never more than the connection pool size
+    :return: int
+    """
+    pool_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_POOL_SIZE', '10'))
+    workers = int(cnc_utils.get_config_value('BOOTSTRAPPER_FLEET_WORKERS', str(pool_size)))
+    return max(1, min(workers, pool_size))
+
+
+def build_device_archive(service, app_dir, device, spool_dir):
+    """
+    Render the payload for a single device and spool the resulting archive to disk
+    :param service: bootstrapper-payload snippet (service) dict
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param device: dict of variables from the inventory
+    :param spool_dir: directory to write the archive into
+    :return: result dict with report_fields plus 'path' to the spooled archive when successful
+    """
+    start = time.time()
+    hostname = device.get('hostname', '')
+
+    result = dict(hostname=hostname, deployment_type=device.get('deployment_type', ''), status='error',
+                  http_status='', filename='', message='', path=None)
+
+    try:
+        context, bootstrap_ref = build_utils.prepare_context(service, app_dir, device)
+        result['deployment_type'] = context.get('deployment_type', '')
+        hostname = context.get('hostname', '')
+        if archive_utils.is_local(result['deployment_type']):
+            return _build_local_archive(service, context, bootstrap_ref, spool_dir, result, start)
+
+        payload = build_utils.render_payload(service, app_dir, context, bootstrap_ref)
+        resp = upstream_utils.post_to_bootstrapper('generate_bootstrap_package', payload, stream=True)
+    except (ValueError, TargetConnectionException, requests.exceptions.RequestException) as e:
+        if isinstance(e, requests.exceptions.RequestException):
+            metrics_utils.record_build(result['deployment_type'], 'error')
+        result['message'] = str(e)
+        result['elapsed'] = '%.3f' % (time.time() - start)
+        return result
+
+    metrics_utils.record_build(result['deployment_type'], resp.status_code)
+    with resp:
+        result['http_status'] = str(resp.status_code)
+        content_type = resp.headers.get('Content-Type', '')
+
+        if resp.status_code != 200:
+            result['message'] = resp.text
+        elif 'json' in content_type:
+            # cloud deployment types upload the archive themselves and only return a status message
+            try:
+                result['message'] = resp.json().get('response', resp.text)
+                result['status'] = 'success'
+            except (ValueError, AttributeError):
+                result['message'] = f'Bootstrapper Service returned an invalid response: {resp.text}'
+        else:
+            result['filename'] = build_utils.get_archive_filename(resp, hostname)
+            chunk_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_CHUNK_SIZE', '65536'))
+            fd, spool_path = tempfile.mkstemp(dir=spool_dir)
+            try:
+                with os.fdopen(fd, 'wb') as spool_file:
+                    for chunk in resp.iter_content(chunk_size=chunk_size):
+                        spool_file.write(chunk)
+            except (OSError, requests.exceptions.RequestException) as e:
+                os.unlink(spool_path)
+                result['message'] = f'Could not download archive: {e}'
+            else:
+                result['status'] = 'success'
+                result['path'] = spool_path
+
+    result['elapsed'] = '%.3f' % (time.time() - start)
+    return result
+
+
+def _build_local_archive(service, context, bootstrap_ref, spool_dir, result, start):
+    filename, _, chunks = build_utils.stream_local_archive(service, context, bootstrap_ref)
+    fd, spool_path = tempfile.mkstemp(dir=spool_dir)
+    try:
+        with os.fdopen(fd, 'wb') as spool_file:
+            for chunk in chunks:
+                spool_file.write(chunk)
+    except OSError as oe:
+        os.unlink(spool_path)
+        metrics_utils.record_build(result['deployment_type'], 'error', 'local')
+        result['message'] = f'Could not write archive: {oe}'
+    else:
+        metrics_utils.record_build(result['deployment_type'], 200, 'local')
+        result['status'] = 'success'
+        result['filename'] = filename
+        result['path'] = spool_path
+
+    result['elapsed'] = '%.3f' % (time.time() - start)
+    return result
+
+
+def get_dir_names(devices):
+    """
+    Pick a unique zip directory for each device in inventory order, so the zip layout does not depend on timing.
+    Hostnames are reduced to safe characters, and a duplicate gets the first free numbered suffix that is not also
+    the hostname of another device
+    :param devices: list of variable dicts as returned from load_inventory
+    :return: list of directory names
+    """
+    base_names = list()
+    for index, device in enumerate(devices):
+        base_name = re.sub(r'[^A-Za-z0-9_.-]', '_', device.get('hostname', '')).strip('.')
+        base_names.append(base_name or f'device-{index + 1}')
+
+    taken = set(base_names)
+    used = set()
+    dir_names = list()
+    for base_name in base_names:
+        dir_name = base_name
+        suffix = 1
+        while dir_name in used or (dir_name != base_name and dir_name in taken):
+            suffix += 1
+            dir_name = f'{base_name}-{suffix}'
+        used.add(dir_name)
+        dir_names.append(dir_name)
+
+    return dir_names
+
+
+def build_fleet(devices, app_dir, output_file, workers=None):
+    """
+    Build archives for every device and write them all into a single zip file. Each archive is stored under a
+    directory named after the device hostname, and a status report is added as status.csv
+    :param devices: list of variable dicts as returned from load_inventory
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param output_file: path or binary file object to write the zip into
+    :param workers: max number of concurrent builds, defaults to get_worker_count()
+    :return: list of result dicts, one per device in inventory order
+    """
+    service = build_utils.load_payload_service(app_dir)
+    if workers is None:
+        workers = get_worker_count()
+
+    results = [None] * len(devices)
+
+    dir_names = get_dir_names(devices)
+
+    with tempfile.TemporaryDirectory(prefix='fleet-') as spool_dir, \
+            zipfile.ZipFile(output_file, 'w', zipfile.ZIP_STORED, allowZip64=True) as fleet_zip, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+
+        futures = dict()
+        for index, device in enumerate(devices):
+            future = executor.submit(build_device_archive, service, app_dir, device, spool_dir)
+            futures[future] = index
+
+        # archives are added to the zip from this thread only, as soon as each one is ready
+        for future in as_completed(futures):
+            index = futures[future]
+            result = future.result()
+            spool_path = result.pop('path')
+
+            if spool_path is not None:
+                fleet_zip.write(spool_path, f'{dir_names[index]}/{result["filename"]}')
+                os.unlink(spool_path)
+
+            print(f'{result["hostname"]}: {result["status"]} {result["message"]}')
+            results[index] = result
+
+        report = io.StringIO()
+        writer = csv.DictWriter(report, fieldnames=report_fields)
+        writer.writeheader()
+        writer.writerows(results)
+        fleet_zip.writestr(report_name, report.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+
+    return results
+
+
+def get_fleet_dir():
+    fleet_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'fleets')
+    os.makedirs(fleet_dir, exist_ok=True)
+    return fleet_dir
+
+
+def get_fleet_path(fleet_id):
+    """
+    Path of the zip file built by a build_fleet job
+    :param fleet_id: uuid passed to the job as fleet_id
+    :return: path string
+    """
+    return os.path.join(get_fleet_dir(), f'{uuid.UUID(fleet_id)}.zip')
+
+
+def prune_fleets():
+    # finished fleets are kept as long as their job record
+    cutoff = time.time() - job_utils.job_retention
+    for file_name in os.listdir(get_fleet_dir()):
+        path = os.path.join(get_fleet_dir(), file_name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def submit_fleet(inventory_file, file_name):
+    """
+    Check an inventory and queue a build_fleet job for it. The inventory can hold auth codes and credentials, so it
+    is kept in the blob store until the job has read it rather than in the job record
+    :param inventory_file: uploaded file
+    :param file_name: name of the uploaded file, used to determine the format
+    :return: tuple of job id and number of devices
+    :raises ValueError: if the inventory can not be parsed or has no devices
+    """
+    inventory_ref = blob_utils.put_chunks(inventory_file.chunks())
+    try:
+        with open(blob_utils.get_blob_path(inventory_ref), 'rb') as stored:
+            devices = load_inventory(stored, file_name)
+        if not devices:
+            raise ValueError('No devices found in inventory file')
+    except ValueError:
+        blob_utils.remove_blob(inventory_ref)
+        raise
+
+    fleet_id = str(uuid.uuid4())
+    # fleets are built one at a time, each one already uses every connection to the bootstrapper service
+    job_id = job_utils.submit_job('build_fleet', 'fleet', lock_name='build_fleet', inventory_ref=inventory_ref,
+                                  file_name=file_name, fleet_id=fleet_id)
+    return job_id, len(devices)
+
+
+@job_utils.register_job('build_fleet')
+def build_fleet_job(inventory_ref, file_name, fleet_id):
+    """
+    Background job to build a fleet into a zip file under the fleets dir
+    :param inventory_ref: blob reference of the uploaded inventory, removed once it has been read
+    :param file_name: name of the uploaded inventory file
+    :param fleet_id: uuid to name the zip file after, see get_fleet_path
+    :return: tuple of success, message and details with the fleet_id and counts
+    """
+    try:
+        with open(blob_utils.get_blob_path(inventory_ref), 'rb') as stored:
+            devices = load_inventory(stored, file_name)
+    except (OSError, ValueError) as e:
+        return False, f'Could not load inventory: {e}'
+    finally:
+        blob_utils.remove_blob(inventory_ref)
+
+    prune_fleets()
+    fleet_path = get_fleet_path(fleet_id)
+    partial_path = f'{fleet_path}.partial'
+    print(f'Building fleet of {len(devices)} devices')
+    try:
+        results = build_fleet(devices, 'bootstrapper', partial_path)
+    except (OSError, ValueError) as e:
+        if os.path.exists(partial_path):
+            os.unlink(partial_path)
+        return False, f'Could not build fleet: {e}'
+
+    os.replace(partial_path, fleet_path)
+    failed = len([r for r in results if r['status'] != 'success'])
+    message = f'Built {len(results) - failed} of {len(results)} archives'
+    print(f'Fleet build complete with {failed} failures')
+    return True, message, dict(fleet_id=fleet_id, built=len(results) - failed, failed=failed)
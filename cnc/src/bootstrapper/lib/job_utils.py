@@ -0,0 +1,294 @@
+"""
+Background jobs for long running repository operations such as clone and update.
+
+Jobs are run by celery when BOOTSTRAPPER_JOB_BROKER is set to a broker url, i.e. redis://redis:6379/0, or by a
+small pool of threads inside the web process when it is left at the default of 'local', so no external queue is
+required. Job state is kept as json files under ~/.pan_cnc/bootstrapper/jobs so it can be read from any worker.
+Operations on the same repository are serialized by a per-repository file lock, other jobs name their own lock.
+"""
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from pan_cnc.lib import cnc_utils
+
+# registered job functions by name, each is called with its kwargs and returns a (success, message) tuple, or a
+# (success, message, details) tuple where details is a json serializable dict kept with the job
+job_functions = dict()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# finished jobs are forgotten after this many seconds
+job_retention = 86400
+
+# seconds between touches of the job file while a job is running, see _check_stale
+heartbeat_interval = 30
+
+
+def register_job(name):
+    """
+    Decorator to make a function available to run as a background job
+    :param name: name used to submit the job
+    """
+
+    def decorator(func):
+        job_functions[name] = func
+        return func
+
+    return decorator
+
+
+def get_broker():
+    return cnc_utils.get_config_value('BOOTSTRAPPER_JOB_BROKER', 'local')
+
+
+def _get_dir(name):
+    job_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', name)
+    os.makedirs(job_dir, exist_ok=True)
+    return job_dir
+
+
+def _job_path(job_id):
+    return os.path.join(_get_dir('jobs'), f'{job_id}.json')
+
+
+def _save_job(job):
+    job['updated'] = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=_get_dir('jobs'))
+    with os.fdopen(fd, 'w') as job_file:
+        json.dump(job, job_file)
+    os.replace(tmp_path, _job_path(job['id']))
+
+
+def get_job(job_id):
+    """
+    Load the current state of a job
+    :param job_id: id returned from submit_job
+    :return: job dict or None if not found
+    """
+    # job ids are always uuids, refuse anything that could escape the jobs dir
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        return None
+
+    try:
+        with open(_job_path(job_id), 'r') as job_file:
+            job = json.load(job_file)
+            heartbeat = os.fstat(job_file.fileno()).st_mtime
+    except (OSError, ValueError):
+        return None
+
+    return _check_stale(job, heartbeat)
+
+
+def _check_stale(job, heartbeat):
+    # a started job touches its file every heartbeat_interval, also while it waits for its lock. If that stopped, or
+    # a job was never started because its worker restarted or the celery message was lost, the job would otherwise
+    # be reported as running or pending forever
+    stale_after = int(cnc_utils.get_config_value('BOOTSTRAPPER_JOB_STALE_AFTER', '300'))
+    now = time.time()
+    # the job file is written when the job is created, so a job that never started ages from its creation
+    if job['status'] not in ('pending', 'running') or now - max(heartbeat, job['created']) < stale_after:
+        return job
+
+    print(f'Job {job["name"]} for {job["repo_name"]} stopped responding while {job["status"]}')
+    if job['status'] == 'pending':
+        job['message'] = f'Job {job["name"]} for {job["repo_name"]} was never started'
+    else:
+        job['message'] = f'Job {job["name"]} for {job["repo_name"]} stopped unexpectedly'
+    job['status'] = 'error'
+    _save_job(job)
+    return job
+
+
+def list_jobs():
+    """
+    List all jobs that are still running or finished recently, oldest first. Old finished jobs are removed
+    :return: list of job dicts
+    """
+    jobs = list()
+    now = time.time()
+    for file_name in os.listdir(_get_dir('jobs')):
+        if not file_name.endswith('.json'):
+            continue
+
+        job = get_job(file_name[:-5])
+        if job is None:
+            continue
+
+        if job['status'] in ('success', 'error') and now - job['updated'] > job_retention:
+            for path in (_job_path(job['id']), _job_path(job['id']) + '.finalized'):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            continue
+
+        jobs.append(job)
+
+    return sorted(jobs, key=lambda j: j['created'])
+
+
+def claim_finalize(job_id):
+    """
+    Claim the one time follow up work for a finished job, such as clearing caches in the web process
+    :param job_id: id of a finished job
+    :return: True for exactly one caller per job
+    """
+    try:
+        fd = os.open(_job_path(job_id) + '.finalized', os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return False
+
+    os.close(fd)
+    return True
+
+
+@contextmanager
+def _file_lock(lock_path, blocking=True, remove=False):
+    while True:
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                if remove and not _is_current(lock_file, lock_path):
+                    # the previous holder removed the file after we opened it, lock the file now at this path
+                    continue
+                try:
+                    yield
+                finally:
+                    if remove:
+                        os.unlink(lock_path)
+                return
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_current(lock_file, lock_path):
+    try:
+        return os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def repo_lock(repo_name, blocking=True):
+    """
+    Serialize all jobs for one repository, across threads and worker processes
+    :param repo_name: name of the repository
+    :param blocking: wait for the lock, otherwise raise BlockingIOError if a job holds it
+    """
+    return _file_lock(os.path.join(_get_dir('locks'), f'{os.path.basename(repo_name)}.lock'), blocking)
+
+
+def job_lock(lock_name):
+    """
+    Serialize jobs that do not belong to a single repository, such as updating all of them. These locks are kept
+    apart from the repository locks, so no repository name can ever share one. Lock names may be generated, i.e.
+    from a payload digest, so each lock file is removed again when it is released
+    :param lock_name: name of the lock
+    """
+    return _file_lock(os.path.join(_get_dir('job_locks'), f'{os.path.basename(lock_name)}.lock'), remove=True)
+
+
+def _get_job_lock(job):
+    if job.get('lock_name'):
+        return job_lock(job['lock_name'])
+
+    return repo_lock(job['repo_name'])
+
+
+def run_job(job_id):
+    """
+    Execute a submitted job and record the result. Called from the local thread pool or a celery worker
+    :param job_id: id returned from submit_job
+    :return: None
+    """
+    job = get_job(job_id)
+    if job is None:
+        print(f'Job {job_id} not found')
+        return
+
+    func = job_functions.get(job['name'], None)
+    if func is None:
+        job['status'] = 'error'
+        job['message'] = f'Unknown job {job["name"]}'
+        _save_job(job)
+        return
+
+    if job['status'] != 'pending':
+        # expired by _check_stale before a worker got to it, the user has already been told it failed
+        print(f'Job {job["name"]} for {job["repo_name"]} is {job["status"]}, not running it')
+        return
+
+    _save_job(job)
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job['id'], stop_heartbeat), daemon=True).start()
+    try:
+        with _get_job_lock(job):
+            job['status'] = 'running'
+            _save_job(job)
+            try:
+                result = func(**job['kwargs'])
+                job['status'] = 'success' if result[0] else 'error'
+                job['message'] = result[1]
+                job['details'] = result[2] if len(result) > 2 else dict()
+            except Exception as e:
+                traceback.print_exc()
+                job['status'] = 'error'
+                job['message'] = f'Error: {e}'
+
+            _save_job(job)
+    finally:
+        stop_heartbeat.set()
+
+    print(f'Job {job["name"]} for {job["repo_name"]} finished with {job["status"]}: {job["message"]}')
+
+
+def _heartbeat(job_id, stop):
+    while not stop.wait(heartbeat_interval):
+        try:
+            os.utime(_job_path(job_id))
+        except OSError as oe:
+            print(f'Could not update heartbeat of job {job_id}: {oe}')
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = int(cnc_utils.get_config_value('BOOTSTRAPPER_JOB_WORKERS', '2'))
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bootstrapper-job')
+
+    return _executor
+
+
+def submit_job(name, repo_name, lock_name=None, **kwargs):
+    """
+    Queue a registered job function to run in the background
+    :param name: name the job function was registered with
+    :param repo_name: repository this job operates on, used for locking and display
+    :param lock_name: job_lock to hold instead of the repository lock, for jobs that are not about one repository
+    :param kwargs: keyword arguments for the job function, must be json serializable
+    :return: job id
+    """
+    job = dict(id=str(uuid.uuid4()), name=name, repo_name=repo_name, lock_name=lock_name, kwargs=kwargs,
+               status='pending', message='', details=dict(), created=time.time())
+    _save_job(job)
+
+    if get_broker() == 'local':
+        _get_executor().submit(run_job, job['id'])
+    else:
+        from bootstrapper import tasks
+        tasks.run_job.delay(job['id'])
+
+    return job['id']
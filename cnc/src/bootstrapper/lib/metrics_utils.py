@@ -0,0 +1,94 @@
+"""
+Prometheus metrics for the bootstrapper app, exposed in text format at /bootstrapper/metrics
+
+Each stage of a build is timed separately so it is possible to tell whether time is spent rendering templates in
+this container, waiting on Panorama, or waiting on the bootstrapper service. When jobs run in a separate celery
+worker, set PROMETHEUS_MULTIPROC_DIR to the same empty directory for the web and worker processes so both are
+reported from the one endpoint.
+
+The endpoint is disabled unless BOOTSTRAPPER_METRICS_TOKEN is set, scrapers send the token as
+'Authorization: Bearer <token>' like clients of the json api.
+"""
+import hmac
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+
+from pan_cnc.lib import cnc_utils
+
+# template renders are fast, the other stages involve the network or git and can take minutes
+_fast_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, float('inf'))
+_scan_buckets = (.01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+_slow_buckets = (.05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float('inf'))
+
+template_render_seconds = Histogram('bootstrapper_template_render_seconds',
+                                    'Time to render a snippet template', ['template'], buckets=_fast_buckets)
+
+panorama_seconds = Histogram('bootstrapper_panorama_seconds',
+                             'Time spent on Panorama api calls', ['operation'], buckets=_slow_buckets)
+
+upstream_seconds = Histogram('bootstrapper_upstream_seconds',
+                             'Time until the bootstrapper service starts to respond', ['endpoint'],
+                             buckets=_slow_buckets)
+
+repo_operation_seconds = Histogram('bootstrapper_repo_operation_seconds',
+                                   'Time to clone or update a git repository', ['operation'], buckets=_slow_buckets)
+
+snippet_scan_seconds = Histogram('bootstrapper_snippet_scan_seconds',
+                                 'Time to scan a repository for snippets', buckets=_scan_buckets)
+
+builds_total = Counter('bootstrapper_builds_total', 'Archive build requests',
+                       ['deployment_type', 'status', 'cache'])
+
+
+def record_build(deployment_type, status, cache='none'):
+    """
+    Count a single build request
+    :param deployment_type: deployment (archive) type, i.e. tgz or s3
+    :param status: http status code from the bootstrapper service, or 'error' when it could not be reached
+    :param cache: hit or miss for archive types that can be cached, local for archives built in process, otherwise
+                  none
+    :return: None
+    """
+    builds_total.labels(deployment_type=deployment_type or 'unknown', status=str(status), cache=cache).inc()
+
+
+def get_metrics_token():
+    return cnc_utils.get_config_value('BOOTSTRAPPER_METRICS_TOKEN', '')
+
+
+def is_authorized(request):
+    """
+    Check the bearer token sent with a metrics request
+    :param request: django request
+    :return: True if the metrics endpoint is enabled and the token matches
+    """
+    token = get_metrics_token()
+    if token == '':
+        return False
+
+    scheme, _, supplied = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'bearer':
+        return False
+
+    return hmac.compare_digest(supplied.strip().encode('utf-8'), token.encode('utf-8'))
+
+
+def get_metrics():
+    """
+    Collect all metrics in the prometheus text format
+    :return: tuple of body bytes and content type
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
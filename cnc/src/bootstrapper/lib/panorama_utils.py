@@ -0,0 +1,163 @@
+"""
+Panorama helpers that keep authenticated API sessions and generated VM auth keys around between builds.
+
+Sessions are keyed by (panorama_ip, user, password hash) so a changed password forces a new login, and auth keys
+are keyed by (panorama_ip, user). A key is reused until it is within PANORAMA_VM_AUTH_KEY_REUSE seconds of being
+generated, which is always kept well inside the lifetime requested from Panorama, so a batch of builds against the
+same Panorama costs one login and one key request.
+"""
+import hashlib
+import re
+import threading
+import time
+
+from pan_cnc.lib import cnc_utils
+from pan_cnc.lib.exceptions import TargetConnectionException
+
+from bootstrapper.lib import metrics_utils
+
+_sessions = dict()
+_auth_keys = dict()
+_locks = dict()
+_locks_lock = threading.Lock()
+
+
+def _get_lock(cache_key):
+    with _locks_lock:
+        if cache_key not in _locks:
+            _locks[cache_key] = threading.Lock()
+        return _locks[cache_key]
+
+
+def _session_key(panorama_ip, user, password):
+    return panorama_ip, user, hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+def get_key_lifetime():
+    """
+    Lifetime in hours to request for newly generated VM auth keys
+    :return: int
+    """
+    return int(cnc_utils.get_config_value('PANORAMA_VM_AUTH_KEY_LIFETIME', '24'))
+
+
+def get_key_reuse_window():
+    """
+    How long in seconds a generated VM auth key may be handed out to new builds. Devices may boot some time after
+    their archive was built, so this is capped at half of the key lifetime
+    :return: int
+    """
+    reuse = int(cnc_utils.get_config_value('PANORAMA_VM_AUTH_KEY_REUSE', '3600'))
+    return min(reuse, get_key_lifetime() * 3600 // 2)
+
+
+def get_session(panorama_ip, user, password):
+    """
+    Return an authenticated PanXapi object for this Panorama, logging in only if we do not already have one
+    :param panorama_ip: Panorama hostname or ip address
+    :param user: API username
+    :param password: API password
+    :return: pan.xapi.PanXapi with a valid api_key
+    :raises TargetConnectionException: if the login fails
+    """
+    # pan.xapi is only needed once a workflow reaches the Panorama step, so it is not imported with the views
+    import pan.xapi
+
+    cache_key = _session_key(panorama_ip, user, password)
+    with _get_lock(cache_key):
+        xapi = _sessions.get(cache_key, None)
+        if xapi is not None:
+            return xapi
+
+        timeout = int(cnc_utils.get_config_value('PANORAMA_TIMEOUT', '30'))
+        # a non standard port or plain http is only expected for lab setups and the benchmark stand-ins
+        port = cnc_utils.get_config_value('PANORAMA_PORT', '')
+        use_http = cnc_utils.get_config_value('PANORAMA_USE_HTTP', 'no') == 'yes'
+        try:
+            print(f'Logging in to Panorama {panorama_ip}')
+            xapi = pan.xapi.PanXapi(hostname=panorama_ip, api_username=user, api_password=password,
+                                    port=int(port) if port else None, use_http=use_http, timeout=timeout)
+            with metrics_utils.panorama_seconds.labels(operation='login').time():
+                xapi.keygen()
+        except pan.xapi.PanXapiError as pxe:
+            print(f'Could not log in to Panorama {panorama_ip}: {pxe}')
+            raise TargetConnectionException(f'Could not log in to Panorama {panorama_ip}')
+
+        _sessions[cache_key] = xapi
+        return xapi
+
+
+def invalidate_session(panorama_ip, user, password):
+    """
+    Forget the cached session for this Panorama, i.e. after the api key has been revoked
+    """
+    _sessions.pop(_session_key(panorama_ip, user, password), None)
+
+
+def parse_vm_auth_key(result):
+    """
+    Pull the key from a 'VM auth key 123456 generated. Expires at: ...' op command result
+    :param result: xml_result string from the generate op command
+    :return: vm auth key string or None if not found
+    """
+    matches = re.match('VM auth key (.*?) ', result or '')
+    if matches:
+        return matches[1]
+
+    return None
+
+
+def generate_vm_auth_key(xapi):
+    """
+    Ask Panorama to generate a new VM auth key
+    :param xapi: authenticated PanXapi object
+    :return: op command result string
+    """
+    lifetime = get_key_lifetime()
+    with metrics_utils.panorama_seconds.labels(operation='generate_vm_auth_key').time():
+        xapi.op(cmd=f'<request><bootstrap><vm-auth-key><generate><lifetime>{lifetime}</lifetime></generate>'
+                    f'</vm-auth-key></bootstrap></request>')
+    return xapi.xml_result()
+
+
+def get_vm_auth_key(panorama_ip, user, password):
+    """
+    Return a VM auth key for this Panorama, reusing a recently generated key and API session where possible
+    :param panorama_ip: Panorama hostname or ip address
+    :param user: API username
+    :param password: API password
+    :return: vm auth key string or None if Panorama did not return one
+    :raises TargetConnectionException: if Panorama cannot be contacted
+    """
+    import pan.xapi
+
+    key_cache_key = (panorama_ip, user)
+    with _get_lock(key_cache_key):
+        password_hash = _session_key(panorama_ip, user, password)[2]
+        cached = _auth_keys.get(key_cache_key, None)
+        # only hand out a cached key to callers that could have logged in to get it themselves
+        if cached is not None and cached['password_hash'] == password_hash and time.time() < cached['reuse_until']:
+            print(f'Using cached VM auth key for {panorama_ip}')
+            return cached['vm_auth_key']
+
+        result = None
+        # a cached session may have an api key that is no longer valid, so try once more with a fresh login
+        for attempt in range(2):
+            xapi = get_session(panorama_ip, user, password)
+            try:
+                result = generate_vm_auth_key(xapi)
+                break
+            except pan.xapi.PanXapiError as pxe:
+                print(f'Could not get vm auth key from {panorama_ip}: {pxe}')
+                invalidate_session(panorama_ip, user, password)
+        else:
+            raise TargetConnectionException(f'Could not get vm auth key from Panorama {panorama_ip}')
+
+        vm_auth_key = parse_vm_auth_key(result)
+        if vm_auth_key is None:
+            print(f'Could not parse VM Auth key from Panorama response: {result}')
+            return None
+
+        _auth_keys[key_cache_key] = dict(vm_auth_key=vm_auth_key, password_hash=password_hash,
+                                         reuse_until=time.time() + get_key_reuse_window())
+        return vm_auth_key
@@ -0,0 +1,112 @@
+"""
+Profile single requests to the bootstrapper views to see where the time of a slow build goes
+
+Only staff users can profile a request, either by adding ?profile=yes to the url of a workflow step or by setting
+BOOTSTRAPPER_PROFILE to yes, which profiles every request they make. Each profiled request writes a cProfile dump,
+which can be opened with pstats or snakeviz, and a text summary of the top call sites to
+~/.pan_cnc/bootstrapper/profiles. Only the newest BOOTSTRAPPER_PROFILE_KEEP profiles are kept.
+
+Only the view itself is profiled. Streamed archive bodies are sent after the view returns and the awaited part of
+async views runs on the event loop, so neither is included.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+from datetime import datetime
+
+from pan_cnc.lib import cnc_utils
+
+# number of entries in each table of the text summary
+summary_lines = 40
+
+
+def get_profile_dir():
+    profile_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'profiles')
+    os.makedirs(profile_dir, exist_ok=True)
+    return profile_dir
+
+
+def should_profile(request):
+    """
+    Check if this request was asked to be profiled, by a staff user. The user is only looked up when profiling was
+    asked for, so requests without the query parameter or config value do not load it
+    :param request: django request
+    :return: boolean
+    """
+    if request.GET.get('profile', '') != 'yes' \
+            and cnc_utils.get_config_value('BOOTSTRAPPER_PROFILE', 'no') != 'yes':
+        return False
+
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_authenticated and user.is_staff
+
+
+def run_profiled(name, request, func, *args, **kwargs):
+    """
+    Call func under cProfile and write the results to the profile dir
+    :param name: name of what is being profiled, used in the file names, i.e. the view class
+    :param request: django request, recorded in the summary
+    :param func: function to call
+    :return: whatever func returns
+    """
+    profiler = cProfile.Profile()
+    start = time.time()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        elapsed = time.time() - start
+        try:
+            write_profile(profiler, name, request, elapsed)
+        except OSError as oe:
+            print(f'Could not write profile for {name}: {oe}')
+
+
+def write_profile(profiler, name, request, elapsed):
+    """
+    Save a profile dump and text summary and remove the oldest profiles over the limit
+    :param profiler: finished cProfile.Profile
+    :param name: name of what was profiled
+    :param request: django request
+    :param elapsed: wall clock seconds
+    :return: path of the text summary
+    """
+    profile_dir = get_profile_dir()
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+    base_name = f'{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-{safe_name}-{request.method.lower()}'
+    base_path = os.path.join(profile_dir, base_name)
+
+    profiler.dump_stats(f'{base_path}.prof')
+
+    summary = io.StringIO()
+    summary.write(f'{request.method} {request.get_full_path()}\n')
+    summary.write(f'view: {name}\nuser: {request.user}\nelapsed: {elapsed:.3f}s\n\n')
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.strip_dirs()
+    summary.write('Sorted by cumulative time\n')
+    stats.sort_stats('cumulative').print_stats(summary_lines)
+    summary.write('Sorted by own time\n')
+    stats.sort_stats('tottime').print_stats(summary_lines)
+
+    with open(f'{base_path}.txt', 'w') as summary_file:
+        summary_file.write(summary.getvalue())
+
+    print(f'Wrote profile of {name} to {base_path}.txt, took {elapsed:.3f}s')
+    prune_profiles(profile_dir)
+    return f'{base_path}.txt'
+
+
+def prune_profiles(profile_dir):
+    keep = int(cnc_utils.get_config_value('BOOTSTRAPPER_PROFILE_KEEP', '20'))
+    # names start with the timestamp, so sorting them sorts by age
+    names = sorted({os.path.splitext(f)[0] for f in os.listdir(profile_dir) if f.endswith(('.prof', '.txt'))})
+    for base_name in names[:max(0, len(names) - keep)]:
+        for extension in ('.prof', '.txt'):
+            try:
+                os.unlink(os.path.join(profile_dir, base_name + extension))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,395 @@
+"""
+Helpers for the git repositories imported into the bootstrapper app.
+
+Import and update are registered as background jobs, see job_utils.
+
+The repository list is kept as an index of one entry per repository keyed by its HEAD commit. Only repositories that
+are new or whose HEAD has moved since the last listing are read again, and those are read in parallel.
+
+GitPython and pan_cnc.lib.git_utils are only imported when a repository is actually read or changed, so listing
+unchanged repositories and starting a worker do not pay for them.
+
+Jobs that change a repository bump a generation file once they have re-indexed it. Every process compares that file
+on each request through refresh_snippet_caches and clears its pan_cnc snippet caches when it has moved, no matter
+which worker or celery process ran the job.
+"""
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pan_cnc.lib import cnc_utils
+
+from bootstrapper.lib import job_utils
+from bootstrapper.lib import metrics_utils
+
+# jobs that change the imported repositories, their results are reported on the repositories page
+repo_job_names = ('import_repo', 'update_repo', 'update_all_repos')
+
+
+def get_repositories_dir():
+    """
+    All imported repositories live under ~/.pan_cnc/bootstrapper/repositories
+    :return: path string
+    """
+    return os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'repositories')
+
+
+def _get_generation_path():
+    return os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'snippet_generation')
+
+
+def _read_generation():
+    try:
+        with open(_get_generation_path(), 'r') as generation_file:
+            return generation_file.read()
+    except OSError:
+        return ''
+
+
+# generation this process has cleared its snippet caches for, the caches start out empty
+_seen_generation = _read_generation()
+
+
+def mark_snippets_changed():
+    """
+    Record that the imported repositories have changed, so every process clears its snippet caches on its next request
+    :return: None
+    """
+    generation_path = _get_generation_path()
+    os.makedirs(os.path.dirname(generation_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(generation_path))
+    with os.fdopen(fd, 'w') as generation_file:
+        generation_file.write(str(uuid.uuid4()))
+    os.replace(tmp_path, generation_path)
+
+
+def refresh_snippet_caches(app_dir):
+    """
+    Clear the pan_cnc snippet caches of this process if the repositories have changed since it last did
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :return: None
+    """
+    global _seen_generation
+
+    generation = _read_generation()
+    if generation == _seen_generation:
+        return
+
+    from pan_cnc.lib import snippet_utils
+
+    print('Invalidating snippet cache')
+    snippet_utils.invalidate_snippet_caches(app_dir)
+    _seen_generation = generation
+
+
+def get_head_commit(repo_dir):
+    """
+    Read the commit HEAD points to directly from the .git directory, without starting git or loading the repo
+    :param repo_dir: path to the repository working tree
+    :return: commit sha string or None if it could not be determined
+    """
+    git_dir = os.path.join(repo_dir, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as head_file:
+            head = head_file.read().strip()
+    except OSError:
+        return None
+
+    if not head.startswith('ref:'):
+        # detached HEAD
+        return head
+
+    ref = head[4:].strip()
+    try:
+        with open(os.path.join(git_dir, ref), 'r') as ref_file:
+            return ref_file.read().strip()
+    except OSError:
+        pass
+
+    # the ref may only be in packed-refs, i.e. right after a clone
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as packed_refs:
+            for line in packed_refs:
+                parts = line.strip().split(' ')
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except OSError:
+        pass
+
+    return None
+
+
+def list_repository_dirs():
+    """
+    Find every git repository under the repositories dir
+    :return: list of Path objects
+    """
+    repositories_dir = Path(get_repositories_dir())
+    if not repositories_dir.exists():
+        return list()
+
+    repo_dirs = list()
+    for d in repositories_dir.iterdir():
+        git_dir = d.joinpath('.git')
+        if git_dir.exists() and git_dir.is_dir():
+            repo_dirs.append(d)
+
+    return sorted(repo_dirs, key=lambda k: k.name)
+
+
+def get_repo_details_list(app_dir):
+    """
+    Return the details of every imported repository, re-reading only those that changed since the last call
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :return: list of repo detail dicts as returned by git_utils.get_repo_details
+    """
+    index = cnc_utils.get_long_term_cached_value(app_dir, 'repository_index')
+    if index is None:
+        index = dict()
+
+    new_index = dict()
+    stale = list()
+    for d in list_repository_dirs():
+        commit = get_head_commit(str(d))
+        entry = index.get(d.name, None)
+        if entry is not None and commit is not None and entry['commit'] == commit:
+            new_index[d.name] = entry
+        else:
+            stale.append((d, commit))
+
+    if stale:
+        from pan_cnc.lib import git_utils
+
+        print(f'Loading details for {len(stale)} repositories')
+        workers = int(cnc_utils.get_config_value('BOOTSTRAPPER_REPO_DETAIL_WORKERS', '8'))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(stale)))) as executor:
+            details = executor.map(lambda s: git_utils.get_repo_details(s[0].name, s[0], app_dir), stale)
+            for (d, commit), repo_detail in zip(stale, details):
+                new_index[d.name] = dict(commit=commit, detail=repo_detail)
+
+    if new_index != index:
+        # cache the index for 1 week. Removed repos drop out and changed repos are re-read on the next listing
+        cnc_utils.set_long_term_cached_value(app_dir, 'repository_index', new_index, 604800, 'imported_git_repos')
+
+    return [new_index[name]['detail'] for name in sorted(new_index)]
+
+
+def get_clone_depth():
+    return int(cnc_utils.get_config_value('BOOTSTRAPPER_CLONE_DEPTH', '1'))
+
+
+def is_shallow(repo_dir):
+    return os.path.exists(os.path.join(repo_dir, '.git', 'shallow'))
+
+
+def _write_sparse_patterns(repo, treeish):
+    """
+    Limit the working tree to the directories that hold a .meta-cnc.yaml file in the given commit. The snippet
+    directories are found from the tree itself so this works before anything has been checked out
+    """
+    paths = repo.git.ls_tree('-r', '--name-only', treeish).splitlines()
+    snippet_dirs = sorted({os.path.dirname(p) for p in paths if os.path.basename(p) == '.meta-cnc.yaml'})
+    if '' in snippet_dirs:
+        # a snippet at the top of the repo needs everything anyway
+        snippet_dirs = ['']
+
+    with open(os.path.join(repo.git_dir, 'info', 'sparse-checkout'), 'w') as sparse_file:
+        for d in snippet_dirs:
+            sparse_file.write(f'/{d}/\n' if d else '/*\n')
+
+
+def clone_repo_shallow(repo_dir, url, branch, sparse=False):
+    """
+    Clone only the most recent commits of a single branch. With sparse, only the directories that hold a
+    .meta-cnc.yaml file, and everything below them, are checked out
+    :param repo_dir: directory to clone into
+    :param url: git url to clone from
+    :param branch: branch to clone
+    :param sparse: limit the working tree to snippet directories
+    :return: boolean on success
+    """
+    from git import GitCommandError
+    from git import Repo
+
+    try:
+        repo = Repo.clone_from(url, repo_dir, depth=get_clone_depth(), single_branch=True, branch=branch,
+                               no_checkout=sparse)
+        if sparse:
+            repo.git.config('core.sparseCheckout', 'true')
+            _write_sparse_patterns(repo, 'HEAD')
+            repo.git.read_tree('-mu', 'HEAD')
+
+    except GitCommandError as gce:
+        print(f'Could not clone {url}: {gce}')
+        if os.path.exists(repo_dir):
+            shutil.rmtree(repo_dir)
+        return False
+
+    return True
+
+
+def update_repo_shallow(repo_dir):
+    """
+    Fetch only the new tip of the branch on top of a shallow clone and move the working tree to it. Any sparse
+    checkout settings are kept
+    :param repo_dir: path to the repository
+    :return: message string, containing 'Error' on failure
+    """
+    from git import GitCommandError
+    from git import InvalidGitRepositoryError
+    from git import NoSuchPathError
+    from git import Repo
+
+    try:
+        repo = Repo(repo_dir)
+        branch = repo.active_branch.name
+        current = repo.head.commit.hexsha
+        repo.git.fetch('--depth', str(get_clone_depth()), 'origin', branch)
+        latest = repo.git.rev_parse('FETCH_HEAD')
+        if latest == current:
+            return 'Repository is already up to date'
+
+        if repo.config_reader().get_value('core', 'sparseCheckout', False):
+            # templates may have been added in new directories
+            _write_sparse_patterns(repo, 'FETCH_HEAD')
+
+        repo.git.reset('--hard', 'FETCH_HEAD')
+    except (GitCommandError, InvalidGitRepositoryError, NoSuchPathError, TypeError) as e:
+        # TypeError is raised by active_branch for a detached HEAD
+        print(f'Could not update {repo_dir}: {e}')
+        return f'Error: Could not update repository: {e}'
+
+    return f'Updated to commit {latest[:8]}'
+
+
+@job_utils.register_job('import_repo')
+def import_repository(repo_name, url, branch, app_dir, shallow='yes', sparse='no'):
+    """
+    Clone a new repository into the repositories dir and index its snippets
+    :param repo_name: name of the new repository dir
+    :param url: git url to clone from
+    :param branch: branch to check out
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :param shallow: 'yes' to clone only the tip of the branch
+    :param sparse: 'yes' to only check out directories that contain a .meta-cnc.yaml file, requires shallow
+    :return: tuple of (success, message, details) where details lists the changed repositories
+    """
+    from pan_cnc.lib import git_utils
+
+    if sparse == 'yes' and shallow != 'yes':
+        # full clones are updated by pan_cnc, which would not add new template directories to the sparse patterns
+        return False, f'Could not Import Repository {repo_name}: a sparse checkout needs a shallow clone'
+
+    # imported here as the snippet index depends on this module
+    from bootstrapper.lib import snippet_index_utils
+
+    new_repo_snippets_dir = os.path.join(get_repositories_dir(), repo_name)
+
+    # where to clone from
+    clone_url = url
+    if 'github' in url.lower():
+        details = git_utils.get_repo_upstream_details(repo_name, url, app_dir)
+        if 'clone_url' in details:
+            clone_url = details['clone_url']
+
+    with metrics_utils.repo_operation_seconds.labels(operation='clone').time():
+        if shallow == 'yes':
+            cloned = clone_repo_shallow(new_repo_snippets_dir, clone_url, branch, sparse == 'yes')
+        else:
+            cloned = git_utils.clone_repo(new_repo_snippets_dir, repo_name, clone_url, branch)
+
+    if not cloned:
+        return False, f'Could not Import Repository {repo_name}'
+
+    snippet_index_utils.index_repository(repo_name)
+    mark_snippets_changed()
+    return True, f'Imported Repository {repo_name} Successfully', dict(changed=[repo_name])
+
+
+def _update_repo_dir(repo_dir):
+    """
+    Update a single repository, using an incremental fetch for shallow clones
+    :param repo_dir: path to the repository
+    :return: tuple of (status, message) where status is one of changed, unchanged or error
+    """
+    from pan_cnc.lib import git_utils
+
+    before = get_head_commit(repo_dir)
+    with metrics_utils.repo_operation_seconds.labels(operation='update').time():
+        if is_shallow(repo_dir):
+            msg = update_repo_shallow(repo_dir)
+        else:
+            msg = git_utils.update_repo(repo_dir)
+
+    if 'Error' in msg:
+        return 'error', msg
+
+    if get_head_commit(repo_dir) != before:
+        return 'changed', msg
+
+    return 'unchanged', msg
+
+
+@job_utils.register_job('update_repo')
+def update_repository(repo_name):
+    """
+    Pull the latest changes for an imported repository and re-index its snippets if anything changed
+    :param repo_name: name of the repository dir
+    :return: tuple of (success, message, details) where details lists the changed repositories
+    """
+    from bootstrapper.lib import snippet_index_utils
+
+    status, msg = _update_repo_dir(os.path.join(get_repositories_dir(), repo_name))
+    if status == 'error':
+        return False, msg, dict(changed=[])
+
+    if status == 'unchanged':
+        return True, msg, dict(changed=[])
+
+    snippet_index_utils.index_repository(repo_name)
+    mark_snippets_changed()
+    return True, msg, dict(changed=[repo_name])
+
+
+@job_utils.register_job('update_all_repos')
+def update_all_repositories():
+    """
+    Update every imported repository through a bounded pool of concurrent fetches. Only repositories whose HEAD
+    moved are re-indexed
+    :return: tuple of (success, message, details) where details has the status of each repository and the list of
+    changed repositories
+    """
+    from bootstrapper.lib import snippet_index_utils
+
+    def update(d):
+        # an import, update or remove of this repo may have been started on its own
+        with job_utils.repo_lock(d.name):
+            return _update_repo_dir(str(d))
+
+    repo_dirs = list_repository_dirs()
+    results = dict()
+    if repo_dirs:
+        workers = int(cnc_utils.get_config_value('BOOTSTRAPPER_UPDATE_WORKERS', '4'))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(repo_dirs)))) as executor:
+            for d, (status, msg) in zip(repo_dirs, executor.map(update, repo_dirs)):
+                print(f'Update {d.name}: {status} {msg}')
+                results[d.name] = dict(status=status, message=msg)
+
+    changed = [name for name in results if results[name]['status'] == 'changed']
+    failed = [name for name in results if results[name]['status'] == 'error']
+    for repo_name in changed:
+        snippet_index_utils.index_repository(repo_name)
+    if changed:
+        mark_snippets_changed()
+
+    message = f'Updated {len(results)} repositories: {len(changed)} changed, ' \
+              f'{len(results) - len(changed) - len(failed)} unchanged, {len(failed)} failed'
+    if changed:
+        message += f'. Changed: {", ".join(changed)}'
+    if failed:
+        message += f'. Failed: {", ".join(failed)}'
+
+    return not failed, message, dict(changed=changed, results=results)
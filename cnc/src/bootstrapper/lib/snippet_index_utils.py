@@ -0,0 +1,187 @@
+"""
+Persistent index of snippet labels for the bootstrapper app, stored in sqlite under ~/.pan_cnc/bootstrapper.
+
+Every .meta-cnc.yaml found in the app snippets dir and in each imported repository is recorded with its labels, so
+looking up all snippets with a given label is a single query instead of a scan of every repository. Repositories
+are indexed one at a time as they are imported, updated or removed. Repositories added or changed outside of those
+views, such as the default repositories cloned by pan-cnc, are picked up by comparing the HEAD commit recorded for
+each repository at most once every BOOTSTRAPPER_SNIPPET_INDEX_CHECK seconds.
+"""
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from pan_cnc.lib import cnc_utils
+
+from bootstrapper.lib import metrics_utils
+from bootstrapper.lib import repo_utils
+from bootstrapper.lib import template_utils
+
+# pseudo repository name used for the snippets shipped with the app itself
+app_repo_name = ''
+
+_schema = """
+CREATE TABLE IF NOT EXISTS repositories (
+    name TEXT PRIMARY KEY,
+    head_commit TEXT
+);
+CREATE TABLE IF NOT EXISTS snippets (
+    repo TEXT NOT NULL,
+    name TEXT NOT NULL,
+    label TEXT,
+    meta_path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS labels (
+    repo TEXT NOT NULL,
+    snippet_name TEXT NOT NULL,
+    label_key TEXT NOT NULL,
+    label_value TEXT
+);
+CREATE INDEX IF NOT EXISTS snippets_repo ON snippets (repo);
+CREATE INDEX IF NOT EXISTS snippets_name ON snippets (name);
+CREATE INDEX IF NOT EXISTS labels_key_value ON labels (label_key, label_value);
+CREATE INDEX IF NOT EXISTS labels_repo ON labels (repo);
+"""
+
+_last_check = 0
+_app_indexed = False
+_check_lock = threading.Lock()
+
+
+def get_index_path():
+    index_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper')
+    os.makedirs(index_dir, exist_ok=True)
+    return os.path.join(index_dir, 'snippet_index.sqlite')
+
+
+def _connect():
+    connection = sqlite3.connect(get_index_path(), timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(_schema)
+    return connection
+
+
+def _index_dir(connection, repo_name, snippets_dir, head_commit):
+    """
+    Replace all entries for one repository with what is currently on disk
+    """
+    rows = list()
+    label_rows = list()
+    with metrics_utils.snippet_scan_seconds.time():
+        for meta_file in Path(snippets_dir).rglob('.meta-cnc.yaml'):
+            service = template_utils.load_snippet_metadata(meta_file)
+            if service is None or 'name' not in service:
+                continue
+
+            rows.append((repo_name, service['name'], service.get('label', service['name']), str(meta_file)))
+            labels = service.get('labels', None)
+            if not isinstance(labels, dict):
+                continue
+
+            for label_key, label_value in labels.items():
+                values = label_value if isinstance(label_value, list) else [label_value]
+                for value in values:
+                    label_rows.append((repo_name, service['name'], str(label_key), str(value)))
+
+    with connection:
+        connection.execute('DELETE FROM snippets WHERE repo = ?', (repo_name,))
+        connection.execute('DELETE FROM labels WHERE repo = ?', (repo_name,))
+        connection.executemany('INSERT INTO snippets (repo, name, label, meta_path) VALUES (?, ?, ?, ?)', rows)
+        connection.executemany('INSERT INTO labels (repo, snippet_name, label_key, label_value) VALUES (?, ?, ?, ?)',
+                               label_rows)
+        connection.execute('INSERT OR REPLACE INTO repositories (name, head_commit) VALUES (?, ?)',
+                           (repo_name, head_commit))
+
+    print(f'Indexed {len(rows)} snippets in {repo_name or "app"}')
+
+
+def index_repository(repo_name):
+    """
+    (Re)index all snippets in a single imported repository
+    :param repo_name: name of the repository dir under the repositories dir
+    :return: None
+    """
+    repo_dir = os.path.join(repo_utils.get_repositories_dir(), repo_name)
+    connection = _connect()
+    try:
+        _index_dir(connection, repo_name, repo_dir, repo_utils.get_head_commit(repo_dir))
+    finally:
+        connection.close()
+
+
+def remove_repository(repo_name):
+    """
+    Drop all snippets from a repository that has been removed
+    :param repo_name: name of the repository
+    :return: None
+    """
+    connection = _connect()
+    try:
+        with connection:
+            connection.execute('DELETE FROM snippets WHERE repo = ?', (repo_name,))
+            connection.execute('DELETE FROM labels WHERE repo = ?', (repo_name,))
+            connection.execute('DELETE FROM repositories WHERE name = ?', (repo_name,))
+    finally:
+        connection.close()
+
+
+def _reconcile(connection):
+    """
+    Bring the index in line with the repositories on disk, only touching those that were added, changed or removed
+    """
+    global _app_indexed
+
+    if not _app_indexed:
+        # the app snippets only change when the app itself is upgraded, index them once per process
+        _index_dir(connection, app_repo_name, template_utils.app_snippets_dir, None)
+        _app_indexed = True
+
+    indexed = dict(connection.execute('SELECT name, head_commit FROM repositories WHERE name != ?',
+                                      (app_repo_name,)).fetchall())
+    on_disk = dict()
+    for d in repo_utils.list_repository_dirs():
+        on_disk[d.name] = repo_utils.get_head_commit(str(d))
+
+    for repo_name, head_commit in on_disk.items():
+        if repo_name not in indexed or indexed[repo_name] != head_commit or head_commit is None:
+            _index_dir(connection, repo_name, os.path.join(repo_utils.get_repositories_dir(), repo_name),
+                       head_commit)
+
+    for repo_name in set(indexed) - set(on_disk):
+        with connection:
+            connection.execute('DELETE FROM snippets WHERE repo = ?', (repo_name,))
+            connection.execute('DELETE FROM labels WHERE repo = ?', (repo_name,))
+            connection.execute('DELETE FROM repositories WHERE name = ?', (repo_name,))
+
+
+def _check_index(connection):
+    global _last_check
+
+    interval = int(cnc_utils.get_config_value('BOOTSTRAPPER_SNIPPET_INDEX_CHECK', '60'))
+    with _check_lock:
+        if time.time() - _last_check < interval:
+            return
+        _reconcile(connection)
+        _last_check = time.time()
+
+
+def get_snippets_by_label(label_key, label_value):
+    """
+    Find all snippets with a matching label
+    :param label_key: label name, i.e. 'template_category'
+    :param label_value: label value, i.e. 'panos_full'
+    :return: list of dicts with name, label, repo and meta_path keys
+    """
+    connection = _connect()
+    try:
+        _check_index(connection)
+        rows = connection.execute('SELECT DISTINCT s.name, s.label, s.repo, s.meta_path FROM labels l '
+                                  'JOIN snippets s ON s.repo = l.repo AND s.name = l.snippet_name '
+                                  'WHERE l.label_key = ? AND l.label_value = ?',
+                                  (label_key, label_value)).fetchall()
+    finally:
+        connection.close()
+
+    return [dict(name=r[0], label=r[1], repo=r[2], meta_path=r[3]) for r in rows]
@@ -0,0 +1,184 @@
+"""
+Process wide cache of snippet metadata and compiled jinja templates for the bootstrapper app.
+
+Templates are compiled once per process and only recompiled when the file on disk changes. Each snippet directory
+has its own jinja Environment with that directory as the search path, so {% include %} and {% import %} resolve
+relative to the snippet just like template files named in .meta-cnc.yaml. When enabled with
+BOOTSTRAPPER_BYTECODE_CACHE, the compiled bytecode is also kept under ~/.pan_cnc/bootstrapper/bytecode_cache so a
+restarted worker does not have to compile large bootstrap.xml templates again.
+"""
+import os
+import threading
+from pathlib import Path
+
+import oyaml
+from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import FileSystemLoader
+from jinja2 import TemplateError
+from jinja2 import TemplateNotFound
+
+from pan_cnc.lib import cnc_utils
+from pan_cnc.lib import jinja_filters
+
+from bootstrapper.lib import metrics_utils
+
+app_snippets_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'snippets')
+
+# snippet dir -> jinja Environment loading templates from it
+_environments = dict()
+_environment_lock = threading.Lock()
+
+# meta-cnc.yaml path -> (mtime, parsed metadata)
+_metadata_cache = dict()
+# snippet name -> meta-cnc.yaml path for the snippets shipped with this app
+_app_snippet_paths = dict()
+
+
+def get_environment(snippet_path):
+    """
+    Return the shared jinja Environment for a snippet directory with all pan-cnc filters loaded. Jinja keeps compiled
+    templates in its cache and checks the file mtime before each use, so an edited template is recompiled on the
+    next render
+    :param snippet_path: snippet directory, template names are relative to it
+    :return: jinja2.Environment
+    """
+    snippet_path = os.path.abspath(snippet_path)
+    environment = _environments.get(snippet_path, None)
+    if environment is None:
+        with _environment_lock:
+            environment = _environments.get(snippet_path, None)
+            if environment is None:
+                environment = _build_environment(snippet_path)
+                _environments[snippet_path] = environment
+
+    return environment
+
+
+def _build_environment(snippet_path):
+    cache_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_TEMPLATE_CACHE_SIZE', '400'))
+    bytecode_cache = None
+    if cnc_utils.get_config_value('BOOTSTRAPPER_BYTECODE_CACHE', 'yes') == 'yes':
+        bytecode_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'bytecode_cache')
+        os.makedirs(bytecode_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+
+    environment = Environment(loader=FileSystemLoader(snippet_path), cache_size=cache_size, auto_reload=True,
+                              bytecode_cache=bytecode_cache)
+
+    for f in jinja_filters.defined_filters:
+        if hasattr(jinja_filters, f):
+            environment.filters[f] = getattr(jinja_filters, f)
+
+    return environment
+
+
+def load_snippet_metadata(meta_path):
+    """
+    Load and parse a .meta-cnc.yaml file, re-reading it only when it has changed on disk
+    :param meta_path: path to the .meta-cnc.yaml file
+    :return: snippet (service) dict with snippet_path set, or None if it could not be loaded
+    """
+    meta_path = str(meta_path)
+    try:
+        mtime = os.stat(meta_path).st_mtime
+    except OSError:
+        _metadata_cache.pop(meta_path, None)
+        return None
+
+    cached = _metadata_cache.get(meta_path, None)
+    if cached is not None and cached[0] == mtime:
+        return dict(cached[1])
+
+    try:
+        with open(meta_path, 'r') as meta_file:
+            service = oyaml.safe_load(meta_file.read())
+    except (OSError, oyaml.YAMLError) as e:
+        print(f'Could not load snippet metadata from {meta_path}: {e}')
+        return None
+
+    if not isinstance(service, dict):
+        return None
+
+    service['snippet_path'] = os.path.dirname(meta_path)
+    _metadata_cache[meta_path] = (mtime, service)
+    return dict(service)
+
+
+def load_app_snippet(snippet_name):
+    """
+    Load one of the snippets shipped with the bootstrapper app itself, such as bootstrapper-payload
+    :param snippet_name: name of the snippet
+    :return: snippet (service) dict or None if not found
+    """
+    meta_path = _app_snippet_paths.get(snippet_name, None)
+    if meta_path is not None:
+        service = load_snippet_metadata(meta_path)
+        if service is not None and service.get('name', '') == snippet_name:
+            return service
+
+    # not seen before or moved, scan the app snippets dir again
+    _app_snippet_paths.clear()
+    for meta_file in Path(app_snippets_dir).rglob('.meta-cnc.yaml'):
+        service = load_snippet_metadata(meta_file)
+        if service is not None and 'name' in service:
+            _app_snippet_paths[service['name']] = str(meta_file)
+
+    meta_path = _app_snippet_paths.get(snippet_name, None)
+    if meta_path is None:
+        return None
+
+    return load_snippet_metadata(meta_path)
+
+
+def compile_snippet_templates(service):
+    """
+    Load every template file of a snippet into the template cache without rendering it
+    :param service: snippet (service) dict, must contain snippet_path
+    :return: number of templates compiled
+    """
+    compiled = 0
+    for snippet in service.get('snippets', list()):
+        if 'file' not in snippet:
+            continue
+
+        try:
+            get_environment(service['snippet_path']).get_template(snippet['file'])
+            compiled += 1
+        except (TemplateNotFound, TemplateError) as te:
+            print(f'Could not compile template {snippet["file"]} in {service["snippet_path"]}: {te}')
+
+    return compiled
+
+
+def render_snippet_template(service, context, template_file=''):
+    """
+    Render a template file from a snippet using the cached compiled template
+    :param service: snippet (service) dict, must contain snippet_path
+    :param context: variables to render the template with
+    :param template_file: file name of the template in the snippet dir, defaults to the first snippet in the list
+    :return: rendered string or None on error
+    """
+    if 'snippet_path' not in service:
+        print('Snippet does not have a snippet_path')
+        return None
+
+    if template_file == '':
+        snippets = service.get('snippets', None)
+        if not snippets or 'file' not in snippets[0]:
+            print(f'No template file found in snippet {service.get("name", "")}')
+            return None
+        template_file = snippets[0]['file']
+
+    template_path = os.path.abspath(os.path.join(service['snippet_path'], template_file))
+
+    try:
+        with metrics_utils.template_render_seconds.labels(template=os.path.basename(template_file)).time():
+            template = get_environment(service['snippet_path']).get_template(template_file)
+            return template.render(context)
+    except TemplateNotFound:
+        print(f'Could not find template file {template_path}')
+    except TemplateError as te:
+        print(f'Could not render template {template_path}: {te}')
+
+    return None
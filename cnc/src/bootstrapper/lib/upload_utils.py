@@ -0,0 +1,105 @@
+"""
+Helpers to accept large bootstrap.xml uploads without holding them in memory.
+
+Uploads are streamed to disk by Django in chunks, capped at BOOTSTRAPPER_UPLOAD_MAX_BYTES while the request is being
+read. The XML is then checked with an incremental parser as it is copied into the blob store, so only a small part
+of the document is ever held in memory.
+"""
+from xml.etree.ElementTree import ParseError
+from xml.etree.ElementTree import XMLPullParser
+
+from django.core.files.uploadhandler import FileUploadHandler
+from django.core.files.uploadhandler import SkipFile
+
+from pan_cnc.lib import cnc_utils
+
+from bootstrapper.lib import blob_utils
+
+
+def get_max_upload_bytes():
+    return int(cnc_utils.get_config_value('BOOTSTRAPPER_UPLOAD_MAX_BYTES', str(50 * 1024 * 1024)))
+
+
+class UploadSizeLimitHandler(FileUploadHandler):
+    """
+    Skips any uploaded file as soon as it grows past the limit, before the rest of it is written anywhere. Must be
+    the first upload handler on the request
+    """
+
+    def __init__(self, request=None, max_bytes=None):
+        super().__init__(request)
+        self.max_bytes = get_max_upload_bytes() if max_bytes is None else max_bytes
+        self.too_large = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_bytes:
+            self.too_large = True
+            raise SkipFile()
+
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class BootstrapXmlValidator:
+    """
+    Incrementally checks that a document is well formed XML with a <config> root element. Elements are discarded
+    as soon as they have been parsed
+    """
+
+    def __init__(self):
+        self.parser = XMLPullParser(events=('start', 'end'))
+        self.root = None
+        self.depth = 0
+
+    def feed(self, data):
+        # parse errors are raised from either feed or read_events depending on where they are found
+        try:
+            self.parser.feed(data)
+            self._read_events()
+        except ParseError as pe:
+            raise ValueError(f'Bootstrap is not valid XML: {pe}')
+
+    def close(self):
+        try:
+            self.parser.close()
+            self._read_events()
+        except ParseError as pe:
+            raise ValueError(f'Bootstrap is not valid XML: {pe}')
+
+        if self.root is None:
+            raise ValueError('Bootstrap does not contain any XML')
+
+    def _read_events(self):
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                if self.root is None:
+                    if elem.tag != 'config':
+                        raise ValueError(f'Bootstrap root element must be <config>, found <{elem.tag}>')
+                    self.root = elem
+                self.depth += 1
+            else:
+                self.depth -= 1
+                elem.clear()
+                if self.depth == 1:
+                    # drop finished top level sections so memory use does not grow with the document
+                    self.root.clear()
+
+
+def store_bootstrap(chunks):
+    """
+    Validate a bootstrap.xml and copy it into the blob store in a single pass
+    :param chunks: iterable of bytes, i.e. UploadedFile.chunks()
+    :return: blob reference
+    :raises ValueError: if the document is not a valid bootstrap
+    """
+    validator = BootstrapXmlValidator()
+
+    def validated(source):
+        for chunk in source:
+            validator.feed(chunk)
+            yield chunk
+        validator.close()
+
+    return blob_utils.put_chunks(validated(chunks))
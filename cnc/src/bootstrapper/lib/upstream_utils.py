@@ -0,0 +1,213 @@
+"""
+Shared HTTP client used for all calls from the bootstrapper views to the panos-bootstrapper service.
+
+A single requests Session is built per worker process so that connections to the bootstrapper container are pooled
+and kept alive between builds instead of being set up again for every archive. Async views use an httpx AsyncClient
+instead, so many builds can wait on the bootstrapper service from one worker without a thread each. The AsyncClient
+is only kept for the event loop an ASGI worker runs in its main thread, runserver runs every async view on a new loop
+in another thread and gets a client that is closed again when the request is done.
+"""
+import asyncio
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from pan_cnc.lib import cnc_utils
+
+from bootstrapper.lib import archive_cache_utils
+from bootstrapper.lib import build_utils
+from bootstrapper.lib import metrics_utils
+
+_session = None
+_session_lock = threading.Lock()
+
+# httpx clients are tied to the event loop they were first used on, only main thread loops are kept here
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_bootstrapper_url(path):
+    """
+    Build the full url to an endpoint on the bootstrapper service
+    get the bootstrapper host and port from the .panrc file, environment, or default name lookup
+    docker-compose will host bootstrapper under the 'bootstrapper' domain name
+    :param path: endpoint path on the bootstrapper service, i.e. 'generate_bootstrap_package'
+    :return: url string
+    """
+    bootstrapper_host = cnc_utils.get_config_value('BOOTSTRAPPER_HOST', 'bootstrapper')
+    bootstrapper_port = cnc_utils.get_config_value('BOOTSTRAPPER_PORT', '5000')
+    return f'http://{bootstrapper_host}:{bootstrapper_port}/{path.lstrip("/")}'
+
+
+def get_timeout():
+    """
+    Connect and read timeouts for upstream calls. The read timeout is the longest we will wait between bytes, not
+    for the whole archive
+    :return: tuple of (connect_timeout, read_timeout) in seconds
+    """
+    connect_timeout = float(cnc_utils.get_config_value('BOOTSTRAPPER_CONNECT_TIMEOUT', '5'))
+    read_timeout = float(cnc_utils.get_config_value('BOOTSTRAPPER_READ_TIMEOUT', '300'))
+    return connect_timeout, read_timeout
+
+
+def get_session():
+    """
+    Return the process wide requests Session, building it on first use
+    :return: requests.Session
+    """
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+
+    return _session
+
+
+def _build_session():
+    """
+    Build a Session with a bounded connection pool and retries. Connection failures are always safe to retry as
+    nothing was sent, read failures and 5xx responses are only retried for idempotent methods (urllib3 default)
+    :return: requests.Session
+    """
+    pool_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_POOL_SIZE', '10'))
+    max_retries = int(cnc_utils.get_config_value('BOOTSTRAPPER_MAX_RETRIES', '3'))
+
+    retry = Retry(total=max_retries,
+                  backoff_factor=0.5,
+                  status_forcelist=(502, 503, 504),
+                  raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def post_to_bootstrapper(path, json_payload, stream=False):
+    """
+    POST a json payload to the bootstrapper service using the shared session
+    :param path: endpoint path on the bootstrapper service
+    :param json_payload: data structure to send as json
+    :param stream: do not read the response body up front, the caller must consume or close the response
+    :return: requests Response object
+    :raises requests.exceptions.RequestException: on connection failure or timeout
+    """
+    url = get_bootstrapper_url(path)
+    print(f'Using bootstrapper url: {url}')
+    with metrics_utils.upstream_seconds.labels(endpoint=path).time():
+        return get_session().post(url, json=json_payload, timeout=get_timeout(), stream=stream)
+
+
+def relay_upstream_content(resp, chunk_size):
+    """
+    Yield the body of a streamed upstream response chunk by chunk, releasing the connection back to the pool once
+    the client has consumed it (or gone away)
+    :param resp: requests Response object opened with stream=True
+    :param chunk_size: size in bytes of each chunk to relay
+    :return: generator of bytes
+    """
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        resp.close()
+
+
+def build_async_client():
+    """
+    Build an httpx AsyncClient for the bootstrapper service with the same pool size, retries and timeouts as the
+    sync session
+    :return: httpx.AsyncClient
+    """
+    # only the async views need httpx
+    import httpx
+
+    pool_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_ASYNC_POOL_SIZE', '100'))
+    max_retries = int(cnc_utils.get_config_value('BOOTSTRAPPER_MAX_RETRIES', '3'))
+    connect_timeout, read_timeout = get_timeout()
+
+    # httpx only retries failed connections, which like the sync session is always safe for a POST
+    transport = httpx.AsyncHTTPTransport(retries=max_retries,
+                                         limits=httpx.Limits(max_connections=pool_size,
+                                                             max_keepalive_connections=pool_size))
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+
+def get_async_client():
+    """
+    Return the shared httpx AsyncClient for the running event loop, building it on first use. Only used for the loop
+    an ASGI worker runs in its main thread, which lives as long as the worker
+    :return: httpx.AsyncClient
+    """
+    loop = asyncio.get_event_loop()
+    client = _async_clients.get(loop, None)
+    if client is None:
+        client = build_async_client()
+        _async_clients[loop] = client
+
+    return client
+
+
+def is_worker_loop():
+    """
+    Check if the running event loop is the one of an ASGI worker, rather than a loop runserver or async_to_sync
+    starts in another thread for a single request
+    :return: True when running in the main thread
+    """
+    return threading.current_thread() is threading.main_thread()
+
+
+async def async_fetch_archive(path, json_payload, digest, default_filename):
+    """
+    POST a json payload to the bootstrapper service without blocking the event loop. An archive response is spooled
+    to disk through the archive cache as it arrives, anything else is read into memory
+    :param path: endpoint path on the bootstrapper service
+    :param json_payload: data structure to send as json
+    :param digest: payload digest to cache the archive under, or None to only spool it
+    :param default_filename: name to use when the service does not send a Content-Disposition header
+    :return: dict with status_code, content_type and text, plus filename, archive (an open binary file) and size
+             when an archive was returned
+    :raises httpx.HTTPError: on connection failure or timeout
+    """
+    if is_worker_loop():
+        return await _fetch_archive(get_async_client(), path, json_payload, digest, default_filename)
+
+    # the loop goes away with this request, so the client and its connections must not outlive it
+    client = build_async_client()
+    try:
+        return await _fetch_archive(client, path, json_payload, digest, default_filename)
+    finally:
+        await client.aclose()
+
+
+async def _fetch_archive(client, path, json_payload, digest, default_filename):
+    url = get_bootstrapper_url(path)
+    chunk_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_CHUNK_SIZE', '65536'))
+    print(f'Using bootstrapper url: {url}')
+
+    start = time.time()
+    async with client.stream('POST', url, json=json_payload) as resp:
+        metrics_utils.upstream_seconds.labels(endpoint=path).observe(time.time() - start)
+
+        content_type = resp.headers.get('Content-Type', '')
+        result = dict(status_code=resp.status_code, content_type=content_type, text='', filename='', archive=None,
+                      size=0)
+
+        if resp.status_code != 200 or 'json' in content_type:
+            await resp.aread()
+            result['text'] = resp.text
+            return result
+
+        result['filename'] = build_utils.get_archive_filename(resp, default_filename)
+        result['archive'], result['size'] = await archive_cache_utils.spool_async_stream(
+            digest, resp.aiter_bytes(chunk_size), result['filename'], content_type)
+
+    return result
@@ -0,0 +1,110 @@
+"""
+Warm the per-process caches in the background when a worker starts, so the first user after a restart or rollout
+does not pay for them
+
+With BOOTSTRAPPER_WARMUP set to yes, a thread builds the snippet label index, reads the details of every imported
+repository, compiles the bootstrapper-payload templates and loads the django templates and modules that are otherwise
+only imported on first use. /bootstrapper/ready answers 503 until this has finished, so an orchestrator can hold back
+traffic until then. A failed step is logged and skipped, it never keeps a worker from becoming ready.
+"""
+import importlib
+import threading
+import time
+
+from pan_cnc.lib import cnc_utils
+
+_ready = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+
+# templates rendered by the bootstrapper views
+django_templates = ('pan_cnc/results.html', 'bootstrapper/upload_bootstrap.html', 'bootstrapper/fleet.html',
+                    'bootstrapper/fleet_job.html', 'bootstrapper/repos.html')
+
+
+def is_enabled():
+    return cnc_utils.get_config_value('BOOTSTRAPPER_WARMUP', 'no') == 'yes'
+
+
+def is_ready():
+    """
+    Check if this worker has finished warming up
+    :return: True once warm up has finished, or always when it is disabled
+    """
+    return not is_enabled() or _ready.is_set()
+
+
+def start_warmup(app_dir='bootstrapper'):
+    """
+    Start warming up in a background thread, once per process and only when BOOTSTRAPPER_WARMUP is yes
+    :param app_dir: name of the app, i.e. 'bootstrapper'
+    :return: None
+    """
+    global _started
+
+    if not is_enabled():
+        return
+
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    thread = threading.Thread(target=warmup, args=(app_dir,), name='bootstrapper-warmup', daemon=True)
+    thread.start()
+
+
+def warmup(app_dir):
+    start = time.time()
+    try:
+        for step in (_warm_snippet_index, _warm_repo_details, _warm_payload_templates, _warm_django_templates,
+                     _warm_modules):
+            step_start = time.time()
+            try:
+                step(app_dir)
+            except Exception as e:
+                # anything left cold is simply loaded by the first request that needs it
+                print(f'Warm up step {step.__name__} failed: {e}')
+            else:
+                print(f'Warm up step {step.__name__} took {time.time() - step_start:.3f}s')
+    finally:
+        _ready.set()
+
+    print(f'Warm up finished in {time.time() - start:.3f}s')
+
+
+def _warm_snippet_index(app_dir):
+    from bootstrapper.lib import snippet_index_utils
+
+    snippet_index_utils.get_snippets_by_label('template_category', 'panos_full')
+
+
+def _warm_repo_details(app_dir):
+    from bootstrapper.lib import repo_utils
+
+    repo_utils.get_repo_details_list(app_dir)
+
+
+def _warm_payload_templates(app_dir):
+    from bootstrapper.lib import build_utils
+    from bootstrapper.lib import template_utils
+
+    template_utils.compile_snippet_templates(build_utils.load_payload_service(app_dir))
+
+
+def _warm_django_templates(app_dir):
+    from django.template.loader import get_template
+
+    for template_name in django_templates:
+        get_template(template_name)
+
+
+def _warm_modules(app_dir):
+    # api_utils and fleet_utils import the build, archive, upload and upstream helpers the views load on first use
+    modules = ['bootstrapper.lib.api_utils', 'bootstrapper.lib.fleet_utils', 'bootstrapper.lib.repo_utils',
+               'bootstrapper.lib.snippet_index_utils', 'pan.xapi', 'git']
+    if cnc_utils.get_config_value('BOOTSTRAPPER_ASYNC_VIEWS', 'no') == 'yes':
+        modules.append('httpx')
+
+    for module in modules:
+        importlib.import_module(module)
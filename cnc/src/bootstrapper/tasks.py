@@ -0,0 +1,28 @@
+# Celery tasks for the bootstrapper app
+#
+# Only used when BOOTSTRAPPER_JOB_BROKER is set to a broker url. Start a worker alongside the cnc container with:
+#
+# celery -A bootstrapper.tasks worker
+#
+
+import os
+
+import django
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cnc.settings')
+django.setup()
+
+from pan_cnc.lib import cnc_utils  # noqa: E402
+
+from bootstrapper.lib import api_utils  # noqa: E402,F401 - registers the api build job
+from bootstrapper.lib import fleet_utils  # noqa: E402,F401 - registers the fleet build job
+from bootstrapper.lib import job_utils  # noqa: E402
+from bootstrapper.lib import repo_utils  # noqa: E402,F401 - registers the repository jobs
+
+app = Celery('bootstrapper', broker=cnc_utils.get_config_value('BOOTSTRAPPER_JOB_BROKER', 'local'))
+
+
+@app.task
+def run_job(job_id):
+    job_utils.run_job(job_id)
@@ -1,36 +1,270 @@
+import asyncio
+import functools
 import json
 import os
-import re
 import shutil
-from base64 import urlsafe_b64encode
-from pathlib import Path
 
-import requests
+from asgiref.sync import sync_to_async
 from django import forms
 from django.contrib import messages
-from django.shortcuts import HttpResponse
+from django.http import FileResponse
+from django.http import HttpResponse
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import HttpResponseRedirect
 from django.shortcuts import render
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.csrf import csrf_protect
 from django.views.generic import RedirectView
+from django.views.generic import View
 
 from pan_cnc.lib import cnc_utils
-from pan_cnc.lib import git_utils
-from pan_cnc.lib import pan_utils
-from pan_cnc.lib import snippet_utils
 from pan_cnc.lib.exceptions import TargetConnectionException
 from pan_cnc.views import CNCBaseAuth
 from pan_cnc.views import CNCBaseFormView
 from pan_cnc.views import CNCView
 
+# the build, archive, repository, upload and api helpers pull in requests, jinja2 and the snippet index, so they are
+# imported by the views that use them and a worker only loads what its requests need, see warmup_utils
+from bootstrapper.lib import blob_utils
+from bootstrapper.lib import job_utils
+from bootstrapper.lib import metrics_utils
+from bootstrapper.lib import panorama_utils
+from bootstrapper.lib import profile_utils
+from bootstrapper.lib import warmup_utils
+
+
+def stream_archive_response(resp, digest, filename, chunk_size):
+    """
+    Relay an archive from the bootstrapper service to the client as it arrives, keeping a copy in the archive cache
+    when a digest is given
+    :param resp: streamed requests Response from the bootstrapper service
+    :param digest: payload digest from archive_cache_utils.get_payload_digest or None to skip the cache
+    :param filename: filename of the archive
+    :param chunk_size: size in bytes of each chunk to relay
+    :return: StreamingHttpResponse
+    """
+    from bootstrapper.lib import archive_cache_utils
+    from bootstrapper.lib import upstream_utils
+
+    content_type = resp.headers.get('Content-Type', '')
+    streaming_content = upstream_utils.relay_upstream_content(resp, chunk_size)
+    if digest is not None:
+        streaming_content = archive_cache_utils.cache_stream(digest, streaming_content, filename, content_type)
+
+    response = StreamingHttpResponse(streaming_content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    if digest is not None:
+        response['ETag'] = archive_cache_utils.get_etag(digest)
+    # iter_content decodes any transfer compression, so the upstream length is only valid without it
+    if 'Content-Length' in resp.headers and 'Content-Encoding' not in resp.headers:
+        response['Content-Length'] = resp.headers['Content-Length']
+    return response
+
+
+def spooled_archive_response(result, digest):
+    """
+    Serve an archive that upstream_utils.async_fetch_archive has already spooled to disk, so sending it to the
+    client never waits on the bootstrapper service
+    :param result: dict returned from async_fetch_archive
+    :param digest: payload digest the archive was cached under, or None
+    :return: FileResponse
+    """
+    from bootstrapper.lib import archive_cache_utils
+
+    response = FileResponse(result['archive'], content_type=result['content_type'])
+    response['Content-Disposition'] = 'attachment; filename=%s' % result['filename']
+    response['Content-Length'] = str(result['size'])
+    if digest is not None:
+        response['ETag'] = archive_cache_utils.get_etag(digest)
+    return response
+
+
+def local_archive_response(service, context, bootstrap_ref):
+    """
+    Build an archive in process and stream it to the client as it is written
+    :param service: bootstrapper-payload snippet (service) dict
+    :param context: all variables for this device
+    :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+    :return: StreamingHttpResponse
+    :raises ValueError: if init-cfg.txt could not be compiled
+    """
+    from bootstrapper.lib import build_utils
+
+    filename, content_type, chunks = build_utils.stream_local_archive(service, context, bootstrap_ref)
+    metrics_utils.record_build(context.get('deployment_type', ''), 200, 'local')
+
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+
+def get_cache_digest(json_payload):
+    """
+    Digest to keep the archive for this payload under in the archive cache
+    :param json_payload: payload from build_utils.render_payload
+    :return: digest, or None if archives of this deployment type are not cached
+    """
+    from bootstrapper.lib import archive_cache_utils
+
+    if not archive_cache_utils.is_cacheable(json_payload.get('archive_type', '')):
+        return None
+
+    # identical payloads produce identical archives, serve them from disk if we have already built this one
+    return archive_cache_utils.get_payload_digest(json_payload)
+
+
+def cached_build_response(request, deployment_type, digest, entry):
+    from bootstrapper.lib import archive_cache_utils
+
+    print(f'Serving cached archive {entry["filename"]}')
+    metrics_utils.record_build(deployment_type, 200, 'hit')
+    return archive_cache_utils.cached_archive_response(request, digest, entry)
+
+
+def build_archive_response(request, json_payload, hostname, error_response, results_response):
+    """
+    Serve the archive for a payload from the archive cache, or request it from the bootstrapper service and relay it
+    to the client, recording the build in the metrics. Used by the workflow and the json api, which only differ in
+    how they show errors and responses that are not an archive
+    :param request: HttpRequest
+    :param json_payload: payload from build_utils.render_payload
+    :param hostname: hostname of the device, the archive filename when the service does not send one
+    :param error_response: called with the exception when the bootstrapper service could not be reached
+    :param results_response: called with the status code, content type and text of a response that is not an archive
+    :return: HttpResponse
+    """
+    import requests
+    from bootstrapper.lib import archive_cache_utils
+    from bootstrapper.lib import build_utils
+    from bootstrapper.lib import upstream_utils
+
+    deployment_type = json_payload.get('archive_type', '')
+    digest = get_cache_digest(json_payload)
+    if digest is not None:
+        entry = archive_cache_utils.get_cached_archive(digest, open_file=True)
+        if entry is not None:
+            return cached_build_response(request, deployment_type, digest, entry)
+
+    cache_status = 'none' if digest is None else 'miss'
+    try:
+        resp = upstream_utils.post_to_bootstrapper('generate_bootstrap_package', json_payload, stream=True)
+    except requests.exceptions.RequestException as rex:
+        metrics_utils.record_build(deployment_type, 'error', cache_status)
+        return error_response(rex)
+
+    metrics_utils.record_build(deployment_type, resp.status_code, cache_status)
+    content_type = resp.headers.get('Content-Type', '')
+    if resp.status_code == 200 and 'json' not in content_type:
+        # archives are relayed to the client in chunks of this size rather than buffered in the worker
+        chunk_size = int(cnc_utils.get_config_value('BOOTSTRAPPER_CHUNK_SIZE', '65536'))
+        filename = build_utils.get_archive_filename(resp, hostname)
+        return stream_archive_response(resp, digest, filename, chunk_size)
+
+    with resp:
+        return results_response(resp.status_code, content_type, resp.text)
+
+
+async def async_build_archive_response(request, json_payload, hostname, error_response, results_response):
+    """
+    Same as build_archive_response for the async views. The archive is spooled to disk before it is sent, and the
+    error_response and results_response callbacks are run in a thread
+    :return: HttpResponse
+    """
+    import httpx
+    from bootstrapper.lib import archive_cache_utils
+    from bootstrapper.lib import upstream_utils
+
+    deployment_type = json_payload.get('archive_type', '')
+    digest = get_cache_digest(json_payload)
+    if digest is not None:
+        entry = await sync_to_async(archive_cache_utils.get_cached_archive, thread_sensitive=False)(digest, True)
+        if entry is not None:
+            return cached_build_response(request, deployment_type, digest, entry)
+
+    cache_status = 'none' if digest is None else 'miss'
+    try:
+        result = await upstream_utils.async_fetch_archive('generate_bootstrap_package', json_payload, digest,
+                                                          hostname)
+    except httpx.HTTPError as he:
+        metrics_utils.record_build(deployment_type, 'error', cache_status)
+        return await sync_to_async(error_response)(he)
+
+    metrics_utils.record_build(deployment_type, result['status_code'], cache_status)
+    if result['archive'] is None:
+        return await sync_to_async(results_response)(result['status_code'], result['content_type'], result['text'])
+
+    return spooled_archive_response(result, digest)
+
+
+class AsyncViewMixin:
+    """
+    Serve the view as an async function when BOOTSTRAPPER_ASYNC_VIEWS is set to yes. The view itself, including the
+    form and session handling in pan_cnc, still runs synchronously in a thread, but a form_valid that waits on the
+    network may return a coroutine, which is then awaited on the event loop instead of holding a worker thread
+    """
+    async_enabled = False
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        if cnc_utils.get_config_value('BOOTSTRAPPER_ASYNC_VIEWS', 'no') != 'yes':
+            return super().as_view(**initkwargs)
+
+        view = super().as_view(async_enabled=True, **initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            response = await sync_to_async(view)(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        functools.update_wrapper(async_view, view)
+        return async_view
+
+
+class ProfiledViewMixin:
+    """
+    Run the request under cProfile when a staff user asks for it, see profile_utils
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not profile_utils.should_profile(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        return profile_utils.run_profiled(type(self).__name__, request, super().dispatch, request, *args, **kwargs)
+
+
+class SnippetCacheMixin:
+    """
+    Clear the pan_cnc snippet caches of this process before the view loads any snippet, if a repository job in any
+    process has changed the imported repositories since, see repo_utils.refresh_snippet_caches
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        from bootstrapper.lib import repo_utils
+
+        repo_utils.refresh_snippet_caches(self.app_dir)
+        return super().dispatch(request, *args, **kwargs)
 
-class BootstrapWorkflowView(CNCBaseFormView):
+
+class BootstrapWorkflowView(ProfiledViewMixin, SnippetCacheMixin, CNCBaseFormView):
     snippet = 'bootstrapper-payload'
+    app_dir = 'bootstrapper'
     header = 'Build Bootstrap Archive'
     title = 'Deployment Information'
-    fields_to_render = ['hostname', 'include_panorama', 'deployment_type']
+    fields_to_render = ['hostname', 'include_panorama', 'deployment_type', 'include_dynamic_content']
 
     def form_valid(self, form):
+        from bootstrapper.lib import archive_utils
+        from bootstrapper.lib import build_utils
+
         deployment_type = self.get_value_from_workflow('deployment_type', '')
+        if self.get_value_from_workflow('include_dynamic_content', 'no') == 'yes' \
+                and not archive_utils.is_local(deployment_type):
+            messages.add_message(self.request, messages.ERROR, build_utils.get_dynamic_content_error(deployment_type))
+            return HttpResponseRedirect('build')
+
         if deployment_type in ['s3', 'azure', 'gcp']:
             return HttpResponseRedirect('cloud_auth')
 
@@ -110,31 +344,46 @@ class GetCloudAuthView(BootstrapWorkflowView):
             return HttpResponseRedirect('choose_bootstrap')
 
 
-class BootstrapStep03View(BootstrapWorkflowView):
+class BootstrapStep03View(AsyncViewMixin, BootstrapWorkflowView):
     title = 'Configure Panorama Server'
     fields_to_render = ['panorama_ip', 'panorama_user', 'panorama_password']
 
     def form_valid(self, form):
+        if self.async_enabled:
+            return self.async_form_valid(form)
+
+        try:
+            vm_auth_key = panorama_utils.get_vm_auth_key(*self.get_panorama_credentials())
+        except TargetConnectionException:
+            return self.panorama_error()
+
+        return self.save_vm_auth_key(vm_auth_key)
+
+    async def async_form_valid(self, form):
+        credentials = await sync_to_async(self.get_panorama_credentials)()
+        try:
+            # pan.xapi is blocking, run it in the shared thread pool so a slow Panorama only ties up that thread
+            vm_auth_key = await sync_to_async(panorama_utils.get_vm_auth_key, thread_sensitive=False)(*credentials)
+        except TargetConnectionException:
+            return await sync_to_async(self.panorama_error)()
+
+        return await sync_to_async(self.save_vm_auth_key)(vm_auth_key)
+
+    def get_panorama_credentials(self):
         target_ip = self.get_value_from_workflow('panorama_ip', '')
         target_username = self.get_value_from_workflow('panorama_user', '')
         target_password = self.get_value_from_workflow('panorama_password', '')
-        p = pan_utils.panos_login(target_ip, target_username, target_password)
-        if p is None:
-            results = dict()
-            results['results'] = 'Error, Could not contact Panorama'
-            return render(self.request, 'pan_cnc/results.html', context=results)
-        try:
-            r = pan_utils.get_vm_auth_key_from_panorama()
-        except TargetConnectionException:
-            print('Could not get vm auth key from panorama')
-            messages.add_message(self.request, messages.ERROR, 'Could not contact Panorama!')
-            results = dict()
-            results['results'] = 'Error, Could not contact Panorama'
-            return render(self.request, 'pan_cnc/results.html', context=results)
-
-        matches = re.match('VM auth key (.*?) ', r)
-        if matches:
-            vm_auth_key = matches[1]
+        return target_ip, target_username, target_password
+
+    def panorama_error(self):
+        print('Could not get vm auth key from panorama')
+        messages.add_message(self.request, messages.ERROR, 'Could not contact Panorama!')
+        results = dict()
+        results['results'] = 'Error, Could not contact Panorama'
+        return render(self.request, 'pan_cnc/results.html', context=results)
+
+    def save_vm_auth_key(self, vm_auth_key):
+        if vm_auth_key is not None:
             print(vm_auth_key)
             self.save_value_to_workflow('vm_auth_key', vm_auth_key)
         else:
@@ -183,26 +432,24 @@ class ChooseBootstrapXmlView(BootstrapWorkflowView):
         return self.form_valid(form)
 
     def generate_dynamic_form(self, data=None):
+        from bootstrapper.lib import build_utils
+
         dynamic_form = forms.Form()
 
-        # load all templates that report that they are a full panos configuration
-        bs_templates = snippet_utils.load_snippets_by_label('template_category', 'panos_full', self.app_dir)
+        # load all templates that report that they are a full panos configuration, except any whose names conflict
+        # with our choices here, the api and fleet builds only accept the same templates
+        bs_templates = build_utils.get_bootstrap_templates()
 
         choices_list = list()
         # grab each bootstrap template and construct a simple tuple with name and label, append to the list
         for bst in bs_templates:
-            if bst['name'] == 'upload' or bst['name'] == 'default':
-                # do not allow template names that conflict with our choices here
-                # do not allow sneaky stuff!
-                continue
-
             choice = (bst['name'], bst['label'])
             choices_list.append(choice)
 
         # let's sort the list by the label attribute (index 1 in the tuple)
         choices_list = sorted(choices_list, key=lambda k: k[1])
         choices_list.insert(0, ('none', 'Do not include a bootstrap'))
-        choices_list.insert(1, ('bootstrap_xml', 'Use Default Bootstrap'))
+        choices_list.insert(1, (build_utils.default_bootstrap_name, 'Use Default Bootstrap'))
         choices_list.insert(2, ('upload', 'Upload Custom Bootstrap'))
 
         dynamic_form.fields['custom_bootstrap'] = forms.ChoiceField(label='Custom Bootstrap',
@@ -225,16 +472,17 @@ class ChooseBootstrapXmlView(BootstrapWorkflowView):
         if cb == 'upload':
             return HttpResponseRedirect('upload_bootstrap')
         elif cb == 'none':
-            self.save_value_to_workflow('bootstrap_string', '')
+            self.save_value_to_workflow('bootstrap_ref', '')
             return HttpResponseRedirect('complete')
         else:
             # custom bootstrap is set to some other value from a snippet
             return HttpResponseRedirect('configure_bootstrap')
 
 
-class ConfigureBootstrapView(CNCBaseFormView):
+class ConfigureBootstrapView(ProfiledViewMixin, SnippetCacheMixin, CNCBaseFormView):
     title = 'Configure Custom Bootstrap'
     header = 'Build bootstrap Archive'
+    app_dir = 'bootstrapper'
     fields_to_filter = ['hostname', 'FW_NAME']
 
     def get_snippet(self):
@@ -243,6 +491,8 @@ class ConfigureBootstrapView(CNCBaseFormView):
         return self.snippet
 
     def form_valid(self, form):
+        from bootstrapper.lib import template_utils
+
         context = self.get_snippet_context()
 
         # special case to hide FW_NAME field from iron-skillet
@@ -250,18 +500,29 @@ class ConfigureBootstrapView(CNCBaseFormView):
             if context['FW_NAME'] != context['hostname']:
                 context['FW_NAME'] = context['hostname']
 
-        bs = snippet_utils.render_snippet_template(self.service, self.app_dir, context)
+        bs = template_utils.render_snippet_template(self.service, context)
         if bs is not None:
-            bsb = bytes(bs, 'utf-8')
-            encoded_bootstrap_string = urlsafe_b64encode(bsb)
-            self.save_value_to_workflow('bootstrap_string', encoded_bootstrap_string.decode('utf-8'))
+            # keep the rendered config out of the session, the workflow only holds a small reference to it
+            self.save_value_to_workflow('bootstrap_ref', blob_utils.put_bytes(bytes(bs, 'utf-8')))
 
         return HttpResponseRedirect('complete')
 
 
+@method_decorator(csrf_exempt, name='dispatch')
 class UploadBootstrapView(BootstrapWorkflowView):
     title = 'Upload Custom Bootstrap.xml'
+    template_name = 'bootstrapper/upload_bootstrap.html'
     fields_to_render = []
+    upload_limit_handler = None
+
+    def dispatch(self, request, *args, **kwargs):
+        from bootstrapper.lib import upload_utils
+
+        # upload handlers can only be changed before the body is read, so the csrf check is done here instead of
+        # in the middleware, which would read the whole upload first
+        self.upload_limit_handler = upload_utils.UploadSizeLimitHandler(request)
+        request.upload_handlers.insert(0, self.upload_limit_handler)
+        return csrf_protect(super().dispatch)(request, *args, **kwargs)
 
     # override the post method as we do not have a snippet defined...
     def post(self, request, *args, **kwargs):
@@ -270,96 +531,234 @@ class UploadBootstrapView(BootstrapWorkflowView):
 
     def generate_dynamic_form(self, data=None):
         dynamic_form = forms.Form()
+        dynamic_form.fields['bootstrap_file'] = forms.FileField(label='Bootstrap XML File', required=False)
         dynamic_form.fields['bootstrap_string'] = forms.CharField(widget=forms.Textarea,
-                                                                  label='Bootstrap XML Contents',
-                                                                  initial='<xml></xml>')
+                                                                  label='Or Paste Bootstrap XML Contents',
+                                                                  required=False)
         return dynamic_form
 
     def form_valid(self, form):
+        from bootstrapper.lib import upload_utils
+
+        if self.upload_limit_handler is not None and self.upload_limit_handler.too_large:
+            max_mb = upload_utils.get_max_upload_bytes() // (1024 * 1024)
+            messages.add_message(self.request, messages.ERROR, f'Bootstrap file is larger than {max_mb}MB')
+            return HttpResponseRedirect('upload_bootstrap')
+
+        upload = self.request.FILES.get('bootstrap_file', None)
         bs = self.request.POST.get('bootstrap_string', '')
-        if bs != '':
-            bsb = bytes(bs, 'utf-8')
-            encoded_bootstrap_string = urlsafe_b64encode(bsb)
-            self.save_value_to_workflow('bootstrap_string', encoded_bootstrap_string.decode('utf-8'))
+        try:
+            if upload is not None:
+                bootstrap_ref = upload_utils.store_bootstrap(upload.chunks())
+            elif bs.strip() != '':
+                bootstrap_ref = upload_utils.store_bootstrap([bytes(bs, 'utf-8')])
+            else:
+                messages.add_message(self.request, messages.ERROR, 'Upload a bootstrap file or paste its contents')
+                return HttpResponseRedirect('upload_bootstrap')
+
+        except ValueError as ve:
+            print(f'Rejected uploaded bootstrap: {ve}')
+            messages.add_message(self.request, messages.ERROR, str(ve))
+            return HttpResponseRedirect('upload_bootstrap')
+
+        self.save_value_to_workflow('bootstrap_ref', bootstrap_ref)
         return HttpResponseRedirect('complete')
 
 
-class CompleteWorkflowView(BootstrapWorkflowView):
+class CompleteWorkflowView(AsyncViewMixin, BootstrapWorkflowView):
     title = 'License Firewall with Auth Code'
     fields_to_render = ['auth_key']
 
     def form_valid(self, form):
+        if self.async_enabled:
+            return self.async_form_valid(form)
+
+        # the context is collected once and used for both the local and the remote build
+        payload_context, bootstrap_ref = self.get_build_context()
+        local_response = self.get_local_response(payload_context, bootstrap_ref)
+        if local_response is not None:
+            return local_response
+
+        try:
+            json_payload, hostname = self.get_build_payload(payload_context, bootstrap_ref)
+        except ValueError as ve:
+            return self.payload_error(ve)
+        except FileNotFoundError:
+            return self.bootstrap_missing()
+
+        return build_archive_response(self.request, json_payload, hostname, self.upstream_error,
+                                      self.results_response)
+
+    async def async_form_valid(self, form):
+        payload_context, bootstrap_ref = await sync_to_async(self.get_build_context)()
+        local_response = await sync_to_async(self.get_local_response)(payload_context, bootstrap_ref)
+        if local_response is not None:
+            return local_response
+
+        try:
+            json_payload, hostname = await sync_to_async(self.get_build_payload)(payload_context, bootstrap_ref)
+        except ValueError as ve:
+            return await sync_to_async(self.payload_error)(ve)
+        except FileNotFoundError:
+            return await sync_to_async(self.bootstrap_missing)()
+
+        return await async_build_archive_response(self.request, json_payload, hostname, self.upstream_error,
+                                                  self.results_response)
+
+    def get_build_context(self):
+        """
+        Collect the values saved to the workflow by all previous steps
+        :return: tuple of the full context and the blob reference of the bootstrap.xml to include
+        """
         context = self.get_snippet_context()
 
-        if 'panorama_ip' not in context and 'TARGET_IP' in context:
-            print('Setting panorama ip on context')
-            context['panorama_ip'] = context['TARGET_IP']
-
-        print('Compiling init-cfg.txt')
-        ic = snippet_utils.render_snippet_template(self.service, self.app_dir, context, 'init_cfg.txt')
-        print(ic)
-        if ic is not None:
-            icb = bytes(ic, 'utf-8')
-            encoded_init_cfg_string = urlsafe_b64encode(icb)
-            self.save_value_to_workflow('init_cfg_string', encoded_init_cfg_string.decode('utf-8'))
-
-        payload = self.render_snippet_template()
-
-        # get the bootstrapper host and port from the .panrc file, environrment, or default name lookup
-        # docker-compose will host bootstrapper under the 'bootstrapper' domain name
-        bootstrapper_host = cnc_utils.get_config_value('BOOTSTRAPPER_HOST', 'bootstrapper')
-        bootstrapper_port = cnc_utils.get_config_value('BOOTSTRAPPER_PORT', '5000')
-        print(f'Using bootstrapper_host: {bootstrapper_host}')
-        print(f'Using bootstrapper_port: {bootstrapper_port}')
+        # values saved to the workflow by earlier steps are needed too, such as vm_auth_key
+        payload_context = dict(self.get_workflow())
+        payload_context.update(context)
+        return payload_context, self.get_value_from_workflow('bootstrap_ref', '')
+
+    def get_local_response(self, payload_context, bootstrap_ref):
+        """
+        Build the archive in process for the deployment types in BOOTSTRAPPER_LOCAL_ARCHIVE_TYPES
+        :param payload_context: full context from get_build_context
+        :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+        :return: response, or None if the bootstrapper service builds this deployment type
+        """
+        from bootstrapper.lib import archive_utils
+
+        if not archive_utils.is_local(payload_context.get('deployment_type', '')):
+            return None
+
+        print('Building archive locally')
         try:
-            json_payload = json.loads(payload)
-            print('Using payload: %s' % payload)
-        except json.decoder.JSONDecodeError as je:
-            print(f'Could not encode payload! {je}')
-            messages.add_message(self.request, messages.ERROR, 'Could not Encode payload for Bootstrapper Service')
-            return HttpResponseRedirect('error')
-
-        resp = requests.post(f'http://{bootstrapper_host}:{bootstrapper_port}/generate_bootstrap_package',
-                             json=json_payload
-                             )
-        content_type = ''
-        if 'Content-Type' in resp.headers:
-            content_type = resp.headers['Content-Type']
-        if 'Content-Disposition' in resp.headers:
-            filename = resp.headers['Content-Disposition'].split('=')[1]
-        else:
-            filename = context.get('hostname')
-
-        print(resp.headers)
-        if resp.status_code == 200:
-            if 'json' in content_type:
-                return_json = resp.json()
-                if 'response' in return_json:
-                    result_text = return_json["response"]
-                else:
-                    result_text = resp.text
-
-                results = dict()
-                results['results'] = str(resp.status_code)
-                results['results'] += '\n'
-                results['results'] += result_text
-                return render(self.request, 'pan_cnc/results.html', context=results)
+            return local_archive_response(self.service, payload_context, bootstrap_ref)
+        except ValueError as ve:
+            return self.payload_error(ve)
+        except FileNotFoundError:
+            return self.bootstrap_missing()
 
-            else:
-                response = HttpResponse(content_type=content_type)
-                response['Content-Disposition'] = 'attachment; filename=%s' % filename
-                response.write(resp.content)
-                return response
-        else:
-            results = super().get_context_data()
-            results['results'] = str(resp.status_code)
-            results['results'] += '\n'
-            results['results'] += resp.text
+    def get_build_payload(self, payload_context, bootstrap_ref):
+        """
+        Compile the payload from the values saved to the workflow by all previous steps
+        :param payload_context: full context from get_build_context
+        :param bootstrap_ref: blob reference of the bootstrap.xml to include, if any
+        :return: tuple of payload data structure and the hostname
+        :raises ValueError: if the payload could not be compiled
+        """
+        from bootstrapper.lib import build_utils
+
+        print('Compiling init-cfg.txt and payload')
+        json_payload = build_utils.render_payload(self.service, self.app_dir, payload_context, bootstrap_ref)
+        return json_payload, payload_context.get('hostname')
+
+    def payload_error(self, error):
+        print(f'Could not encode payload! {error}')
+        messages.add_message(self.request, messages.ERROR,
+                             f'Could not Encode payload for Bootstrapper Service: {error}')
+        return HttpResponseRedirect('error')
+
+    def bootstrap_missing(self):
+        # the bootstrap.xml chosen earlier was not used for BOOTSTRAPPER_BLOB_MAX_AGE and has been pruned
+        print('Bootstrap blob of this workflow has been removed')
+        self.save_value_to_workflow('bootstrap_ref', '')
+        messages.add_message(self.request, messages.ERROR,
+                             'The chosen bootstrap.xml has expired, please choose it again')
+        return HttpResponseRedirect('choose_bootstrap')
+
+    def upstream_error(self, error):
+        print(f'Could not contact bootstrapper service! {error}')
+        messages.add_message(self.request, messages.ERROR, 'Could not contact Bootstrapper Service')
+        results = super().get_context_data()
+        results['results'] = 'Error, Could not contact Bootstrapper Service'
+        return render(self.request, 'pan_cnc/results.html', context=results)
+
+    def results_response(self, status_code, content_type, text):
+        """
+        Show the response from the bootstrapper service when it did not return an archive, i.e. for cloud
+        deployment types or on error
+        """
+        result_text = text
+        if status_code == 200 and 'json' in content_type:
+            try:
+                result_text = json.loads(text).get('response', text)
+            except ValueError:
+                pass
+
+        results = super().get_context_data()
+        results['results'] = str(status_code)
+        results['results'] += '\n'
+        results['results'] += result_text
+        return render(self.request, 'pan_cnc/results.html', context=results)
+
+
+class FleetBuildView(CNCView):
+    """
+    Build bootstrap archives for many devices at once from an uploaded CSV or YAML inventory file
+    """
+    template_name = 'bootstrapper/fleet.html'
+    app_dir = 'bootstrapper'
+
+    def post(self, request, *args, **kwargs):
+        # fleet builds are rare, so the inventory parsers are only loaded when one is started
+        from bootstrapper.lib import fleet_utils
+
+        inventory = request.FILES.get('inventory', None)
+        if inventory is None:
+            messages.add_message(request, messages.ERROR, 'Please choose an inventory file')
+            return HttpResponseRedirect('fleet')
+
+        try:
+            job_id, device_count = fleet_utils.submit_fleet(inventory, inventory.name)
+        except ValueError as ve:
+            print(f'Could not load inventory: {ve}')
+            messages.add_message(request, messages.ERROR, str(ve))
+            return HttpResponseRedirect('fleet')
+
+        messages.add_message(request, messages.INFO, f'Building archives for {device_count} devices')
+        return HttpResponseRedirect(f'/bootstrapper/fleet_job/{job_id}')
+
+
+class FleetJobView(CNCView):
+    """
+    Show the progress of a fleet build job, or return the finished zip with ?download=yes
+    """
+    template_name = 'bootstrapper/fleet_job.html'
+    app_dir = 'bootstrapper'
+
+    job = None
+
+    def get(self, request, *args, **kwargs):
+        # loaded on first use like in FleetBuildView
+        from bootstrapper.lib import fleet_utils
+
+        job = job_utils.get_job(kwargs.get('job_id', ''))
+        if job is None or job['name'] != 'build_fleet':
+            messages.add_message(request, messages.ERROR, 'Fleet build not found')
+            return HttpResponseRedirect('/bootstrapper/fleet')
+
+        if request.GET.get('download', 'no') != 'yes':
+            self.job = job
+            return super().get(request, *args, **kwargs)
+
+        fleet_id = job.get('details', dict()).get('fleet_id', None)
+        try:
+            if fleet_id is None:
+                raise FileNotFoundError(job['id'])
+            fleet_zip = open(fleet_utils.get_fleet_path(fleet_id), 'rb')
+        except FileNotFoundError:
+            messages.add_message(request, messages.ERROR, 'The archives of this fleet build are not available')
+            return HttpResponseRedirect(f'/bootstrapper/fleet_job/{job["id"]}')
+
+        return FileResponse(fleet_zip, as_attachment=True, filename='bootstrap_fleet.zip',
+                            content_type='application/zip')
 
-            return render(self.request, 'pan_cnc/results.html', context=results)
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['job'] = self.job
+        return context
 
 
-class ImportGitRepoView(CNCBaseFormView):
+class ImportGitRepoView(ProfiledViewMixin, SnippetCacheMixin, CNCBaseFormView):
     # define initial dynamic form from this snippet metadata
     snippet = 'import_repo'
     app_dir = 'bootstrapper'
@@ -377,36 +776,20 @@ class ImportGitRepoView(CNCBaseFormView):
         url = workflow.get('url')
         branch = workflow.get('branch')
         repo_name = workflow.get('repo_name')
+        shallow = workflow.get('shallow_clone', 'yes')
+        sparse = workflow.get('sparse_checkout', 'no')
         # FIXME - Ensure repo_name is unique
 
-        # we are going to keep the snippets in the snippets dir in the panhandler app
-        # get the dir where all apps are installed
-        # src_dir = settings.SRC_PATH
-        # get the panhandler app dir
-        # panhandler_dir = os.path.join(src_dir, self.app_dir)
-        # get the snippets dir under that
-        # snippets_dir = os.path.join(panhandler_dir, 'snippets')
-        # figure out what our new repo / snippet dir will be
-        snippets_dir = os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'repositories')
-        new_repo_snippets_dir = os.path.join(snippets_dir, repo_name)
-
-        # where to clone from
-        clone_url = url
-        if 'github' in url.lower():
-            details = git_utils.get_repo_upstream_details(repo_name, url, self.app_dir)
-            if 'clone_url' in details:
-                clone_url = details['clone_url']
-
-        if not git_utils.clone_repo(new_repo_snippets_dir, repo_name, clone_url, branch):
-            messages.add_message(self.request, messages.ERROR, 'Could not Import Repository')
-        else:
-            print('Invalidating snippet cache')
-            snippet_utils.invalidate_snippet_caches(self.app_dir)
-            cnc_utils.clear_long_term_cache(self.app_dir)
+        if sparse == 'yes' and shallow != 'yes':
+            messages.add_message(self.request, messages.ERROR,
+                                 'Checking out only the template directories needs the latest commit clone mode')
+            return HttpResponseRedirect('/bootstrapper/import')
 
-            messages.add_message(self.request, messages.INFO, 'Imported Repository Successfully')
+        # cloning large repositories can take minutes, do it in the background and let the repos page poll for it
+        job_utils.submit_job('import_repo', repo_name, repo_name=repo_name, url=url, branch=branch,
+                             app_dir=self.app_dir, shallow=shallow, sparse=sparse)
+        messages.add_message(self.request, messages.INFO, f'Importing Repository {repo_name}')
 
-        # return render(self.request, 'pan_cnc/results.html', context)
         return HttpResponseRedirect('/bootstrapper/repos')
 
 
@@ -427,15 +810,22 @@ class UpdateGitRepoView(CNCBaseAuth, RedirectView):
 
         repo_dir = os.path.join(snippets_dir, repo_name)
 
-        msg = git_utils.update_repo(repo_dir)
-        if 'Error' in msg:
-            level = messages.ERROR
+        if os.path.exists(repo_dir):
+            job_utils.submit_job('update_repo', repo_name, repo_name=repo_name)
+            messages.add_message(self.request, messages.INFO, f'Updating Repository {repo_name}')
         else:
-            print('Invalidating snippet cache')
-            snippet_utils.invalidate_snippet_caches(self.app_dir)
-            level = messages.INFO
+            messages.add_message(self.request, messages.ERROR, f'Repository {repo_name} not found')
+
+        return self.next_url
+
+
+class UpdateAllGitReposView(CNCBaseAuth, RedirectView):
+    next_url = '/bootstrapper/repos'
+    app_dir = 'bootstrapper'
 
-        messages.add_message(self.request, level, msg)
+    def get_redirect_url(self, *args, **kwargs):
+        job_utils.submit_job('update_all_repos', 'all', lock_name='update_all_repos')
+        messages.add_message(self.request, messages.INFO, 'Updating all Repositories')
         return self.next_url
 
 
@@ -455,42 +845,186 @@ class RemoveGitRepoView(CNCBaseAuth, RedirectView):
         repo_dir = os.path.abspath(os.path.join(snippets_dir, repo_name))
 
         if snippets_dir in repo_dir:
-            print(f'Removing repo {repo_name}')
-            print('Invalidating snippet cache')
-            snippet_utils.invalidate_snippet_caches(self.app_dir)
-            shutil.rmtree(repo_dir)
+            from bootstrapper.lib import repo_utils
+            from bootstrapper.lib import snippet_index_utils
+
+            # never wait here for a clone or update of this repo, that can take minutes
+            try:
+                with job_utils.repo_lock(repo_name, blocking=False):
+                    print(f'Removing repo {repo_name}')
+                    shutil.rmtree(repo_dir)
+                    snippet_index_utils.remove_repository(repo_name)
+                    repo_utils.mark_snippets_changed()
+            except BlockingIOError:
+                messages.add_message(self.request, messages.ERROR,
+                                     f'Repository {repo_name} is busy, try again once its update has finished')
+                return self.next_url
 
-        cnc_utils.clear_long_term_cache(self.app_dir)
         messages.add_message(self.request, messages.SUCCESS, 'Repo Successfully Removed')
         return self.next_url
 
 
-class ListGitReposView(CNCView):
+class ListGitReposView(SnippetCacheMixin, CNCView):
     template_name = 'bootstrapper/repos.html'
     app_dir = 'bootstrapper'
 
     def get_context_data(self, **kwargs):
+        from bootstrapper.lib import repo_utils
 
         context = super().get_context_data(**kwargs)
-        # snippets_dir = Path(os.path.join(settings.SRC_PATH, self.app_dir, 'snippets'))
-        snippets_dir = Path(os.path.join(os.path.expanduser('~/.pan_cnc'), 'bootstrapper', 'repositories'))
+        context['jobs'] = self.finalize_repo_jobs()
+        context['repos'] = repo_utils.get_repo_details_list(self.app_dir)
+        return context
 
-        repos = cnc_utils.get_long_term_cached_value(self.app_dir, 'imported_repositories')
-        if repos is not None:
-            context['repos'] = repos
-        else:
-            repos = list()
-            for d in snippets_dir.iterdir():
-                git_dir = d.joinpath('.git')
-                if git_dir.exists() and git_dir.is_dir():
-                    repo_detail = git_utils.get_repo_details(d.name, d, self.app_dir)
-                    repos.append(repo_detail)
-                    continue
-
-            # cache the repos list for 1 week. this will be cleared when we import a new repository or otherwise
-            # change the repo list somehow
-            cnc_utils.set_long_term_cached_value(self.app_dir, 'imported_repositories', repos, 604800,
-                                                 'imported_git_repos')
-            context['repos'] = repos
+    def finalize_repo_jobs(self):
+        """
+        Report the result of finished repository jobs. Each finished job is only reported once
+        :return: list of repository jobs that are still pending or running
+        """
+        from bootstrapper.lib import repo_utils
 
-        return context
+        active_jobs = list()
+        for job in job_utils.list_jobs():
+            if job['name'] not in repo_utils.repo_job_names:
+                continue
+
+            if job['status'] in ('pending', 'running'):
+                active_jobs.append(job)
+                continue
+
+            if not job_utils.claim_finalize(job['id']):
+                continue
+
+            level = messages.INFO if job['status'] == 'success' else messages.ERROR
+
+            messages.add_message(self.request, level, job['message'])
+
+        return active_jobs
+
+
+class JobStatusView(CNCBaseAuth, View):
+    """
+    Report the state of a background job as json, polled from the repositories page
+    """
+
+    def get(self, request, *args, **kwargs):
+        job = job_utils.get_job(kwargs.get('job_id', ''))
+        if job is None:
+            return JsonResponse({'status': 'unknown', 'message': 'Job not found'}, status=404)
+
+        return JsonResponse({k: job[k] for k in ('id', 'name', 'repo_name', 'status', 'message')})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ApiBuildView(AsyncViewMixin, View):
+    """
+    Build an archive from a single json request authenticated with BOOTSTRAPPER_API_TOKEN. Returns the archive
+    directly, or a job id when 'async' is set
+    """
+    app_dir = 'bootstrapper'
+
+    def post(self, request, *args, **kwargs):
+        from bootstrapper.lib import api_utils
+        from bootstrapper.lib import archive_utils
+        from bootstrapper.lib import build_utils
+
+        if not api_utils.is_authorized(request):
+            return JsonResponse({'status': 'error', 'message': 'Not authorized'}, status=401)
+
+        try:
+            service = build_utils.load_payload_service(self.app_dir)
+            variables, bootstrap_xml, run_async = api_utils.parse_build_request(service, request.body)
+            context, bootstrap_ref = api_utils.prepare_build_request(service, self.app_dir, variables, bootstrap_xml)
+            if not run_async and archive_utils.is_local(context.get('deployment_type', '')):
+                return local_archive_response(service, context, bootstrap_ref)
+
+            json_payload = build_utils.render_payload(service, self.app_dir, context, bootstrap_ref)
+        except ValueError as ve:
+            return JsonResponse({'status': 'error', 'message': str(ve)}, status=400)
+        except TargetConnectionException as tce:
+            return JsonResponse({'status': 'error', 'message': f'Could not contact Panorama: {tce}'}, status=502)
+
+        hostname = context.get('hostname', '')
+        if run_async:
+            job_id = api_utils.submit_build(json_payload, hostname)
+            return JsonResponse({'status': 'pending', 'job_id': job_id, 'job_url': f'/bootstrapper/api_job/{job_id}'},
+                                status=202)
+
+        if self.async_enabled:
+            return async_build_archive_response(request, json_payload, hostname, self.upstream_error,
+                                                self.results_response)
+
+        return build_archive_response(request, json_payload, hostname, self.upstream_error, self.results_response)
+
+    @staticmethod
+    def upstream_error(error):
+        return JsonResponse({'status': 'error', 'message': f'Could not contact Bootstrapper Service: {error}'},
+                            status=502)
+
+    @staticmethod
+    def results_response(status_code, content_type, text):
+        if status_code != 200:
+            return JsonResponse({'status': 'error', 'message': text}, status=502)
+
+        return JsonResponse({'status': 'success', 'message': json.loads(text).get('response', text)})
+
+
+class ApiJobView(View):
+    """
+    Report the state of an api build job as json, or return the finished archive with ?download=yes
+    """
+
+    def get(self, request, *args, **kwargs):
+        from bootstrapper.lib import api_utils
+        from bootstrapper.lib import archive_cache_utils
+
+        if not api_utils.is_authorized(request):
+            return JsonResponse({'status': 'error', 'message': 'Not authorized'}, status=401)
+
+        job = job_utils.get_job(kwargs.get('job_id', ''))
+        if job is None or job['name'] != 'build_archive':
+            return JsonResponse({'status': 'unknown', 'message': 'Job not found'}, status=404)
+
+        result = {k: job[k] for k in ('id', 'status', 'message')}
+        digest = job.get('details', dict()).get('digest', None)
+        if digest is None:
+            return JsonResponse(result)
+
+        result['download_url'] = f'/bootstrapper/api_job/{job["id"]}?download=yes'
+        if request.GET.get('download', 'no') != 'yes':
+            return JsonResponse(result)
+
+        entry = archive_cache_utils.get_cached_archive(digest, open_file=True)
+        if entry is None:
+            return JsonResponse({'status': 'error', 'message': 'Archive has been removed from the cache'}, status=410)
+
+        return archive_cache_utils.cached_archive_response(request, digest, entry)
+
+
+class MetricsView(View):
+    """
+    Expose build and stage timing metrics in the prometheus text format, to scrapers that send
+    BOOTSTRAPPER_METRICS_TOKEN
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not metrics_utils.is_authorized(request):
+            return JsonResponse({'status': 'error', 'message': 'Not authorized'}, status=401)
+
+        body, content_type = metrics_utils.get_metrics()
+        return HttpResponse(body, content_type=content_type)
+
+
+class ReadyView(View):
+    """
+    Readiness check, answers 503 until this worker has finished warming up its caches
+    """
+    app_dir = 'bootstrapper'
+
+    def get(self, request, *args, **kwargs):
+        # the development server does not load asgi.py, so warm up is started by the first check instead
+        warmup_utils.start_warmup(self.app_dir)
+        if not warmup_utils.is_ready():
+            return JsonResponse({'status': 'warming'}, status=503)
+
+        return JsonResponse({'status': 'ready'})
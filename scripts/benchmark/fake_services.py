@@ -0,0 +1,248 @@
+# Local stand-ins for the panos-bootstrapper service, the Panorama XML API and a content update server
+#
+# Used by run_benchmark.py so the cnc app can be load tested without a bootstrapper container or a real Panorama.
+# Can also be run on its own to point a development instance at:
+#
+# python ./fake_services.py --bootstrapper-port 5000 --panorama-port 8080 --archive-size 1048576 --delay 0.2
+#
+# then run the cnc app with BOOTSTRAPPER_HOST=127.0.0.1 PANORAMA_PORT=8080 PANORAMA_USE_HTTP=yes
+#
+# The update server serves content packages such as /panupv2-all-contents-8213-5678 and honours Range requests, to
+# try the content store with content_store.py download http://127.0.0.1:8081/panupv2-all-contents-8213-5678
+#
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+# deployment types where the real service uploads the archive itself and only returns a status message
+cloud_types = ('s3', 'azure', 'gcp')
+
+archive_extensions = {
+    'tgz': ('tar.gz', 'application/gzip'),
+    'encoded_tgz': ('tar.gz.b64', 'application/octet-stream'),
+    'iso': ('iso', 'application/octet-stream'),
+    'zip': ('zip', 'application/zip'),
+}
+
+chunk_size = 64 * 1024
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBootstrapperHandler(BaseHTTPRequestHandler):
+    """
+    Answers /generate_bootstrap_package with an archive of archive_size bytes after waiting delay seconds
+    """
+    archive_size = 1024 * 1024
+    delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        body = self.rfile.read(length)
+        if urlparse(self.path).path != '/generate_bootstrap_package':
+            self.send_error(404)
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_error(400, 'Payload is not json')
+            return
+
+        time.sleep(self.delay)
+        archive_type = payload.get('archive_type', 'tgz')
+        hostname = payload.get('hostname', 'panos-01')
+
+        if archive_type in cloud_types:
+            data = json.dumps({'response': f'Uploaded {hostname} to {archive_type}'}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        extension, content_type = archive_extensions.get(archive_type, ('bin', 'application/octet-stream'))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(self.archive_size))
+        self.send_header('Content-Disposition', f'attachment; filename={hostname}.{extension}')
+        self.end_headers()
+
+        block = b'\0' * chunk_size
+        remaining = self.archive_size
+        while remaining > 0:
+            self.wfile.write(block[:min(remaining, chunk_size)])
+            remaining -= chunk_size
+
+
+class FakePanoramaHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Panorama XML API that answers keygen and the vm-auth-key generate op command
+    """
+    delay = 0.0
+    vm_auth_key = '123456789012345'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        self._handle(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+    def _handle(self, query):
+        if urlparse(self.path).path != '/api/':
+            self.send_error(404)
+            return
+
+        time.sleep(self.delay)
+        request_type = query.get('type', [''])[0]
+        if request_type == 'keygen':
+            result = '<key>LUFRPT1benchmark</key>'
+        elif request_type == 'op' and 'vm-auth-key' in query.get('cmd', [''])[0]:
+            result = f'VM auth key {self.vm_auth_key} generated. Expires at: 2030/01/01 00:00:00'
+        else:
+            data = b'<response status="error"><msg><line>Unsupported request</line></msg></response>'
+            self._send_xml(data)
+            return
+
+        self._send_xml(f'<response status="success"><result>{result}</result></response>'.encode('utf-8'))
+
+    def _send_xml(self, data):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeUpdateHandler(BaseHTTPRequestHandler):
+    """
+    Serves any content package name with package_size bytes of repeatable data. With drop_after set, the first
+    response stops after that many bytes so clients have to resume with a Range request
+    """
+    package_size = 4 * 1024 * 1024
+    drop_after = 0
+    dropped = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        name = urlparse(self.path).path.strip('/')
+        if not re.match(r'^panup(v2|v3)?-all-[a-z]+-\d+-\d+$', name):
+            self.send_error(404)
+            return
+
+        start = 0
+        match = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match is not None:
+            start = int(match.group(1))
+            if start >= self.package_size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{self.package_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{self.package_size - 1}/{self.package_size}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(self.package_size - start))
+        self.end_headers()
+
+        end = self.package_size
+        if self.drop_after and not FakeUpdateHandler.dropped:
+            # only the first download is cut short
+            FakeUpdateHandler.dropped = True
+            end = min(end, start + self.drop_after)
+
+        data = package_data(name, self.package_size)
+        for offset in range(start, end, chunk_size):
+            self.wfile.write(data[offset:min(offset + chunk_size, end)])
+
+        if end < self.package_size:
+            self.close_connection = True
+
+
+def package_data(name, size):
+    """
+    Contents of a fake content package, the same for every request so downloads can be checked with package_sha256
+    """
+    seed = hashlib.sha256(name.encode('utf-8')).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def package_sha256(name, size):
+    return hashlib.sha256(package_data(name, size)).hexdigest()
+
+
+def start_server(handler_class, port, **attributes):
+    """
+    Start a threaded http server in the background
+    :param handler_class: request handler class
+    :param port: port to listen on, 0 to pick a free one
+    :param attributes: class attributes to set on a copy of the handler, i.e. archive_size or delay
+    :return: the running server, server.server_address[1] is the port in use
+    """
+    handler = type(handler_class.__name__, (handler_class,), attributes)
+    server = ThreadingServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def start_bootstrapper(port=0, archive_size=1024 * 1024, delay=0.0):
+    return start_server(FakeBootstrapperHandler, port, archive_size=archive_size, delay=delay)
+
+
+def start_panorama(port=0, delay=0.0):
+    return start_server(FakePanoramaHandler, port, delay=delay)
+
+
+def start_update_server(port=0, package_size=4 * 1024 * 1024, drop_after=0):
+    return start_server(FakeUpdateHandler, port, package_size=package_size, drop_after=drop_after)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run fake bootstrapper and Panorama services')
+    parser.add_argument('--bootstrapper-port', type=int, default=5000)
+    parser.add_argument('--panorama-port', type=int, default=8080)
+    parser.add_argument('--archive-size', type=int, default=1024 * 1024, help='archive size in bytes')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait before each archive')
+    parser.add_argument('--panorama-delay', type=float, default=0.0, help='seconds to wait before each api call')
+    parser.add_argument('--update-port', type=int, default=8081)
+    parser.add_argument('--package-size', type=int, default=4 * 1024 * 1024, help='content package size in bytes')
+    parser.add_argument('--drop-after', type=int, default=0,
+                        help='cut the first package download short after this many bytes')
+    args = parser.parse_args()
+
+    start_bootstrapper(args.bootstrapper_port, args.archive_size, args.delay)
+    start_panorama(args.panorama_port, args.panorama_delay)
+    start_update_server(args.update_port, args.package_size, args.drop_after)
+    print(f'Fake bootstrapper on 127.0.0.1:{args.bootstrapper_port}, fake Panorama on 127.0.0.1:{args.panorama_port}, '
+          f'fake update server on 127.0.0.1:{args.update_port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
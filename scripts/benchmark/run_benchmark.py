@@ -0,0 +1,414 @@
+# End to end benchmark for the bootstrapper cnc app
+#
+# Starts the cnc app with 'manage.py runserver' against the local stand-ins from fake_services.py, then drives the
+# complete build workflow (build -> cloud_auth -> step03 -> choose_bootstrap -> configure_bootstrap -> complete)
+# from a pool of client threads for every deployment type. Each type runs with Panorama, and without Panorama both
+# with and without a custom bootstrap.xml. The Panorama workflow goes from step03 straight to complete, so it never
+# uses one.
+# Each form is filled in from the page the app returns, so the benchmark follows the same redirects a browser would.
+#
+# Reports p50 / p95 / p99 latency of a full workflow, workflows and http requests per second, and the peak RSS of
+# the server process. Results can be saved and later compared against to catch regressions:
+#
+# python ./run_benchmark.py --cnc-dir /app/cnc --output baseline.json
+# python ./run_benchmark.py --cnc-dir /app/cnc --baseline baseline.json
+#
+# Use --server-url to benchmark an instance that is already running, it must be configured with
+# BOOTSTRAPPER_HOST, BOOTSTRAPPER_PORT, PANORAMA_PORT and PANORAMA_USE_HTTP=yes pointing at fake_services.py
+#
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+import requests
+
+import fake_services
+
+deployment_types = ('tgz', 'iso', 'zip', 'encoded_tgz', 's3', 'azure', 'gcp')
+
+# template from the app snippets dir used for the custom bootstrap scenarios
+custom_bootstrap_name = 'minimal_bootstrap_xml'
+
+# values posted for any of these fields when the app asks for them
+form_values = {
+    'auth_key': 'bench-auth-code',
+    'panorama_user': 'admin',
+    'panorama_password': 'admin',
+    'ADMINISTRATOR_PASSWORD': 'Bench-Passw0rd',
+    'aws_key': 'bench',
+    'aws_secret': 'bench',
+    'aws_location': 'us-east-2',
+    'azure_storage_account': 'bench',
+    'azure_access_key': 'bench',
+    'gcp_project_id': 'bench',
+    'gcp_access_token': 'bench',
+}
+
+max_steps = 10
+
+
+class WorkflowError(Exception):
+    pass
+
+
+class FormParser(HTMLParser):
+    """
+    Collect the action and default field values of the first POST form on a page
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.fields = dict()
+        self.found = False
+        self._in_form = False
+        self._select = None
+        self._select_value = None
+        self._textarea = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form' and not self.found and attrs.get('method', 'get').lower() == 'post':
+            self.found = True
+            self._in_form = True
+            self.action = attrs.get('action', '')
+        if not self._in_form:
+            return
+
+        name = attrs.get('name', None)
+        if tag == 'input' and name:
+            input_type = attrs.get('type', 'text').lower()
+            if input_type in ('submit', 'button', 'file', 'image', 'reset'):
+                return
+            if input_type in ('checkbox', 'radio') and 'checked' not in attrs:
+                return
+            self.fields[name] = attrs.get('value', '') or ''
+        elif tag == 'select' and name:
+            self._select = name
+            self._select_value = None
+        elif tag == 'option' and self._select:
+            if self._select_value is None or 'selected' in attrs:
+                self._select_value = attrs.get('value', '')
+        elif tag == 'textarea' and name:
+            self._textarea = name
+            self.fields[name] = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self._in_form = False
+        elif tag == 'select' and self._select:
+            self.fields[self._select] = self._select_value or ''
+            self._select = None
+        elif tag == 'textarea':
+            self._textarea = None
+
+    def handle_data(self, data):
+        if self._textarea:
+            self.fields[self._textarea] += data
+
+
+def parse_form(html):
+    parser = FormParser()
+    parser.feed(html)
+    return parser if parser.found else None
+
+
+def submit_form(session, url, overrides):
+    """
+    Load a page, fill in its form and post it without following the redirect
+    :return: tuple of response and the url it was posted to
+    """
+    page = session.get(url)
+    page.raise_for_status()
+    form = parse_form(page.text)
+    if form is None:
+        raise WorkflowError(f'No form found on {url}')
+
+    data = dict(form.fields)
+    data.update({k: v for k, v in overrides.items() if k in data})
+    post_url = urljoin(page.url, form.action or page.url)
+    resp = session.post(post_url, data=data, headers={'Referer': page.url}, allow_redirects=False, stream=True)
+    return resp, post_url
+
+
+def login(session, base_url, username, password, login_path):
+    resp, _ = submit_form(session, base_url + login_path, {'username': username, 'password': password})
+    resp.close()
+    if not resp.is_redirect:
+        raise WorkflowError(f'Could not log in as {username}')
+
+
+def run_workflow(session, base_url, overrides):
+    """
+    Drive one build from the first step to the downloaded archive
+    :return: tuple of number of http requests made and bytes received in the final response
+    """
+    url = base_url + '/bootstrapper/build'
+    request_count = 0
+    for _ in range(max_steps):
+        resp, post_url = submit_form(session, url, overrides)
+        request_count += 2
+
+        if resp.is_redirect:
+            resp.close()
+            url = urljoin(post_url, resp.headers['Location'])
+            if url.rstrip('/').endswith('/error'):
+                raise WorkflowError(f'Workflow redirected to {url}')
+            continue
+
+        with resp:
+            if resp.status_code != 200:
+                raise WorkflowError(f'{post_url} returned {resp.status_code}')
+
+            if overrides['deployment_type'] in fake_services.cloud_types:
+                # cloud types finish on a results page with the message from the bootstrapper service
+                if 'Uploaded' not in resp.text:
+                    raise WorkflowError(f'Unexpected response from {post_url}')
+                return request_count, len(resp.content)
+
+            if 'attachment' not in resp.headers.get('Content-Disposition', ''):
+                raise WorkflowError(f'No archive returned from {post_url}')
+
+            size = 0
+            for chunk in resp.iter_content(chunk_size=fake_services.chunk_size):
+                size += len(chunk)
+            return request_count, size
+
+    raise WorkflowError(f'Workflow did not finish in {max_steps} steps')
+
+
+def get_scenarios(selected_types):
+    scenarios = list()
+    for deployment_type in selected_types:
+        # the panorama workflow skips choose_bootstrap, so custom_bootstrap is only set without panorama
+        for include_panorama, custom_bootstrap in (('no', 'none'), ('no', custom_bootstrap_name), ('yes', 'none')):
+            name = deployment_type
+            if include_panorama == 'yes':
+                name += '+panorama'
+            if custom_bootstrap != 'none':
+                name += '+bootstrap'
+            overrides = dict(form_values, deployment_type=deployment_type, include_panorama=include_panorama,
+                             custom_bootstrap=custom_bootstrap, panorama_ip='127.0.0.1')
+            scenarios.append((name, overrides))
+    return scenarios
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    # nearest rank
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100.0 * len(ordered))
+    return ordered[max(0, rank - 1)]
+
+
+def reset_peak_rss(pid):
+    # writing 5 to clear_refs resets VmHWM on linux, not available everywhere
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss(pid):
+    """
+    Peak resident set size of a process in bytes, or None if it can not be read
+    """
+    try:
+        with open(f'/proc/{pid}/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def run_scenario(name, overrides, args, pid):
+    local = threading.local()
+
+    def get_session():
+        if getattr(local, 'session', None) is None:
+            local.session = requests.Session()
+            login(local.session, args.server_url, args.username, args.password, args.login_path)
+        return local.session
+
+    def one(index):
+        values = dict(overrides)
+        if not args.reuse_hostnames:
+            values['hostname'] = f'bench-{name.replace("+", "-")}-{index}'
+        session = get_session()
+        start = time.time()
+        try:
+            request_count, _ = run_workflow(session, args.server_url, values)
+        except (WorkflowError, requests.exceptions.RequestException) as e:
+            return None, 0, str(e)
+        return time.time() - start, request_count, ''
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(-args.warmup, 0)))
+
+        if pid:
+            reset_peak_rss(pid)
+        start = time.time()
+        outcomes = list(executor.map(one, range(args.iterations)))
+        elapsed = time.time() - start
+
+    latencies = [o[0] for o in outcomes if o[0] is not None]
+    errors = [o[2] for o in outcomes if o[0] is None]
+    total_requests = sum(o[1] for o in outcomes)
+    return {
+        'iterations': args.iterations,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else '',
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'workflows_per_sec': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'requests_per_sec': round(total_requests / elapsed, 2) if elapsed else None,
+        'peak_rss_mb': _mb(get_peak_rss(pid)) if pid else None,
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def _mb(size):
+    return round(size / (1024 * 1024), 1) if size is not None else None
+
+
+def start_cnc(args, bootstrapper_port, panorama_port):
+    env = dict(os.environ)
+    env.update({
+        'BOOTSTRAPPER_HOST': '127.0.0.1',
+        'BOOTSTRAPPER_PORT': str(bootstrapper_port),
+        'PANORAMA_PORT': str(panorama_port),
+        'PANORAMA_USE_HTTP': 'yes',
+        'PYTHONUNBUFFERED': '1',
+    })
+    port = args.port
+    manage = os.path.join(args.cnc_dir, 'manage.py')
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, manage, 'runserver', f'127.0.0.1:{port}', '--noreload'],
+                               cwd=args.cnc_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'cnc app exited with {process.returncode}, see --server-log for details')
+        try:
+            requests.get(url + args.login_path, timeout=2)
+            return process, url
+        except requests.exceptions.RequestException:
+            time.sleep(0.5)
+
+    process.terminate()
+    raise SystemExit('cnc app did not start within 60 seconds')
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change against a baseline for every scenario
+    :return: list of scenario names that regressed by more than the tolerance
+    """
+    regressions = list()
+    print()
+    print(f'{"scenario":<28}{"p95 ms":>18}{"workflows/s":>20}')
+    for name, result in results.items():
+        base = baseline.get(name, None)
+        if base is None or not base.get('p95_ms') or not result.get('p95_ms'):
+            continue
+        p95_change = (result['p95_ms'] - base['p95_ms']) / base['p95_ms']
+        rate_change = (result['workflows_per_sec'] - base['workflows_per_sec']) / base['workflows_per_sec']
+        print(f'{name:<28}{base["p95_ms"]:>8} {p95_change:>+8.1%}{base["workflows_per_sec"]:>10} '
+              f'{rate_change:>+8.1%}')
+        if p95_change > tolerance or rate_change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bootstrapper build workflow')
+    parser.add_argument('--cnc-dir', default=os.environ.get('CNC_DIR', '/app/cnc'),
+                        help='directory containing the cnc manage.py')
+    parser.add_argument('--server-url', default=None, help='benchmark a running instance instead of starting one')
+    parser.add_argument('--server-pid', type=int, default=None, help='pid of the running instance for peak RSS')
+    parser.add_argument('--server-log', default=None, help='file to write the cnc app output to')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--login-path', default='/login')
+    parser.add_argument('--username', default=os.environ.get('CNC_USERNAME', 'paloalto'))
+    parser.add_argument('--password', default=os.environ.get('CNC_PASSWORD', 'bootstrapper'))
+    parser.add_argument('--bootstrapper-port', type=int, default=0)
+    parser.add_argument('--panorama-port', type=int, default=0)
+    parser.add_argument('--archive-size', type=int, default=1024 * 1024, help='archive size in bytes')
+    parser.add_argument('--delay', type=float, default=0.1, help='seconds the fake bootstrapper waits per archive')
+    parser.add_argument('--panorama-delay', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=20, help='workflows per scenario')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed workflows per scenario')
+    parser.add_argument('--deployment-types', default=','.join(deployment_types))
+    parser.add_argument('--reuse-hostnames', action='store_true',
+                        help='send identical payloads so repeated archives are served from the cache')
+    parser.add_argument('--output', default=None, help='write results as json, i.e. to record a baseline')
+    parser.add_argument('--baseline', default=None, help='compare against results saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed regression as a fraction')
+    args = parser.parse_args()
+
+    bootstrapper = fake_services.start_bootstrapper(args.bootstrapper_port, args.archive_size, args.delay)
+    panorama = fake_services.start_panorama(args.panorama_port, args.panorama_delay)
+    bootstrapper_port = bootstrapper.server_address[1]
+    panorama_port = panorama.server_address[1]
+
+    process = None
+    pid = args.server_pid
+    if args.server_url is None:
+        process, args.server_url = start_cnc(args, bootstrapper_port, panorama_port)
+        pid = process.pid
+    else:
+        print(f'Fake bootstrapper on port {bootstrapper_port}, fake Panorama on port {panorama_port}')
+
+    results = dict()
+    try:
+        print(f'{"scenario":<28}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"wf/s":>8}{"req/s":>8}{"rss MB":>8}'
+              f'{"errors":>8}')
+        for name, overrides in get_scenarios(args.deployment_types.split(',')):
+            result = run_scenario(name, overrides, args, pid)
+            results[name] = result
+            print(f'{name:<28}{result["p50_ms"]!s:>9}{result["p95_ms"]!s:>9}{result["p99_ms"]!s:>9}'
+                  f'{result["workflows_per_sec"]!s:>8}{result["requests_per_sec"]!s:>8}'
+                  f'{result["peak_rss_mb"]!s:>8}{result["errors"]:>8}')
+            if result['first_error']:
+                print(f'    first error: {result["first_error"]}')
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        bootstrapper.shutdown()
+        panorama.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f'Regressed by more than {args.tolerance:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
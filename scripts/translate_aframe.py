@@ -1,62 +1,262 @@
 # 2018-08-10 nembery@paloaltonetworks.com
 #
-# Simple script to take an AFrame screen as an argument
-# find all input_form labels and translate them to another language using google translate APIs
+# Simple script to take AFrame screens as arguments
+# find all input_form labels and translate them to other languages using google translate APIs
+#
+# All unique labels and form names from every screen are collected first and sent to the translator in batches,
+# with each language translated in its own thread. Requests to the translator are rate limited per label across all
+# threads, googletrans sends a separate request for every label in a batch.
 #
 # Example:
 #
-# find ~/PycharmProjects/panos-bootstrapper-ui/aframe/imports/screens/ |
-#   sed 's/.*/"&"/' |
-#       xargs -n 1 -I{} python ./translate_aframe.py {} it
+# python ./translate_aframe.py -l es -l it -l fr ~/PycharmProjects/panos-bootstrapper-ui/aframe/imports/screens/
+#
+# The original single screen form still works:
+#
+# python ./translate_aframe.py exported_screen.json it
+#
+# Use --backend offline to run without the google translate API, every label is returned as '[lang] label'. Offline
+# runs use their own cache and output dir so the fake translations never end up in a real run.
+#
+# Translations are cached in a sqlite database keyed by language and a hash of the source text, so several runs can
+# share the cache at the same time. An existing pickle cache is imported the first time the database is opened.
+#
+# A manifest in the output dir records a hash of each source screen per language. Screens that have not changed
+# since they were last translated are skipped, and translated screens keep the same id between runs. Use --force to
+# translate every screen again.
 #
 
+import argparse
+import copy
+import hashlib
 import json
 import os
 import pickle
+import sqlite3
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, unquote
 
-from googletrans import Translator
-
-cache_file_path = '/tmp/translation_cache.pkl'
+cache_file_path = '/tmp/translation_cache.sqlite'
+legacy_cache_file_path = '/tmp/translation_cache.pkl'
 output_dir = '/tmp/translator_output'
 
+# used instead of the paths above by the offline backend
+offline_cache_file_path = '/tmp/translation_cache_offline.sqlite'
+offline_output_dir = '/tmp/translator_output_offline'
+manifest_file_name = 'manifest.json'
+
+# number of labels sent to the translator in one call
+batch_size = 50
+
+# max translator requests per second, shared by all languages
+rate_limit = 2.0
+
 translator = ''
 
 
-def load_translation_cache(cache_file):
+class RateLimiter:
     """
-    Open the cache file from the given path
-    :param cache_file: Path to the cache
-    :return: Dict containing all translated strings
+    Space calls out to at most rate per second across all threads
     """
 
-    if not os.path.exists(cache_file):
-        with open(cache_file, 'wb+') as cache:
-            pickle.dump({}, cache)
-            return {}
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
 
-    with open(cache_file, 'rb') as cache:
-        trans_cache = pickle.load(cache)
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
 
-    return trans_cache
+        if delay > 0:
+            time.sleep(delay)
 
 
-def save_translation_cache(cache_file, cache):
+class GoogleBackend:
     """
-    Saves the translation cache into a pickle file
-    :param cache_file: path to file to pickle
-    :param cache: data structure to save
-    :return: boolean on success
+    Translate with the googletrans client. Translator objects are not thread safe, so each thread gets its own
     """
-    try:
-        with open(cache_file, 'wb') as cache_obj:
-            pickle.dump(cache, cache_obj)
-    except OSError as oe:
-        print(f'Could not open {cache_file} for writing!')
-        return False
 
-    return True
+    def __init__(self):
+        from googletrans import Translator
+
+        self.translator_class = Translator
+        self.local = threading.local()
+
+    def translate(self, labels, lang, limiter=None):
+        if getattr(self.local, 'translator', None) is None:
+            self.local.translator = self.translator_class()
+
+        # googletrans makes one request per label even when given a list, so each label is rate limited on its own
+        results = list()
+        for label in labels:
+            if limiter is not None:
+                limiter.wait()
+            results.append(self.local.translator.translate(label, dest=lang).text)
+
+        return results
+
+
+class OfflineBackend:
+    """
+    Stand-in that does not call any API, useful for testing the screen processing
+    """
+
+    def translate(self, labels, lang, limiter=None):
+        return [f'[{lang}] {label}' for label in labels]
+
+
+backends = {
+    'google': GoogleBackend,
+    'offline': OfflineBackend,
+}
+
+
+class TranslationCache:
+    """
+    Translations stored in sqlite, one row per (language, source text hash). Rows are read and inserted one batch
+    at a time so concurrent runs never overwrite each other, WAL mode lets readers continue while another process
+    writes. Each thread uses its own connection
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS translations (
+            lang TEXT NOT NULL,
+            source_hash TEXT NOT NULL,
+            source TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            PRIMARY KEY (lang, source_hash)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.local = threading.local()
+        self.connections = list()
+        self.connections_lock = threading.Lock()
+
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(self.schema)
+
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # a generous timeout as other runs may be writing a large batch
+            connection = sqlite3.connect(self.cache_file, timeout=60, check_same_thread=False)
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+
+        return connection
+
+    @staticmethod
+    def source_hash(label):
+        return hashlib.sha256(label.encode('utf-8')).hexdigest()
+
+    def get(self, lang, label):
+        row = self.connect().execute('SELECT translation FROM translations WHERE lang = ? AND source_hash = ?',
+                                     (lang, self.source_hash(label))).fetchone()
+        return row[0] if row is not None else None
+
+    def get_many(self, lang, labels):
+        """
+        Look up several labels at once
+        :param lang: destination language
+        :param labels: list of source strings
+        :return: dict of source string to translation for the labels that are cached
+        """
+        hashes = {self.source_hash(label): label for label in labels}
+        found = dict()
+        hash_list = list(hashes)
+        # stay well under the sqlite limit on query parameters
+        for start in range(0, len(hash_list), 500):
+            chunk = hash_list[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connect().execute(f'SELECT source_hash, translation FROM translations '
+                                          f'WHERE lang = ? AND source_hash IN ({placeholders})', [lang] + chunk)
+            for source_hash, translation in rows:
+                found[hashes[source_hash]] = translation
+
+        return found
+
+    def put_many(self, lang, translations):
+        """
+        Store translations, a translation already stored by another run is kept
+        :param lang: destination language
+        :param translations: dict of source string to translation
+        :return: None
+        """
+        connection = self.connect()
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO translations (lang, source_hash, source, translation) '
+                                   'VALUES (?, ?, ?, ?)',
+                                   [(lang, self.source_hash(k), k, v) for k, v in translations.items()])
+
+    def import_pickle(self, pickle_file):
+        """
+        Copy the translations from the old whole-file pickle cache, only done once per database
+        :param pickle_file: path to the pickle cache
+        :return: number of translations imported
+        """
+        connection = self.connect()
+        if connection.execute("SELECT value FROM meta WHERE key = 'pickle_imported'").fetchone() is not None:
+            return 0
+
+        if not os.path.exists(pickle_file):
+            return 0
+
+        try:
+            with open(pickle_file, 'rb') as cache:
+                legacy_cache = pickle.load(cache)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f'Could not read {pickle_file}: {e}')
+            return 0
+
+        count = 0
+        with connection:
+            for lang, translations in legacy_cache.items():
+                connection.executemany('INSERT OR IGNORE INTO translations (lang, source_hash, source, translation) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       [(lang, self.source_hash(k), k, v) for k, v in translations.items()])
+                count += len(translations)
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pickle_imported', ?)",
+                               (pickle_file,))
+
+        return count
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = list()
+
+
+def load_translation_cache(cache_file, import_legacy=True):
+    """
+    Open the cache database at the given path, importing the old pickle cache the first time
+    :param cache_file: Path to the cache
+    :param import_legacy: import the old pickle cache?
+    :return: TranslationCache
+    """
+    cache = TranslationCache(cache_file)
+    if not import_legacy:
+        return cache
+
+    imported = cache.import_pickle(legacy_cache_file_path)
+    if imported:
+        print(f'Imported {imported} translations from {legacy_cache_file_path}')
+
+    return cache
 
 
 def get_screen_data_from_file(file_name):
@@ -185,7 +385,7 @@ def process_screen(orig_screen_data, lang, cache, translate_form_names=True):
 
 def translate_label(label, lang, cache):
     """
-    Use the google translate API to translate the label to the destination language
+    Use the translator backend to translate the label to the destination language
     :param label: label string to translate
     :param lang: destination language
     :param cache: cache object to cache the translations
@@ -194,28 +394,75 @@ def translate_label(label, lang, cache):
     global translator
 
     if translator == '':
-        translator = Translator()
-
-    if lang not in cache:
-        cache[lang] = dict()
+        translator = GoogleBackend()
 
-    if label not in cache[lang]:
-        r = translator.translate(label, dest=lang)
-        cache[lang][label] = r.text
+    translation = cache.get(lang, label)
+    if translation is None:
+        translation = translator.translate([label], lang)[0]
+        cache.put_many(lang, {label: translation})
     else:
         print('cache hit')
 
-    return cache[lang][label]
+    return translation
 
 
-def save_new_screen(new_screen_data, lang, cache, translate_screen_name=False):
+def get_screen_strings(screen_data, translate_form_names=True):
+    """
+    Collect every string process_screen will translate from a screen
+    :param screen_data: screen data structure
+    :param translate_form_names: include form names as well as labels?
+    :return: set of strings
+    """
+    strings = set()
+    for input_form in screen_data.get('input_forms', {}).values():
+        form = json.loads(input_form).get('form', '')
+        form_json = form.get('json', '')
+        if form_json == '':
+            continue
+
+        if translate_form_names:
+            strings.add(form['name'])
+
+        for form_var in json.loads(unquote(form_json, encoding='utf-8')):
+            if 'label' in form_var:
+                strings.add(form_var['label'])
+
+    return strings
+
+
+def translate_batch(labels, lang, cache, backend, limiter):
+    """
+    Translate all labels that are not already cached, sending them to the backend in batches
+    :param labels: iterable of strings to translate
+    :param lang: destination language
+    :param cache: TranslationCache
+    :param backend: translator backend
+    :param limiter: RateLimiter shared by all languages, passed on to the backend
+    :return: number of labels that were translated
+    """
+    labels = set(labels)
+    cached = cache.get_many(lang, labels)
+    todo = sorted(label for label in labels if label not in cached)
+
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        translated = backend.translate(batch, lang, limiter)
+        # saved after every batch so an interrupted run keeps what it has paid for
+        cache.put_many(lang, dict(zip(batch, translated)))
+        print(f'{lang}: translated {start + len(batch)} of {len(todo)}')
+
+    return len(todo)
+
+
+def save_new_screen(new_screen_data, lang, cache, translate_screen_name=False, screen_id=None):
     """
     Save screen data to a new file
     :param new_screen_data: fully processed screen data structure
     :param lang: destination language
     :param cache: translation cache
     :param translate_screen_name: translate screen name as well?
-    :return: None
+    :param screen_id: id to give the new screen, a new one is generated if not set
+    :return: file name of the new screen in the output dir or None if the screen has no name
     """
 
     if not os.path.exists(output_dir):
@@ -231,7 +478,7 @@ def save_new_screen(new_screen_data, lang, cache, translate_screen_name=False):
                 new_screen_data['screen']['name'] = translate_label(name, lang, cache)
 
             new_screen_data['screen']['description'] = f'{description} {lang}'
-            new_screen_data['screen']['id'] = str(uuid.uuid4())
+            new_screen_data['screen']['id'] = screen_id or str(uuid.uuid4())
             new_name = f'{name} {lang}.json'
             new_path = os.path.join(output_dir, new_name)
             with open(new_path, 'w') as new_screen_file:
@@ -239,47 +486,194 @@ def save_new_screen(new_screen_data, lang, cache, translate_screen_name=False):
                 new_screen_file.write(new_screen_json)
                 print('All done')
 
+            return new_name
 
-if __name__ == '__main__':
+    return None
 
-    # what is this tool called again?
-    tool_name = os.sys.argv[0]
 
-    if len(os.sys.argv) < 3:
-        print(f'Usage: {tool_name} exported_screen.json language')
-        print(f'Example: {tool_name} exported_screen.json es')
-        os.sys.exit(1)
+def get_source_hash(screen_data):
+    """
+    Hash of the english source screen, used to tell if it has changed since it was last translated
+    :param screen_data: screen data structure as loaded from the file
+    :return: hex digest string
+    """
+    return hashlib.sha256(json.dumps(screen_data, sort_keys=True).encode('utf-8')).hexdigest()
 
-    # what is the path to the screen file we want to process?
-    screen_file_name = os.sys.argv[1]
 
-    # what is the language code we want to translate to?
-    language = os.sys.argv[2]
+def get_screen_key(file_name):
+    """
+    Identify a source screen in the manifest by the file it was loaded from. Screen ids are not used as copied
+    screens keep the id of the original
+    """
+    return os.path.abspath(file_name)
 
-    # sanity check on existence of file
-    if not os.path.exists(screen_file_name):
-        print(f'{screen_file_name} was not found!')
-        os.sys.exit(1)
 
-    # explicitly define the translation cache here
-    translation_cache = dict()
+def load_manifest():
+    """
+    Load the manifest of translated screens from the output dir
+    :return: dict of screen key to a dict of language to source_hash, id and output file name
+    """
+    manifest_path = os.path.join(output_dir, manifest_file_name)
+    if not os.path.exists(manifest_path):
+        return dict()
 
     try:
-        # save all our translation API call results to be re-used if necessary
-        translation_cache = load_translation_cache(cache_file_path)
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        print(f'Could not read {manifest_path}, all screens will be translated: {e}')
+        return dict()
 
-        # process the file to pull out the data and verify it's structured properly
-        screen_data_dict = get_screen_data_from_file(screen_file_name)
 
-        # verify this is in fact an english language file
-        if is_english(screen_data_dict):
-            # now do the work
-            new_screen = process_screen(screen_data_dict, language, translation_cache, True)
-            # save the results to a new file
-            save_new_screen(new_screen, language, translation_cache)
+def save_manifest(manifest):
+    """
+    Write the manifest to the output dir, replacing the old one in a single step
+    :param manifest: manifest dict
+    :return: None
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-    finally:
-        # no matter what, let's save whatever translation work we've already done
-        if save_translation_cache(cache_file_path, translation_cache):
-            print('Saved the cache!')
+    manifest_path = os.path.join(output_dir, manifest_file_name)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_up_to_date(entry, source_hash):
+    """
+    Check a manifest entry against the current source screen and the output dir
+    :param entry: manifest entry for one screen and language, or None
+    :param source_hash: hash of the current source screen
+    :return: True if the translated screen does not need to be rebuilt
+    """
+    if entry is None or entry.get('source_hash', '') != source_hash:
+        return False
+
+    return os.path.exists(os.path.join(output_dir, entry.get('output', '')))
 
+
+def find_screen_files(paths):
+    """
+    Expand directories into the screen json files they contain
+    :param paths: list of screen files or directories
+    :return: list of file paths
+    """
+    screen_files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                screen_files.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.json'))
+        else:
+            screen_files.append(path)
+
+    return screen_files
+
+
+def translate_language(screens, lang, cache, backend, limiter, manifest, manifest_lock, force=False):
+    """
+    Translate every changed screen into one language, all strings are translated up front in batches. Labels that
+    have not changed are found in the cache, so only new or edited labels are sent to the backend
+    :param screens: list of (screen data, manifest key, source hash) tuples for the english screens
+    :param lang: destination language
+    :param cache: translation cache
+    :param backend: translator backend
+    :param limiter: RateLimiter shared by all languages
+    :param manifest: manifest dict, updated with every screen that is translated
+    :param manifest_lock: lock to hold while updating the manifest
+    :param force: translate screens even if they have not changed
+    :return: None
+    """
+    pending = list()
+    for screen_data, screen_key, source_hash in screens:
+        with manifest_lock:
+            entry = manifest.get(screen_key, dict()).get(lang, None)
+        if not force and is_up_to_date(entry, source_hash):
+            continue
+        pending.append((screen_data, screen_key, source_hash, entry))
+
+    print(f'{lang}: {len(pending)} of {len(screens)} screens have changed')
+
+    strings = set()
+    for screen_data, _, _, _ in pending:
+        strings.update(get_screen_strings(screen_data))
+
+    translate_batch(strings, lang, cache, backend, limiter)
+
+    for screen_data, screen_key, source_hash, entry in pending:
+        # keep the id of a screen we have translated before so it is updated in place rather than duplicated
+        screen_id = entry.get('id', None) if entry else None
+
+        # process_screen modifies the screen in place and every language starts from the english original
+        new_screen = process_screen(copy.deepcopy(screen_data), lang, cache, True)
+        new_name = save_new_screen(new_screen, lang, cache, screen_id=screen_id)
+        if new_name is None:
+            continue
+
+        with manifest_lock:
+            manifest.setdefault(screen_key, dict())[lang] = dict(source_hash=source_hash,
+                                                                 id=new_screen['screen']['id'],
+                                                                 output=new_name)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Translate AFrame screens to other languages')
+    parser.add_argument('paths', nargs='+', help='exported screen json files or directories containing them')
+    parser.add_argument('-l', '--language', action='append', default=[], help='language code, may be repeated')
+    parser.add_argument('--backend', choices=sorted(backends), default='google')
+    parser.add_argument('--batch-size', type=int, default=batch_size)
+    parser.add_argument('--rate', type=float, default=rate_limit, help='max translator requests per second')
+    parser.add_argument('--force', action='store_true', help='translate screens even if they have not changed')
+    args = parser.parse_args()
+
+    # support the original 'translate_aframe.py exported_screen.json language' form
+    languages = args.language
+    if not languages and len(args.paths) > 1 and not os.path.exists(args.paths[-1]):
+        languages = [args.paths.pop()]
+
+    if not languages:
+        parser.error('at least one language is required')
+
+    batch_size = args.batch_size
+    translator = backends[args.backend]()
+    if args.backend == 'offline':
+        cache_file_path = offline_cache_file_path
+        output_dir = offline_output_dir
+    rate_limiter = RateLimiter(args.rate)
+
+    screen_files = find_screen_files(args.paths)
+    for screen_file_name in screen_files:
+        # sanity check on existence of file
+        if not os.path.exists(screen_file_name):
+            print(f'{screen_file_name} was not found!')
+            os.sys.exit(1)
+
+    # all our translation API call results are saved to be re-used if necessary
+    translation_cache = load_translation_cache(cache_file_path, import_legacy=args.backend != 'offline')
+    translation_manifest = load_manifest()
+    translation_manifest_lock = threading.Lock()
+
+    try:
+        # process the files to pull out the data and verify they are structured properly, only english screens
+        # are translated
+        english_screens = list()
+        for screen_file_name in screen_files:
+            screen_data_dict = get_screen_data_from_file(screen_file_name)
+            if is_english(screen_data_dict):
+                english_screens.append((screen_data_dict, get_screen_key(screen_file_name),
+                                        get_source_hash(screen_data_dict)))
+
+        # now do the work, one thread per language
+        with ThreadPoolExecutor(max_workers=len(languages)) as executor:
+            futures = [executor.submit(translate_language, english_screens, language, translation_cache,
+                                       translator, rate_limiter, translation_manifest, translation_manifest_lock,
+                                       args.force) for language in languages]
+            for future in futures:
+                future.result()
+
+    finally:
+        # every translation was saved as soon as it was made, record the screens that were written
+        translation_cache.close()
+        save_manifest(translation_manifest)
@@ -1,11 +1,5 @@
 #!/usr/bin/env bash
-for lang in 'es' 'it' 'fr' 'de' 'ja' 'zh-cn' 'ko'
-do
-  echo $lang
-  find ../aframe/imports/screens/ |
-    grep 'aframe-Bootstrap Linux KVM with Panorama.json' |
-    sed 's/.*/"&"/' |
-    xargs -n 1 -I{} python ./translate_aframe.py {} $lang
-
-done
-
+# translate every screen into all languages in one process, languages are translated concurrently
+python ./translate_aframe.py \
+  -l 'es' -l 'it' -l 'fr' -l 'de' -l 'ja' -l 'zh-cn' -l 'ko' \
+  '../aframe/imports/screens/aframe-Bootstrap Linux KVM with Panorama.json'
@@ -0,0 +1,37 @@
+# Shared setup for the tests of the bootstrapper app, the translate script and the benchmark stand-ins
+#
+# Run from the top of the repository, with the pan-cnc submodule checked out in cnc/cnc or CNC_DIR pointing at a
+# pan-cnc checkout, i.e. inside the cnc container:
+#
+# pip install pytest
+# python -m pytest tests
+#
+# Every test gets its own HOME, so the stores under ~/.pan_cnc never touch a real install or each other.
+#
+
+import os
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src_dir = os.path.join(repo_dir, 'cnc', 'src')
+cnc_dir = os.environ.get('CNC_DIR', os.path.join(repo_dir, 'cnc', 'cnc'))
+
+for path in (os.path.join(repo_dir, 'scripts', 'benchmark'), os.path.join(repo_dir, 'scripts'), cnc_dir, src_dir):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cnc.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+
+@pytest.fixture(autouse=True)
+def home_dir(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    return home
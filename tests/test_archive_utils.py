@@ -0,0 +1,93 @@
+import base64
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from bootstrapper.lib import archive_utils
+from bootstrapper.lib import blob_utils
+
+init_cfg = 'type=dhcp-client\nhostname=fw1\n'
+bootstrap_xml = b'<config version="10.0.0"><devices/></config>'
+auth_key = 'A1234567'
+
+
+@pytest.fixture
+def content_file(tmp_path):
+    # larger than a few chunks, so every format has to stream the member in parts
+    path = tmp_path / 'panupv2-all-contents-8213-5678'
+    path.write_bytes(os.urandom(3 * archive_utils.chunk_size + 17))
+    return path
+
+
+def read_tgz(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as archive:
+        return {m.name: archive.extractfile(m).read() if m.isfile() else None for m in archive.getmembers()}
+
+
+def read_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {i.filename.rstrip('/'): None if i.is_dir() else archive.read(i) for i in archive.infolist()}
+
+
+def read_encoded_tgz(data):
+    return read_tgz(base64.b64decode(data, validate=True))
+
+
+@pytest.mark.parametrize('deployment_type, reader', [
+    ('tgz', read_tgz),
+    ('zip', read_zip),
+    ('encoded_tgz', read_encoded_tgz),
+])
+def test_stream_archive(deployment_type, reader, content_file):
+    bootstrap_ref = blob_utils.put_bytes(bootstrap_xml)
+    chunks = list(archive_utils.stream_archive(deployment_type, init_cfg, bootstrap_ref, auth_key,
+                                               [str(content_file)]))
+
+    assert len(chunks) > 1
+    assert all(chunks)
+
+    members = reader(b''.join(chunks))
+    for directory in archive_utils.bootstrap_dirs:
+        assert members[directory] is None
+    assert members['config/init-cfg.txt'] == init_cfg.encode('utf-8')
+    assert members['config/bootstrap.xml'] == bootstrap_xml
+    assert members['license/authcodes'] == f'{auth_key}\n'.encode('utf-8')
+    assert members[f'content/{content_file.name}'] == content_file.read_bytes()
+
+
+def test_stream_archive_without_optional_members():
+    members = read_tgz(b''.join(archive_utils.stream_archive('tgz', init_cfg)))
+
+    assert set(members) == set(archive_utils.bootstrap_dirs) | {'config/init-cfg.txt'}
+
+
+def test_stream_archive_rejects_remote_types():
+    with pytest.raises(ValueError):
+        archive_utils.stream_archive('iso', init_cfg)
+
+
+def test_stream_tgz_detects_changed_member(content_file):
+    members = archive_utils.get_archive_members(init_cfg, content_files=[str(content_file)])
+    # the size is taken when the members are listed, the file grows before it is read
+    with open(content_file, 'ab') as grown:
+        grown.write(b'more')
+
+    with pytest.raises(ValueError, match='changed size'):
+        list(archive_utils.stream_tgz(members))
+
+
+@pytest.mark.parametrize('sizes', [[1], [2, 2, 2], [3, 1, 5, 7], [64, 0, 65, 1]])
+def test_stream_base64(sizes):
+    data = os.urandom(sum(sizes))
+    chunks = list()
+    offset = 0
+    for size in sizes:
+        chunks.append(data[offset:offset + size])
+        offset += size
+
+    encoded = b''.join(archive_utils.stream_base64(chunks))
+
+    assert encoded == base64.b64encode(data)
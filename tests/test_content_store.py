@@ -0,0 +1,120 @@
+import os
+
+import pytest
+import requests
+
+import fake_services
+from bootstrapper.lib import content_utils
+
+package_size = 3 * 1024 * 1024 + 123
+
+
+def start(monkeypatch, drop_after=0):
+    # the first download cut short is tracked on the handler class, start every test with a fresh one
+    monkeypatch.setattr(fake_services.FakeUpdateHandler, 'dropped', False)
+    return fake_services.start_update_server(package_size=package_size, drop_after=drop_after)
+
+
+@pytest.fixture
+def update_server(monkeypatch):
+    server = start(monkeypatch)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def content_dir(tmp_path):
+    path = tmp_path / 'content'
+    path.mkdir()
+    return str(path)
+
+
+def package_url(server, name):
+    return f'http://127.0.0.1:{server.server_address[1]}/{name}'
+
+
+def test_parse_package_name():
+    assert content_utils.parse_package_name('panupv2-all-contents-8213-5678') == ('appthreat', '8213-5678')
+    assert content_utils.parse_package_name('panup-all-antivirus-3456-3966') == ('antivirus', '3456-3966')
+    assert content_utils.parse_package_name('bootstrap.xml') is None
+
+
+def test_download(update_server, content_dir):
+    name = 'panupv2-all-contents-8213-5678'
+    sha256 = fake_services.package_sha256(name, package_size)
+
+    package = content_utils.download_package(package_url(update_server, name), sha256, content_dir=content_dir)
+
+    assert package['name'] == name
+    assert package['package'] == 'appthreat'
+    assert package['version'] == '8213-5678'
+    assert package['sha256'] == sha256
+    assert package['size'] == package_size
+    assert sorted(f for f in os.listdir(content_dir) if not f.startswith('.')) == [content_utils.index_name, name]
+
+
+def test_download_resumes(monkeypatch, content_dir):
+    server = start(monkeypatch, drop_after=1024 * 1024)
+    name = 'panup-all-antivirus-3456-3966'
+    try:
+        package = content_utils.download_package(package_url(server, name),
+                                                 fake_services.package_sha256(name, package_size),
+                                                 content_dir=content_dir)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert fake_services.FakeUpdateHandler.dropped
+    assert package['size'] == package_size
+
+
+def test_download_checksum_mismatch(update_server, content_dir):
+    name = 'panupv2-all-contents-8213-5678'
+
+    with pytest.raises(ValueError, match='Checksum'):
+        content_utils.download_package(package_url(update_server, name), '0' * 64, content_dir=content_dir)
+
+    assert content_utils.find_package('appthreat', content_dir=content_dir) is None
+    assert not [f for f in os.listdir(content_dir) if f.endswith('.partial')]
+
+
+def test_download_rejects_other_files(update_server, content_dir):
+    with pytest.raises(ValueError, match='not a content package'):
+        content_utils.download_package(package_url(update_server, 'bootstrap.xml'), content_dir=content_dir)
+
+
+def test_download_missing_package(update_server, content_dir, monkeypatch):
+    monkeypatch.setenv('BOOTSTRAPPER_CONTENT_RETRIES', '0')
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        content_utils.download_package(package_url(update_server, 'panupv2-all-contents-8213-5678') + '/extra',
+                                       file_name='panupv2-all-contents-8213-5678', content_dir=content_dir)
+
+
+def test_stored_package_is_not_downloaded_again(monkeypatch, content_dir):
+    name = 'panupv2-all-contents-8213-5678'
+    sha256 = fake_services.package_sha256(name, package_size)
+    server = start(monkeypatch)
+    url = package_url(server, name)
+    content_utils.download_package(url, sha256, content_dir=content_dir)
+    server.shutdown()
+    server.server_close()
+
+    # the server is gone, so this only works from the store
+    package = content_utils.download_package(url, sha256, content_dir=content_dir)
+
+    assert package['name'] == name
+
+
+def test_archive_content_uses_latest(update_server, content_dir):
+    for name in ('panupv2-all-contents-8213-5678', 'panupv2-all-contents-8220-5710',
+                 'panupv2-all-contents-8214-5690', 'panup-all-antivirus-3456-3966'):
+        content_utils.download_package(package_url(update_server, name), content_dir=content_dir)
+
+    paths = content_utils.get_archive_content(['appthreat', 'antivirus', 'wildfire2'], content_dir=content_dir)
+
+    assert paths == [os.path.join(content_dir, 'panupv2-all-contents-8220-5710'),
+                     os.path.join(content_dir, 'panup-all-antivirus-3456-3966')]
+    assert content_utils.find_package('appthreat', '8214-5690', content_dir)['name'] == \
+        'panupv2-all-contents-8214-5690'
@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from bootstrapper.lib import job_utils
+
+calls = list()
+
+
+@job_utils.register_job('test_echo')
+def echo_job(value):
+    calls.append(value)
+    return True, f'echoed {value}', dict(value=value)
+
+
+@job_utils.register_job('test_fail')
+def fail_job():
+    raise RuntimeError('boom')
+
+
+@job_utils.register_job('test_sleep')
+def sleep_job(seconds):
+    time.sleep(seconds)
+    return True, 'slept'
+
+
+class InlineExecutor:
+    """
+    Runs each job as soon as it is submitted, so the result can be checked right away
+    """
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+class IdleExecutor:
+    """
+    Never runs a job, like a worker that went away before picking it up
+    """
+
+    def submit(self, func, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def local_jobs(monkeypatch):
+    calls.clear()
+    monkeypatch.setenv('BOOTSTRAPPER_JOB_BROKER', 'local')
+    monkeypatch.setattr(job_utils, '_get_executor', InlineExecutor)
+
+
+def age_job(job_id, seconds):
+    # jobs age both from their creation time and from the mtime of their file, the heartbeat
+    path = job_utils._job_path(job_id)
+    with open(path, 'r') as job_file:
+        job = json.load(job_file)
+    job['created'] -= seconds
+    with open(path, 'w') as job_file:
+        json.dump(job, job_file)
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_job_success():
+    job_id = job_utils.submit_job('test_echo', 'repo', value='x')
+    job = job_utils.get_job(job_id)
+
+    assert calls == ['x']
+    assert job['status'] == 'success'
+    assert job['message'] == 'echoed x'
+    assert job['details'] == dict(value='x')
+
+
+def test_job_error():
+    job = job_utils.get_job(job_utils.submit_job('test_fail', 'repo'))
+
+    assert job['status'] == 'error'
+    assert job['message'] == 'Error: boom'
+
+
+def test_unknown_job():
+    job = job_utils.get_job(job_utils.submit_job('test_missing', 'repo'))
+
+    assert job['status'] == 'error'
+    assert job['message'] == 'Unknown job test_missing'
+
+
+def test_get_job_rejects_paths():
+    assert job_utils.get_job('../../etc/passwd') is None
+
+
+def test_pending_job_expires(monkeypatch):
+    monkeypatch.setenv('BOOTSTRAPPER_JOB_STALE_AFTER', '60')
+    monkeypatch.setattr(job_utils, '_get_executor', IdleExecutor)
+    job_id = job_utils.submit_job('test_echo', 'repo', value='x')
+
+    assert job_utils.get_job(job_id)['status'] == 'pending'
+
+    age_job(job_id, 120)
+    job = job_utils.get_job(job_id)
+
+    assert job['status'] == 'error'
+    assert 'was never started' in job['message']
+
+    # a worker that picks it up late must not run it after the user was told it failed
+    job_utils.run_job(job_id)
+
+    assert calls == []
+    assert job_utils.get_job(job_id)['status'] == 'error'
+
+
+def test_running_job_expires(monkeypatch):
+    monkeypatch.setenv('BOOTSTRAPPER_JOB_STALE_AFTER', '60')
+    monkeypatch.setattr(job_utils, '_get_executor', IdleExecutor)
+    job_id = job_utils.submit_job('test_echo', 'repo', value='x')
+    job = job_utils.get_job(job_id)
+    job['status'] = 'running'
+    job_utils._save_job(job)
+
+    age_job(job_id, 30)
+
+    assert job_utils.get_job(job_id)['status'] == 'running'
+
+    age_job(job_id, 120)
+    job = job_utils.get_job(job_id)
+
+    assert job['status'] == 'error'
+    assert 'stopped unexpectedly' in job['message']
+
+
+def test_heartbeat_keeps_long_job_alive(monkeypatch):
+    monkeypatch.setenv('BOOTSTRAPPER_JOB_STALE_AFTER', '1')
+    monkeypatch.setattr(job_utils, 'heartbeat_interval', 0.1)
+    monkeypatch.setattr(job_utils, '_get_executor', IdleExecutor)
+    job_id = job_utils.submit_job('test_sleep', 'repo', seconds=2)
+    runner = threading.Thread(target=job_utils.run_job, args=(job_id,))
+    runner.start()
+
+    time.sleep(1.5)
+    assert job_utils.get_job(job_id)['status'] == 'running'
+
+    runner.join()
+    assert job_utils.get_job(job_id)['status'] == 'success'
+
+
+def test_finished_jobs_are_not_expired(monkeypatch):
+    monkeypatch.setenv('BOOTSTRAPPER_JOB_STALE_AFTER', '60')
+    job_id = job_utils.submit_job('test_echo', 'repo', value='x')
+    age_job(job_id, 120)
+
+    assert job_utils.get_job(job_id)['status'] == 'success'
+
+
+def test_claim_finalize_once():
+    job_id = job_utils.submit_job('test_echo', 'repo', value='x')
+
+    assert job_utils.claim_finalize(job_id) is True
+    assert job_utils.claim_finalize(job_id) is False
+
+
+def test_repo_lock_non_blocking():
+    errors = list()
+
+    def try_lock():
+        try:
+            with job_utils.repo_lock('repo', blocking=False):
+                pass
+        except BlockingIOError as bie:
+            errors.append(bie)
+
+    with job_utils.repo_lock('repo'):
+        other = threading.Thread(target=try_lock)
+        other.start()
+        other.join()
+
+    assert len(errors) == 1
+
+    # free again once released
+    try_lock()
+    assert len(errors) == 1
+
+
+def test_job_lock_serializes_and_is_removed():
+    events = list()
+
+    def hold(name):
+        with job_utils.job_lock('shared'):
+            events.append(('enter', name))
+            time.sleep(0.2)
+            events.append(('exit', name))
+
+    threads = [threading.Thread(target=hold, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every holder leaves before the next one enters
+    for start in range(0, len(events), 2):
+        assert events[start][0] == 'enter'
+        assert events[start + 1] == ('exit', events[start][1])
+
+    assert os.listdir(job_utils._get_dir('job_locks')) == []
+
+
+def test_repo_and_job_locks_are_separate():
+    with job_utils.repo_lock('update_all'):
+        with job_utils.job_lock('update_all'):
+            pass
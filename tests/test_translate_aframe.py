@@ -0,0 +1,102 @@
+import pickle
+
+import pytest
+
+import translate_aframe
+
+
+class RecordingBackend(translate_aframe.OfflineBackend):
+    """
+    Offline backend that remembers every batch it was asked to translate
+    """
+
+    def __init__(self):
+        self.batches = list()
+
+    def translate(self, labels, lang, limiter=None):
+        self.batches.append(list(labels))
+        return super().translate(labels, lang, limiter)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = translate_aframe.TranslationCache(str(tmp_path / 'cache.sqlite'))
+    yield cache
+    cache.close()
+
+
+def test_put_and_get(cache):
+    cache.put_many('es', {'Hostname': 'Nombre de host', 'Password': 'Contraseña'})
+
+    assert cache.get('es', 'Hostname') == 'Nombre de host'
+    assert cache.get('it', 'Hostname') is None
+    assert cache.get_many('es', ['Hostname', 'Password', 'Missing']) == {'Hostname': 'Nombre de host',
+                                                                          'Password': 'Contraseña'}
+
+
+def test_get_many_large(cache):
+    labels = [f'label {i}' for i in range(1200)]
+    cache.put_many('fr', {label: label.upper() for label in labels})
+
+    assert cache.get_many('fr', labels) == {label: label.upper() for label in labels}
+
+
+def test_first_translation_is_kept(cache):
+    cache.put_many('es', {'Hostname': 'Nombre de host'})
+    cache.put_many('es', {'Hostname': 'Otro'})
+
+    assert cache.get('es', 'Hostname') == 'Nombre de host'
+
+
+def test_shared_between_instances(cache):
+    cache.put_many('es', {'Hostname': 'Nombre de host'})
+    other = translate_aframe.TranslationCache(cache.cache_file)
+    try:
+        assert other.get('es', 'Hostname') == 'Nombre de host'
+    finally:
+        other.close()
+
+
+def test_import_pickle_once(cache, tmp_path):
+    pickle_file = tmp_path / 'cache.pkl'
+    with open(pickle_file, 'wb') as legacy:
+        pickle.dump({'es': {'Hostname': 'Nombre de host'}, 'it': {'Hostname': 'Nome host'}}, legacy)
+
+    assert cache.import_pickle(str(pickle_file)) == 2
+    assert cache.get('it', 'Hostname') == 'Nome host'
+    assert cache.import_pickle(str(pickle_file)) == 0
+
+
+def test_load_without_legacy_import(tmp_path, monkeypatch):
+    pickle_file = tmp_path / 'cache.pkl'
+    with open(pickle_file, 'wb') as legacy:
+        pickle.dump({'es': {'Hostname': 'Nombre de host'}}, legacy)
+    monkeypatch.setattr(translate_aframe, 'legacy_cache_file_path', str(pickle_file))
+
+    offline = translate_aframe.load_translation_cache(str(tmp_path / 'offline.sqlite'), import_legacy=False)
+    online = translate_aframe.load_translation_cache(str(tmp_path / 'online.sqlite'))
+    try:
+        assert offline.get('es', 'Hostname') is None
+        assert online.get('es', 'Hostname') == 'Nombre de host'
+    finally:
+        offline.close()
+        online.close()
+
+
+def test_translate_batch_only_sends_uncached(cache, monkeypatch):
+    monkeypatch.setattr(translate_aframe, 'batch_size', 2)
+    cache.put_many('es', {'Hostname': 'Nombre de host'})
+    backend = RecordingBackend()
+    limiter = translate_aframe.RateLimiter(0)
+
+    count = translate_aframe.translate_batch(['Hostname', 'DNS', 'NTP', 'Password', 'DNS'], 'es', cache, backend,
+                                             limiter)
+
+    assert count == 3
+    assert backend.batches == [['DNS', 'NTP'], ['Password']]
+    assert cache.get('es', 'Hostname') == 'Nombre de host'
+    assert cache.get('es', 'NTP') == '[es] NTP'
+
+    # everything is cached now, nothing goes to the backend
+    assert translate_aframe.translate_batch(['DNS', 'NTP'], 'es', cache, backend, limiter) == 0
+    assert len(backend.batches) == 2
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from bootstrapper.lib import blob_utils
+from bootstrapper.lib import upload_utils
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def validate(data, size=7):
+    validator = upload_utils.BootstrapXmlValidator()
+    for chunk in chunked(data, size):
+        validator.feed(chunk)
+    validator.close()
+    return validator
+
+
+def test_accepts_config_root():
+    validator = validate(b'<?xml version="1.0"?>\n<config version="10.0.0"><devices><entry name="a"/></devices>'
+                         b'<shared/></config>')
+
+    assert validator.root.tag == 'config'
+
+
+def test_drops_finished_sections():
+    sections = b''.join(b'<entry name="%d"><value>%d</value></entry>' % (i, i) for i in range(1000))
+    validator = validate(b'<config>' + sections + b'</config>', size=4096)
+
+    assert len(validator.root) == 0
+
+
+def test_rejects_other_root():
+    with pytest.raises(ValueError, match='root element must be <config>'):
+        validate(b'<response status="success"><result/></response>')
+
+
+def test_rejects_malformed_xml():
+    with pytest.raises(ValueError, match='not valid XML'):
+        validate(b'<config><devices></config>')
+
+
+def test_rejects_truncated_xml():
+    with pytest.raises(ValueError, match='not valid XML'):
+        validate(b'<config><devices>')
+
+
+def test_rejects_empty_document():
+    with pytest.raises(ValueError):
+        validate(b'')
+
+
+def test_store_bootstrap():
+    data = b'<config version="10.0.0"><shared/></config>'
+    ref = upload_utils.store_bootstrap(chunked(data, 5))
+
+    assert b''.join(blob_utils.iter_blob(ref)) == data
+
+
+def test_store_bootstrap_keeps_nothing_when_invalid():
+    with pytest.raises(ValueError):
+        upload_utils.store_bootstrap(chunked(b'<response/>', 5))
+
+    assert os.listdir(blob_utils.get_blob_dir()) == []